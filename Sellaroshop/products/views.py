@@ -7,7 +7,12 @@ import cv2
 import numpy as np
 from .models import Product
 from .visual_search import search_engine
+from shop_app.budgets import query_budget
+from shop_app.profiling import timed
+from shop_app.serializers import FastJsonResponse, Projection, image_url, streaming_response
+from django.db.models import BooleanField, ExpressionWrapper, Q
 
+@query_budget(1)
 @csrf_exempt
 @require_http_methods(["POST"])
 def visual_search(request):
@@ -40,7 +45,8 @@ def visual_search(request):
             }, status=400)
         
         # Extract features from query image
-        query_features = search_engine.extract_features(image)
+        with timed('cv2'):
+            query_features = search_engine.extract_features(image)
         
         if query_features is None:
             return JsonResponse({
@@ -49,7 +55,7 @@ def visual_search(request):
             }, status=400)
         
         # Compare with all products
-        products = Product.objects.filter(is_active=True)
+        products = Product.objects.filter(is_active=True).select_related('category', 'brand')
         results = []
         
         for product in products:
@@ -94,6 +100,7 @@ def visual_search(request):
             'error': str(e)
         }, status=500)
 
+@query_budget(None)  # batch job: one write per processed product
 @csrf_exempt
 @require_http_methods(["POST"])
 def extract_product_features(request):
@@ -142,28 +149,50 @@ def extract_product_features(request):
             'error': str(e)
         }, status=500)
 
+PRODUCT_IMAGE = Product._meta.get_field('image')
+
+def product_feed_row(row):
+    return {
+        'id': row['id'],
+        'name': row['name'],
+        'description': row['description'],
+        'price': str(row['price']),
+        'category': row['category__name'],
+        'brand': row['brand__name'],
+        'image_url': image_url(PRODUCT_IMAGE, row['image'], None),
+        'stock': row['stock'],
+        'has_features': row['has_features']
+    }
+
+# feature_vector is only tested for NULL in SQL; the blob is never loaded
+PRODUCT_FEED = Projection(
+    ['id', 'name', 'description', 'price', 'category__name', 'brand__name', 'image', 'stock'],
+    product_feed_row,
+    has_features=ExpressionWrapper(Q(feature_vector__isnull=False), output_field=BooleanField())
+)
+
+STREAM_CHUNK_SIZE = 2000
+
+@query_budget(1)
 @csrf_exempt
 @require_http_methods(["GET"])
 def get_products(request):
-    """Get all products for testing"""
+    """Get all products for testing.
+
+    ?stream=1 streams the same JSON, ?stream=ndjson one product per line;
+    either way rows are read and encoded in chunks so memory stays flat
+    however large the catalog is.
+    """
     try:
         products = Product.objects.filter(is_active=True)
         
-        products_data = []
-        for product in products:
-            products_data.append({
-                'id': product.id,
-                'name': product.name,
-                'description': product.description,
-                'price': str(product.price),
-                'category': product.category.name,
-                'brand': product.brand.name,
-                'image_url': product.image.url if product.image else None,
-                'stock': product.stock,
-                'has_features': product.feature_vector is not None
-            })
+        if request.GET.get('stream'):
+            rows = PRODUCT_FEED.iterate(products, chunk_size=STREAM_CHUNK_SIZE)
+            return streaming_response(request, rows, 'products', {'success': True})
         
-        return JsonResponse({
+        products_data = PRODUCT_FEED.rows(products)
+        
+        return FastJsonResponse({
             'success': True,
             'products': products_data
         })
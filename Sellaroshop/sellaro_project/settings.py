@@ -37,12 +37,14 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'shop_app.profiling.RequestProfilingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'shop_app.carts.SessionCartMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -50,7 +52,7 @@ ROOT_URLCONF = 'sellaro_project.urls'
 
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        'BACKEND': 'shop_app.profiling.ProfiledDjangoTemplates',
         'DIRS': [BASE_DIR / 'templates'],
         'APP_DIRS': True,
         'OPTIONS': {
@@ -99,3 +101,53 @@ MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / 'media'
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+# The catalog version, product snapshots and stock hold totals are shared
+# through this cache, so every worker process must see the same one and
+# add()/incr() must be atomic: use Redis by setting REDIS_URL (needs the
+# redis package). The per-process LocMemCache fallback turns those caches
+# and catalog ETags off unless CACHE_IS_SHARED = True says there is only
+# one process.
+if os.environ.get('REDIS_URL'):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': os.environ['REDIS_URL'],
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+
+# Request profiling (shop_app.profiling)
+PROFILING_SLOW_REQUEST_MS = int(os.environ.get('PROFILING_SLOW_REQUEST_MS', '500'))
+PROFILING_SAMPLE_RATE = float(os.environ.get('PROFILING_SAMPLE_RATE', '1.0'))
+# Slow requests are kept in the default cache; on LocMemCache each worker
+# process keeps (and reports) only its own
+PROFILING_BUFFER_SIZE = 200
+PROFILING_TOP_SQL = 5
+SERVER_TIMING_PUBLIC = os.environ.get('SERVER_TIMING_PUBLIC') == 'True'
+
+# Product image derivatives (shop_app.images)
+IMAGE_DERIVATIVE_WIDTHS = (160, 320, 640, 1024)
+IMAGE_DERIVATIVE_WORKERS = int(os.environ.get('IMAGE_DERIVATIVE_WORKERS', '2'))
+IMAGE_DERIVATIVES_ASYNC = True
+
+# Anonymous carts live in a signed cookie ('cookie') or in guest Cart
+# rows keyed by session ('database')
+ANONYMOUS_CART_STORAGE = os.environ.get('ANONYMOUS_CART_STORAGE', 'cookie')
+
+# Guest carts and sessions idle this long are deleted by cleanup_carts
+GUEST_CART_MAX_AGE_DAYS = 30
+
+# Seconds checkout holds stock for a cart (shop_app.reservations)
+STOCK_HOLD_TTL = 10 * 60
+
+# On-demand resized images (shop_app.resize)
+IMAGE_RESIZE_SIZES = ((100, 100), (200, 200), (300, 300), (400, 300), (600, 600), (800, 600), (1200, 900))
+IMAGE_RESIZE_CACHE_DIR = os.environ.get('IMAGE_RESIZE_CACHE_DIR', BASE_DIR / 'var' / 'resized')
+IMAGE_RESIZE_CACHE_MAX_BYTES = int(os.environ.get('IMAGE_RESIZE_CACHE_MAX_BYTES', 512 * 1024 * 1024))
+IMAGE_RESIZE_MAX_AGE = 24 * 60 * 60
@@ -4,7 +4,7 @@ from django.utils.html import format_html
 from .models import (
     Category, Brand, Store, Product, 
     ProductImage, Deal, Cart, CartItem,
-    Wishlist, ProductReview
+    Wishlist, ProductReview, StockHold
 )
 
 
@@ -86,6 +86,13 @@ class CartItemAdmin(admin.ModelAdmin):
     list_filter = ('added_at',)
 
 
+# StockHold Admin
+@admin.register(StockHold)
+class StockHoldAdmin(admin.ModelAdmin):
+    list_display = ('product', 'cart', 'quantity', 'expires_at')
+    list_filter = ('expires_at',)
+
+
 # ProductImage Admin
 @admin.register(ProductImage)
 class ProductImageAdmin(admin.ModelAdmin):
@@ -0,0 +1,10 @@
+from django.apps import AppConfig
+
+
+class ShopAppConfig(AppConfig):
+    default_auto_field = 'django.db.models.BigAutoField'
+    name = 'shop_app'
+
+    def ready(self):
+        # Register product change handlers (search index, caches)
+        from . import signals  # noqa: F401
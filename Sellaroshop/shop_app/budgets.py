@@ -0,0 +1,57 @@
+# budgets.py - per-view SQL query budgets
+import time
+from functools import wraps
+
+from django.conf import settings
+from django.db import connection
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+class QueryCounter:
+    """connection.execute_wrapper hook that counts executed statements
+    and the time spent in them"""
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.duration += time.perf_counter() - start
+
+
+def query_budget(max_queries):
+    """Declare the most SQL queries a view may run, including template
+    rendering and session/auth lookups.
+
+    The budget is stored on the view as ``query_budget`` so tests can
+    check it. With settings.ENFORCE_QUERY_BUDGETS on, every request is
+    counted and going over the budget raises QueryBudgetExceeded.
+    ``None`` declares a view whose cost scales with its input by design.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if max_queries is None or not getattr(settings, 'ENFORCE_QUERY_BUDGETS', False):
+                return view(request, *args, **kwargs)
+
+            counter = QueryCounter()
+            with connection.execute_wrapper(counter):
+                response = view(request, *args, **kwargs)
+            if counter.count > max_queries:
+                raise QueryBudgetExceeded(
+                    f'{view.__name__} ran {counter.count} queries '
+                    f'(budget {max_queries})'
+                )
+            return response
+
+        wrapper.query_budget = max_queries
+        return wrapper
+    return decorator
@@ -0,0 +1,179 @@
+# cache.py - catalog version counter for cache invalidation
+import datetime
+import hashlib
+import json
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.views.decorators.http import condition
+
+CATALOG_VERSION_KEY = 'catalog:version'
+CATALOG_MODIFIED_KEY = 'catalog:modified'
+
+# Backends every worker shares and whose add() / incr() are atomic, which
+# the rebuild lock and the version counter rely on. FileBasedCache is
+# shared but implements both as a read followed by a write.
+SHARED_BACKENDS = (
+    'django.core.cache.backends.redis.RedisCache',
+    'django.core.cache.backends.memcached.PyMemcacheCache',
+    'django.core.cache.backends.memcached.PyLibMCCache',
+)
+
+
+def is_shared():
+    """Whether every worker process sees the same default cache.
+
+    Snapshot prices, stock hold totals and catalog ETags are only correct
+    when a change made by one worker is seen by all of them, so they are
+    not cached (or not sent) otherwise. CACHE_IS_SHARED overrides the
+    check, e.g. True for a single-process server on LocMemCache.
+    """
+    shared = getattr(settings, 'CACHE_IS_SHARED', None)
+    if shared is not None:
+        return shared
+    return settings.CACHES['default']['BACKEND'] in SHARED_BACKENDS
+
+
+def get_catalog_version():
+    """Current catalog version, bumped on every product/taxonomy change.
+
+    Cache entries embed this number in their key, so bumping it
+    invalidates all of them at once without having to find and delete
+    each one. Invalidation is shared between workers only when CACHES
+    points at a shared backend (see is_shared()).
+    """
+    version = cache.get(CATALOG_VERSION_KEY)
+    if version is None:
+        # Seed from the clock so an evicted counter never reuses old keys
+        version = int(time.time() * 1000)
+        cache.add(CATALOG_VERSION_KEY, version, None)
+        version = cache.get(CATALOG_VERSION_KEY, version)
+    return version
+
+
+def mark_catalog_modified():
+    """Move the catalog Last-Modified to now without changing the
+    version, for changes that are only visible in responses"""
+    cache.set(CATALOG_MODIFIED_KEY, time.time(), None)
+
+
+def bump_catalog_version():
+    mark_catalog_modified()
+    try:
+        return cache.incr(CATALOG_VERSION_KEY)
+    except ValueError:
+        version = int(time.time() * 1000)
+        cache.set(CATALOG_VERSION_KEY, version, None)
+        return version
+
+
+def get_catalog_last_modified():
+    """When the catalog version was last bumped, as an aware datetime.
+
+    If the timestamp was evicted it restarts at "now", which only makes
+    clients refetch once.
+    """
+    modified = cache.get(CATALOG_MODIFIED_KEY)
+    if modified is None:
+        modified = time.time()
+        cache.add(CATALOG_MODIFIED_KEY, modified, None)
+        modified = cache.get(CATALOG_MODIFIED_KEY, modified)
+    return datetime.datetime.fromtimestamp(modified, datetime.timezone.utc)
+
+
+def versioned_key(prefix, params=None):
+    """Cache key for ``params`` (any JSON-serializable value) that
+    changes whenever the catalog version does"""
+    key = f'{prefix}:{get_catalog_version()}'
+    if params is not None:
+        raw = json.dumps(params, sort_keys=True, default=str)
+        key += ':' + hashlib.md5(raw.encode()).hexdigest()
+    return key
+
+
+# Stampede protection for get_or_rebuild()
+REBUILD_LOCK_TIMEOUT = 30
+REBUILD_WAIT = 2.0
+REBUILD_POLL = 0.05
+
+
+def get_or_rebuild(key, builder, timeout=None):
+    """Return ``builder()`` cached under ``key`` for the current catalog
+    version, letting only one worker rebuild it at a time.
+
+    Entries are stored with the version they were built for rather than
+    under a versioned key, so after a product change the previous value
+    is still there. The worker that wins the rebuild lock recomputes it
+    while everyone else keeps serving the stale copy. On a cold cache
+    the losers wait briefly for the winner instead of all hitting the
+    database at once.
+    """
+    version = get_catalog_version()
+    entry = cache.get(key)
+    if entry is not None and entry['version'] == version:
+        return entry['value']
+
+    lock_key = f'{key}:rebuild'
+    if cache.add(lock_key, 1, REBUILD_LOCK_TIMEOUT):
+        try:
+            value = builder()
+            cache.set(key, {'version': version, 'value': value}, timeout)
+        finally:
+            cache.delete(lock_key)
+        return value
+
+    if entry is not None:
+        return entry['value']
+
+    deadline = time.monotonic() + REBUILD_WAIT
+    while time.monotonic() < deadline:
+        time.sleep(REBUILD_POLL)
+        entry = cache.get(key)
+        if entry is not None:
+            return entry['value']
+    return builder()
+
+
+def catalog_condition(when=None):
+    """Conditional GET support for views whose output depends only on the
+    catalog and the URL.
+
+    Responses get an ETag derived from the catalog version and the full
+    request path, plus a Last-Modified of the last catalog change.
+    ``If-None-Match`` / ``If-Modified-Since`` are answered with a 304 before
+    the view runs, so an unchanged catalog costs no queries. ``when``
+    optionally limits this to some requests (e.g. only JSON ones).
+
+    With a process-local cache each worker has its own catalog version,
+    so validators from one worker could wrongly match on another; no
+    validators are sent then.
+    """
+    def applies(request):
+        return is_shared() and (when is None or when(request))
+
+    def etag(request, *args, **kwargs):
+        if not applies(request):
+            return None
+        from .reservations import holds_token
+
+        raw = ':'.join([
+            str(get_catalog_version()),
+            # Product cards show stock held by checkouts as sold out
+            holds_token(),
+            request.get_full_path(),
+            request.headers.get('X-Requested-With', ''),
+        ])
+        return hashlib.md5(raw.encode()).hexdigest()
+
+    def last_modified(request, *args, **kwargs):
+        if not applies(request):
+            return None
+        from .reservations import holds_token
+
+        # Refreshes the hold totals first, which moves Last-Modified
+        # when a product was held out or given back
+        holds_token()
+        return get_catalog_last_modified()
+
+    return condition(etag_func=etag, last_modified_func=last_modified)
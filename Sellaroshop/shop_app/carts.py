@@ -0,0 +1,364 @@
+# carts.py - anonymous cookie carts, guest cart merges, batch updates and cleanup
+import json
+import time
+from collections import Counter
+from datetime import timedelta
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Exists, OuterRef
+from django.utils import timezone
+
+from . import reservations, snapshots
+from .models import Cart, CartItem, Product
+
+COOKIE_NAME = 'cart'
+COOKIE_SALT = 'shop_app.carts'
+COOKIE_MAX_AGE = 30 * 24 * 60 * 60
+# Keeps the signed cookie well under the 4 KB browsers accept
+MAX_LINES = 50
+
+
+def uses_session_carts():
+    return getattr(settings, 'ANONYMOUS_CART_STORAGE', 'cookie') == 'cookie'
+
+
+class SessionCartItem:
+    """What templates expect from a CartItem"""
+
+    def __init__(self, product, quantity):
+        self.id = product.id
+        self.product = product
+        self.quantity = quantity
+
+    def item_total(self):
+        return self.product.final_price * self.quantity
+
+
+class SessionCart:
+    """An anonymous visitor's cart, kept in a signed cookie.
+
+    It has the parts of Cart the cart views use and writes nothing to the
+    database. Lines are {product id: quantity} and item ids are product
+    ids. SessionCartMiddleware stores the cookie when the cart changed;
+    on login the lines move into the user's Cart (see merge_guest_cart).
+    """
+    id = None
+
+    def __init__(self, lines=None):
+        self.lines = dict(lines or {})
+        self.modified = False
+
+    @classmethod
+    def from_request(cls, request):
+        raw = request.get_signed_cookie(COOKIE_NAME, default=None, salt=COOKIE_SALT, max_age=COOKIE_MAX_AGE)
+        try:
+            lines = {int(pk): int(quantity) for pk, quantity in json.loads(raw).items()} if raw else {}
+        except (ValueError, TypeError, AttributeError):
+            lines = {}
+        return cls({pk: quantity for pk, quantity in lines.items() if quantity > 0})
+
+    def dumps(self):
+        return json.dumps({str(pk): quantity for pk, quantity in self.lines.items()}, separators=(',', ':'))
+
+    # Reads
+    def quantity(self, product_id):
+        return self.lines.get(product_id, 0)
+
+    def item_rows(self):
+        return [
+            {'id': pk, 'product_id': pk, 'quantity': quantity}
+            for pk, quantity in self.lines.items()
+        ]
+
+    def line_items(self):
+        products = Product.objects.in_bulk(list(self.lines))
+        return [
+            SessionCartItem(products[pk], quantity)
+            for pk, quantity in self.lines.items() if pk in products
+        ]
+
+    def total_items(self):
+        """Item count straight from the cookie, without any query"""
+        return sum(self.lines.values())
+
+    def totals(self):
+        products = snapshots.get_many(self.lines)
+        for pk in [pk for pk in self.lines if pk not in products]:
+            # The product was deleted
+            self.remove(pk)
+        cents = sum(products[pk]['final_price_cents'] * quantity for pk, quantity in self.lines.items())
+        return self.total_items(), (Decimal(cents) / 100).quantize(Decimal('0.01'))
+
+    def total_cost(self):
+        return self.totals()[1]
+
+    def is_empty(self):
+        return not self.lines
+
+    # Writes
+    def set(self, product_id, quantity):
+        if product_id not in self.lines and len(self.lines) >= MAX_LINES:
+            raise ValueError(f'A cart can hold at most {MAX_LINES} different products')
+        self.lines[product_id] = quantity
+        self.modified = True
+
+    def remove(self, product_id):
+        if self.lines.pop(product_id, None) is not None:
+            self.modified = True
+
+    def clear(self):
+        if self.lines:
+            self.lines = {}
+            self.modified = True
+
+
+def get_session_cart(request):
+    """The request's SessionCart, read from the cookie once per request"""
+    cart = getattr(request, '_session_cart', None)
+    if cart is None:
+        cart = request._session_cart = SessionCart.from_request(request)
+    return cart
+
+
+def _write_items(cart, quantities, existing_ids):
+    """Store {product id: quantity} on a Cart with one upsert (or
+    bulk_create + bulk_update where upserts are unsupported).
+    ``existing_ids`` maps product ids already in the cart to item ids."""
+    items = [CartItem(cart=cart, product_id=product_id, quantity=quantity)
+             for product_id, quantity in quantities.items()]
+    if not items:
+        return
+    if connection.features.supports_update_conflicts_with_target:
+        CartItem.objects.bulk_create(
+            items, update_conflicts=True,
+            unique_fields=['cart', 'product'], update_fields=['quantity', 'updated_at'],
+        )
+        return
+    now = timezone.now()
+    updated = []
+    for item in items:
+        if item.product_id in existing_ids:
+            item.id, item.updated_at = existing_ids[item.product_id], now
+            updated.append(item)
+    CartItem.objects.bulk_create([item for item in items if item.product_id not in existing_ids])
+    CartItem.objects.bulk_update(updated, ['quantity', 'updated_at'])
+
+
+def merge_into_user_cart(user, lines):
+    """Add {product id: quantity} to ``user``'s cart.
+
+    Both sides are read in one query each and merged in memory; merged
+    quantities are clamped to stock and lines for deleted or unavailable
+    products are dropped. The result is written in bulk (_write_items),
+    so the query count does not depend on the number of lines.
+    """
+    with transaction.atomic():
+        user_cart, created = Cart.objects.get_or_create(user=user)
+        if not lines:
+            return user_cart
+        stock = dict(
+            Product.objects.filter(id__in=list(lines), available=True).values_list('id', 'stock')
+        )
+        existing = {} if created else {
+            product_id: (item_id, quantity) for product_id, item_id, quantity in
+            user_cart.items.filter(product_id__in=list(stock)).values_list('product_id', 'id', 'quantity')
+        }
+
+        merged = {}
+        for product_id, quantity in lines.items():
+            if product_id not in stock:
+                continue
+            current = existing.get(product_id, (None, 0))[1]
+            total = min(quantity + current, stock[product_id])
+            if total > 0 and total != current:
+                merged[product_id] = total
+        _write_items(user_cart, merged, {pk: item_id for pk, (item_id, _) in existing.items()})
+    return user_cart
+
+
+def merge_guest_cart(request, user, session_key=None):
+    """Move the visitor's guest cart into ``user``'s cart after login or
+    signup: the cookie cart, plus the session-keyed guest Cart when
+    ``session_key`` is given. login() rotates the session key, so pass
+    the one read before it.
+    """
+    session_cart = get_session_cart(request)
+    lines = dict(session_cart.lines)
+    guest_carts = Cart.objects.filter(session_key=session_key, user=None) if session_key else None
+    if guest_carts is not None:
+        for product_id, quantity in CartItem.objects.filter(cart__in=guest_carts).values_list('product_id', 'quantity'):
+            lines[product_id] = lines.get(product_id, 0) + quantity
+    if not lines:
+        # Nothing to move, but empty guest carts still go
+        if guest_carts is not None:
+            guest_carts.delete()
+        return
+
+    with transaction.atomic():
+        merge_into_user_cart(user, lines)
+        if guest_carts is not None:
+            guest_carts.delete()
+    session_cart.clear()
+
+
+# ==============================
+# Batch updates
+# ==============================
+CART_OPERATIONS = ('add', 'set', 'remove')
+MAX_OPERATIONS = 100
+
+
+def parse_operations(operations):
+    """Validate a batch request's operations into (op, product id,
+    quantity) tuples; raises ValueError with a message for the client"""
+    if not isinstance(operations, list) or not operations:
+        raise ValueError('operations must be a non-empty list')
+    if len(operations) > MAX_OPERATIONS:
+        raise ValueError(f'At most {MAX_OPERATIONS} operations per request')
+    parsed = []
+    for index, operation in enumerate(operations):
+        if not isinstance(operation, dict) or operation.get('op') not in CART_OPERATIONS:
+            raise ValueError(f'Operation {index}: op must be one of {", ".join(CART_OPERATIONS)}')
+        try:
+            product_id = int(operation['product_id'])
+            quantity = int(operation.get('quantity', 1 if operation['op'] == 'add' else 0))
+        except (KeyError, TypeError, ValueError):
+            raise ValueError(f'Operation {index}: product_id and quantity must be integers')
+        if quantity < (1 if operation['op'] == 'add' else 0):
+            raise ValueError(f'Operation {index}: invalid quantity {quantity}')
+        parsed.append((operation['op'], product_id, quantity))
+    return parsed
+
+
+def apply_operations(cart, operations):
+    """Apply parsed operations to a Cart or SessionCart, all or nothing.
+
+    The cart's lines and every product involved are read with one query
+    each; operations run in order in memory, the final quantities are
+    checked against stock, and only then are the changes written in one
+    transaction (one delete plus one bulk upsert). Stock held by other
+    carts' checkouts does not count as available. ``set`` to 0 removes
+    a line. Returns a list of error messages; nothing is written unless
+    it is empty.
+    """
+    if isinstance(cart, SessionCart):
+        existing = {}
+        lines = dict(cart.lines)
+    else:
+        rows = cart.item_rows()
+        existing = {row['product_id']: row['id'] for row in rows}
+        lines = {row['product_id']: row['quantity'] for row in rows}
+    before = dict(lines)
+
+    product_ids = {product_id for op, product_id, quantity in operations}
+    products = {
+        row['id']: row for row in
+        Product.objects.filter(id__in=product_ids).values('id', 'name', 'stock', 'available')
+    }
+
+    errors = []
+    for op, product_id, quantity in operations:
+        if op == 'remove' or (op == 'set' and not quantity):
+            # Lines for deleted or unavailable products can still be dropped
+            lines.pop(product_id, None)
+        elif product_id not in products or not products[product_id]['available']:
+            errors.append(f'Product {product_id} is not available')
+        elif op == 'add':
+            lines[product_id] = lines.get(product_id, 0) + quantity
+        else:
+            lines[product_id] = quantity
+    # Units held by other carts' checkouts are not available
+    available = reservations.available_for_cart(cart, {
+        product_id: products[product_id]['stock'] for product_id in product_ids & set(lines) if product_id in products
+    })
+    for product_id, units in available.items():
+        if lines[product_id] > units:
+            errors.append(f"Only {units} of {products[product_id]['name']} available in stock")
+    if isinstance(cart, SessionCart) and len(lines) > MAX_LINES:
+        errors.append(f'A cart can hold at most {MAX_LINES} different products')
+    if errors:
+        return errors
+
+    changed = {pk: quantity for pk, quantity in lines.items() if before.get(pk) != quantity}
+    removed = [pk for pk in before if pk not in lines]
+    if isinstance(cart, SessionCart):
+        if changed or removed:
+            cart.lines = lines
+            cart.modified = True
+        return []
+    with transaction.atomic():
+        if removed:
+            cart.items.filter(product_id__in=removed).delete()
+        _write_items(cart, changed, existing)
+    return []
+
+
+# ==============================
+# Cleanup
+# ==============================
+GUEST_CART_MAX_AGE_DAYS = 30
+
+
+def stale_guest_carts(cutoff):
+    """Guest carts with no change to the cart or its items since ``cutoff``"""
+    return Cart.objects.filter(user=None, updated_at__lt=cutoff).exclude(
+        Exists(CartItem.objects.filter(cart=OuterRef('pk'), updated_at__gte=cutoff))
+    )
+
+
+def stale_sessions(cutoff):
+    """Database sessions that have expired or were last saved before
+    ``cutoff``"""
+    from django.contrib.sessions.models import Session
+
+    # Saving a session sets expire_date to now + SESSION_COOKIE_AGE
+    last_saved_cutoff = cutoff + timedelta(seconds=settings.SESSION_COOKIE_AGE)
+    return Session.objects.filter(expire_date__lt=max(timezone.now(), last_saved_cutoff))
+
+
+def delete_in_batches(queryset, batch_size=1000, pause=0.1):
+    """Delete ``queryset`` in primary key ranges of at most ``batch_size``
+    rows, each in its own short transaction, sleeping ``pause`` seconds
+    in between so other writers get the database (on SQLite one write
+    locks the whole file). Returns {model label: rows deleted}, cascades
+    included.
+    """
+    totals = Counter()
+    last = None
+    while True:
+        page = queryset.order_by('pk')
+        if last is not None:
+            page = page.filter(pk__gt=last)
+        keys = list(page.values_list('pk', flat=True)[:batch_size])
+        if not keys:
+            break
+        with transaction.atomic():
+            deleted, per_model = queryset.filter(pk__gte=keys[0], pk__lte=keys[-1]).delete()
+        totals.update(per_model)
+        last = keys[-1]
+        if len(keys) < batch_size:
+            break
+        time.sleep(pause)
+    return dict(totals)
+
+
+class SessionCartMiddleware:
+    """Write the anonymous cart cookie back when a view changed it"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        cart = getattr(request, '_session_cart', None)
+        if cart is not None and cart.modified:
+            if cart.lines:
+                response.set_signed_cookie(
+                    COOKIE_NAME, cart.dumps(), salt=COOKIE_SALT, max_age=COOKIE_MAX_AGE,
+                    secure=settings.SESSION_COOKIE_SECURE, httponly=True, samesite='Lax',
+                )
+            else:
+                response.delete_cookie(COOKIE_NAME, samesite='Lax')
+        return response
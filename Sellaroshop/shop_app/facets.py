@@ -0,0 +1,126 @@
+# facets.py - filter counts for search and category listings
+from django.core.cache import cache
+from django.db.models import BooleanField, Case, CharField, Count, Q, Value, When
+
+from .cache import versioned_key
+from .typeahead import tokenize
+
+FACET_CACHE_TIMEOUT = 60 * 10
+
+# (key, label, min inclusive, max exclusive)
+PRICE_BUCKETS = [
+    ('under50', 'Under $50', None, 50),
+    ('50-100', '$50 - $100', 50, 100),
+    ('100-500', '$100 - $500', 100, 500),
+    ('over500', 'Over $500', 500, None),
+]
+
+
+def _price_bucket():
+    whens = []
+    for key, label, low, high in PRICE_BUCKETS:
+        condition = Q()
+        if low is not None:
+            condition &= Q(effective_price__gte=low)
+        if high is not None:
+            condition &= Q(effective_price__lt=high)
+        whens.append(When(condition, then=Value(key)))
+    return Case(*whens, output_field=CharField())
+
+
+FACET_DIMENSIONS = ('category', 'brand', 'price', 'stock')
+
+
+def _matches(condition):
+    return Case(When(condition, then=Value(True)), default=Value(False), output_field=BooleanField())
+
+
+def compute_facets(queryset, filters=None):
+    """Category, brand, price bucket and stock counts for a listing.
+
+    ``queryset`` is the listing before its facet filters and ``filters``
+    maps dimensions (FACET_DIMENSIONS) to the Q the listing applies for
+    them. Each dimension is counted with every filter except its own, so
+    the other options of a selected facet show how many products picking
+    them would give; ``total`` has all filters applied.
+
+    Everything comes from a single GROUP BY over the four dimensions plus
+    one "passes this filter" flag per filter; the per-dimension totals are
+    then rolled up in Python from those (few) combination rows instead of
+    issuing one COUNT per filter value.
+    """
+    filters = {dimension: condition for dimension, condition in (filters or {}).items() if condition}
+    flags = {f'matches_{dimension}': _matches(condition) for dimension, condition in filters.items()}
+    rows = queryset.order_by().annotate(
+        price_bucket=_price_bucket(),
+        in_stock=_matches(Q(stock__gt=0)),
+        **flags
+    ).values(
+        'category_id', 'category__name', 'brand_id', 'brand__name',
+        'price_bucket', 'in_stock', *flags
+    ).annotate(count=Count('id'))
+
+    categories = {}
+    brands = {}
+    prices = {key: 0 for key, *_ in PRICE_BUCKETS}
+    stock = {'in_stock': 0, 'out_of_stock': 0}
+    total = 0
+
+    for row in rows:
+        count = row['count']
+        failed = [dimension for dimension in filters if not row[f'matches_{dimension}']]
+        if len(failed) > 1:
+            continue
+        # A row that fails one filter still counts toward that dimension
+        counts = lambda dimension: not failed or failed[0] == dimension
+
+        if not failed:
+            total += count
+        if counts('category'):
+            category = categories.setdefault(row['category_id'], {
+                'id': row['category_id'], 'name': row['category__name'], 'count': 0
+            })
+            category['count'] += count
+        if counts('brand'):
+            brand = brands.setdefault(row['brand_id'], {
+                'id': row['brand_id'], 'name': row['brand__name'], 'count': 0
+            })
+            brand['count'] += count
+        if counts('price') and row['price_bucket'] in prices:
+            prices[row['price_bucket']] += count
+        if counts('stock'):
+            stock['in_stock' if row['in_stock'] else 'out_of_stock'] += count
+
+    by_count = lambda item: (-item['count'], item['name'])
+    return {
+        'total': total,
+        'categories': sorted(categories.values(), key=by_count),
+        'brands': sorted(brands.values(), key=by_count),
+        'price': [
+            {'key': key, 'label': label, 'count': prices[key]}
+            for key, label, *_ in PRICE_BUCKETS
+        ],
+        'stock': stock,
+    }
+
+
+def facet_key(query='', **filters):
+    """Normalized cache key params: word order, case and accents in the
+    query and empty filters do not create separate entries"""
+    params = {name: str(value) for name, value in filters.items() if value not in (None, '')}
+    words = sorted(set(tokenize(query)))
+    if words:
+        params['q'] = ' '.join(words)
+    return params
+
+
+def get_facets(queryset, query='', facet_filters=None, **params):
+    """Cached compute_facets(queryset, facet_filters); ``query`` and
+    ``params`` (the request's filter values) must describe exactly how
+    the listing was filtered"""
+    key = versioned_key('facets', facet_key(query, **params))
+    facets = cache.get(key)
+    if facets is None:
+        facets = compute_facets(queryset, facet_filters)
+        cache.set(key, facets, FACET_CACHE_TIMEOUT)
+    return facets
@@ -0,0 +1,162 @@
+# images.py - fixed-width WebP/JPEG derivatives of uploaded product images
+import hashlib
+import io
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import close_old_connections
+from PIL import Image, ImageOps
+
+logger = logging.getLogger(__name__)
+
+DERIVATIVE_WIDTHS = (160, 320, 640, 1024)
+# Pillow format name -> (file extension, save options)
+DERIVATIVE_FORMATS = {
+    'webp': ('webp', {'quality': 80, 'method': 4}),
+    'jpeg': ('jpg', {'quality': 82, 'optimize': True, 'progressive': True}),
+}
+DERIVATIVE_DIR = 'derivatives'
+
+
+def content_hash(field_file):
+    digest = hashlib.sha256()
+    field_file.open('rb')
+    try:
+        for chunk in field_file.chunks():
+            digest.update(chunk)
+    finally:
+        field_file.close()
+    return digest.hexdigest()[:20]
+
+
+def derivative_name(digest, width, fmt):
+    """Storage name of one derivative; the content hash in the path means
+    a URL never changes meaning and can be cached forever"""
+    extension = DERIVATIVE_FORMATS[fmt][0]
+    return f'{DERIVATIVE_DIR}/{digest[:2]}/{digest}/{width}w.{extension}'
+
+
+def encode(image, width, fmt):
+    """Scale ``image`` down to ``width`` (never up) and encode it as ``fmt``"""
+    if image.width > width:
+        height = round(image.height * width / image.width)
+        image = image.resize((width, height), Image.LANCZOS)
+    if fmt == 'jpeg' and image.mode != 'RGB':
+        background = Image.new('RGB', image.size, (255, 255, 255))
+        background.paste(image, mask=image.getchannel('A') if 'A' in image.getbands() else None)
+        image = background
+    buffer = io.BytesIO()
+    image.save(buffer, fmt.upper(), **DERIVATIVE_FORMATS[fmt][1])
+    return buffer.getvalue()
+
+
+def open_image(field_file):
+    """Decode an uploaded image, upright and in RGB / RGBA"""
+    field_file.open('rb')
+    try:
+        with Image.open(field_file) as source:
+            image = ImageOps.exif_transpose(source)
+            image.load()
+    finally:
+        field_file.close()
+    if image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA' if 'transparency' in image.info or 'A' in image.getbands() else 'RGB')
+    return image
+
+
+def generate_derivatives(field_file):
+    """Write every derivative of ``field_file`` and return its manifest.
+
+    Widths wider than the original are skipped (the original width is
+    used instead when it is narrower than all of them). Derivatives that
+    already exist are reused, so identical uploads share files.
+
+    Manifest: {'source', 'hash', 'width', 'height',
+               'variants': {fmt: {width (str): storage name}}}
+    """
+    storage = field_file.storage
+    digest = content_hash(field_file)
+
+    image = open_image(field_file)
+
+    widths = [w for w in getattr(settings, 'IMAGE_DERIVATIVE_WIDTHS', DERIVATIVE_WIDTHS) if w < image.width]
+    widths = widths or [image.width]
+
+    variants = {}
+    for fmt in DERIVATIVE_FORMATS:
+        variants[fmt] = {}
+        for width in widths:
+            name = derivative_name(digest, width, fmt)
+            if not storage.exists(name):
+                storage.save(name, ContentFile(encode(image, width, fmt)))
+            variants[fmt][str(width)] = name
+
+    return {
+        'source': field_file.name,
+        'hash': digest,
+        'width': image.width,
+        'height': image.height,
+        'variants': variants,
+    }
+
+
+def needs_derivatives(product):
+    """True when the product's image has no manifest for its current file"""
+    if not product.image:
+        return bool(product.image_variants)
+    return (product.image_variants or {}).get('source') != product.image.name
+
+
+def process_product(product_id):
+    """Generate derivatives for one product and store the manifest"""
+    from .models import Product
+
+    product = Product.objects.filter(pk=product_id).only('id', 'image', 'image_variants').first()
+    if product is None or not needs_derivatives(product):
+        return False
+    manifest = generate_derivatives(product.image) if product.image else {}
+    # Only record it if the image was not replaced in the meantime. Nothing
+    # cached holds the manifest, so a backfill leaves the catalog caches warm
+    Product.objects.filter(pk=product_id, image=product.image.name or '').update_uncached(
+        image_variants=manifest
+    )
+    return True
+
+
+# ==============================
+# Background workers
+# ==============================
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=getattr(settings, 'IMAGE_DERIVATIVE_WORKERS', 2),
+                thread_name_prefix='image-derivatives',
+            )
+        return _executor
+
+
+def _run(product_id):
+    try:
+        process_product(product_id)
+    except Exception:
+        logger.exception('Could not generate image derivatives for product %s', product_id)
+    finally:
+        close_old_connections()
+
+
+def schedule_product(product_id):
+    """Generate derivatives off the request thread (inline when
+    IMAGE_DERIVATIVES_ASYNC is False, e.g. in tests)"""
+    if getattr(settings, 'IMAGE_DERIVATIVES_ASYNC', True):
+        get_executor().submit(_run, product_id)
+    else:
+        process_product(product_id)
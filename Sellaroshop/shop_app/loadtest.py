@@ -0,0 +1,451 @@
+# loadtest.py - synthetic catalog seeding and concurrent endpoint benchmarks
+import contextlib
+import io
+import json
+import random
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from datetime import timedelta
+from decimal import Decimal
+from http.cookiejar import Cookie, CookieJar
+from importlib import import_module
+
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY, get_user_model
+from django.db import close_old_connections, connection, connections, transaction
+from django.test import Client, override_settings
+from django.urls import NoReverseMatch, include, path, reverse
+from django.utils import timezone
+from django.utils.crypto import get_random_string
+from django.utils.text import slugify
+
+from .cache import bump_catalog_version
+from .models import Brand, Cart, CartItem, Category, Deal, Product, Store
+from .typeahead import typeahead_index
+from store.models import StoreLocation
+
+User = get_user_model()
+
+# In-process runs also drive the store locator API, which the project
+# urlconf does not route
+urlpatterns = [
+    path('', include('shop_app.urls')),
+    path('store/', include(('store.urls', 'store'))),
+]
+
+PREFIX = 'Loadtest'
+USER_PREFIX = 'loadtest-'
+
+ADJECTIVES = [
+    'classic', 'compact', 'deluxe', 'ergonomic', 'portable', 'premium', 'rugged',
+    'smart', 'vintage', 'wireless', 'organic', 'modular', 'silent', 'solar',
+]
+NOUNS = [
+    'backpack', 'blender', 'camera', 'chair', 'headphones', 'jacket', 'kettle',
+    'keyboard', 'lamp', 'monitor', 'sneakers', 'speaker', 'tablet', 'watch',
+]
+
+PERCENTILES = (50, 90, 95, 99)
+
+
+# ==============================
+# Synthetic data
+# ==============================
+class Fixture:
+    """Ids the scenarios pick from; loaded from whatever loadtest data exists"""
+
+    def __init__(self):
+        self.product_ids = list(
+            Product.objects.filter(category__name__startswith=PREFIX, available=True)
+            .values_list('id', flat=True)
+        )
+        self.users = list(User.objects.filter(username__startswith=USER_PREFIX).order_by('id'))
+        self.queries = [noun[:length] for noun in NOUNS for length in (3, 5)]
+        # store has no migrations, so its table may be missing
+        self.has_store_locations = has_table(StoreLocation)
+        if not self.product_ids or not self.users:
+            raise ValueError('No load test data found; seed it first')
+
+
+def has_table(model):
+    return model._meta.db_table in connection.introspection.table_names()
+
+
+def clear_data():
+    """Delete everything seed() created (cascades to carts and deals)"""
+    User.objects.filter(username__startswith=USER_PREFIX).delete()
+    Category.objects.filter(name__startswith=PREFIX).delete()
+    Brand.objects.filter(name__startswith=PREFIX).delete()
+    Store.objects.filter(name__startswith=PREFIX).delete()
+    if has_table(StoreLocation):
+        StoreLocation.objects.filter(name__startswith=PREFIX).delete()
+
+
+def seed(products=2000, users=50, cart_items=3, stores=50, rng_seed=0):
+    """Replace the load test catalog, users and carts with a fresh one.
+
+    Rows are bulk inserted and recognisable by the 'Loadtest' /
+    'loadtest-' prefixes so they can be wiped again without touching real
+    data. Returns a Fixture over the new rows.
+    """
+    rng = random.Random(rng_seed)
+    run = get_random_string(6).lower()
+
+    with transaction.atomic():
+        clear_data()
+
+        categories = Category.objects.bulk_create([
+            Category(name=f'{PREFIX} Category {i}', slug=f'loadtest-category-{i}')
+            for i in range(max(1, products // 100))
+        ])
+        brands = Brand.objects.bulk_create([
+            Brand(name=f'{PREFIX} Brand {i}', slug=f'loadtest-brand-{i}')
+            for i in range(max(1, products // 50))
+        ])
+
+        catalog = []
+        for i in range(products):
+            name = f'{rng.choice(ADJECTIVES).title()} {rng.choice(NOUNS)} {i}'
+            price = Decimal(rng.randrange(500, 100000)) / 100
+            catalog.append(Product(
+                name=name, slug=f'{slugify(name)}-{run}',
+                description=f'{PREFIX} product {i}',
+                category=rng.choice(categories), brand=rng.choice(brands),
+                price=price,
+                discount_price=(price * Decimal('0.8')).quantize(Decimal('0.01')) if i % 5 == 0 else None,
+                stock=rng.randrange(0, 500),
+                is_featured=i % 20 == 0, is_new=i % 7 == 0,
+                sold_count=rng.randrange(0, 1000), review_count=rng.randrange(0, 50),
+            ))
+        catalog = Product.objects.bulk_create(catalog, batch_size=500)
+
+        Deal.objects.bulk_create([
+            Deal(
+                product=product, title=f'{PREFIX} deal {product.id}',
+                discount_percentage=20, end_date=timezone.now() + timedelta(days=30),
+            )
+            for product in catalog[::50]
+        ])
+
+        accounts = []
+        for i in range(users):
+            user = User(username=f'{USER_PREFIX}{i}')
+            user.set_unusable_password()
+            accounts.append(user)
+        accounts = User.objects.bulk_create(accounts)
+
+        carts = Cart.objects.bulk_create([Cart(user=user) for user in accounts])
+        in_stock = [product for product in catalog if product.stock > 0]
+        CartItem.objects.bulk_create([
+            CartItem(cart=cart, product=product, quantity=1)
+            for cart in carts
+            for product in rng.sample(in_stock, min(cart_items, len(in_stock)))
+        ], batch_size=500)
+
+        Store.objects.bulk_create([
+            Store(name=f'{PREFIX} Store {i}', location=f'{i} Main St', nearby=i % 3 == 0)
+            for i in range(stores)
+        ])
+        if has_table(StoreLocation):
+            StoreLocation.objects.bulk_create([
+                StoreLocation(
+                    name=f'{PREFIX} Store {i}', address=f'{i} Main St', city='Springfield',
+                    state='ST', zip_code='00000',
+                    latitude=40.0 + rng.uniform(-1, 1), longitude=-74.0 + rng.uniform(-1, 1),
+                )
+                for i in range(stores)
+            ])
+    typeahead_index.invalidate()
+    bump_catalog_version()
+    return Fixture()
+
+
+# ==============================
+# Scenarios
+# ==============================
+# name -> (method, url name, request builder). A builder gets the fixture
+# and an rng and returns (query params or body, is_json_body)
+SCENARIOS = {
+    'home': ('GET', 'home', lambda f, rng: (None, False)),
+    'search_api': ('GET', 'search_api', lambda f, rng: ({'q': rng.choice(f.queries)}, False)),
+    'cart_data': ('GET', 'cart_data', lambda f, rng: (None, False)),
+    'add_to_cart': ('POST', 'add_to_cart', lambda f, rng: ({'product_id': rng.choice(f.product_ids)}, False)),
+    # GET only: a submitted checkout empties the cart, so repeats would
+    # just measure the empty-cart redirect
+    'checkout': ('GET', 'checkout', lambda f, rng: (None, False)),
+    'store_locator': ('GET', 'nearby_stores', lambda f, rng: (None, False)),
+    'store_nearby_api': ('POST', 'store:nearby_stores', lambda f, rng: (
+        {'latitude': 40.0 + rng.uniform(-1, 1), 'longitude': -74.0, 'radius': 50}, True
+    )),
+}
+
+
+def login_session(user):
+    """Create an authenticated session for ``user`` without a login request"""
+    engine = import_module(settings.SESSION_ENGINE)
+    session = engine.SessionStore()
+    session[SESSION_KEY] = user._meta.pk.value_to_string(user)
+    session[BACKEND_SESSION_KEY] = settings.AUTHENTICATION_BACKENDS[0]
+    session[HASH_SESSION_KEY] = user.get_session_auth_hash()
+    session.save()
+    return session.session_key
+
+
+class InProcessClient:
+    """Drives the app through django.test.Client in this process"""
+
+    def __init__(self, session_key):
+        # Server errors come back as 500 responses instead of raising
+        self.client = Client(raise_request_exception=False)
+        self.client.cookies[settings.SESSION_COOKIE_NAME] = session_key
+
+    def request(self, method, url, data, is_json):
+        if method == 'GET':
+            response = self.client.get(url, data or {})
+        elif is_json:
+            response = self.client.post(url, json.dumps(data), content_type='application/json')
+        else:
+            response = self.client.post(url, data or {})
+        return response.status_code
+
+    def close(self):
+        close_old_connections()
+        connections.close_all()
+
+
+class HTTPClient:
+    """Drives a running server (runserver, gunicorn, ...) over HTTP"""
+
+    def __init__(self, session_key, base_url):
+        self.base_url = base_url.rstrip('/')
+        csrf_token = get_random_string(32)
+        self.csrf_token = csrf_token
+        jar = CookieJar()
+        host = urllib.parse.urlsplit(self.base_url).hostname
+        for name, value in ((settings.SESSION_COOKIE_NAME, session_key), (settings.CSRF_COOKIE_NAME, csrf_token)):
+            jar.set_cookie(Cookie(
+                0, name, value, None, False, host, False, False, '/', True,
+                False, None, False, None, None, {},
+            ))
+        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(jar))
+
+    def request(self, method, url, data, is_json):
+        url = self.base_url + url
+        body = None
+        headers = {'X-CSRFToken': self.csrf_token}
+        if method == 'GET':
+            if data:
+                url = f'{url}?{urllib.parse.urlencode(data)}'
+        elif is_json:
+            body = json.dumps(data).encode()
+            headers['Content-Type'] = 'application/json'
+        else:
+            body = urllib.parse.urlencode(data or {}).encode()
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        request = urllib.request.Request(url, data=body, headers=headers, method=method)
+        try:
+            with self.opener.open(request, timeout=30) as response:
+                response.read()
+                return response.status
+        except urllib.error.HTTPError as e:
+            return e.code
+
+    def close(self):
+        pass
+
+
+# ==============================
+# Runner
+# ==============================
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    rank = max(0, min(len(sorted_values) - 1, round(pct / 100 * len(sorted_values) + 0.5) - 1))
+    return sorted_values[rank]
+
+
+def summarize(latencies, errors, wall_time):
+    latencies = sorted(latencies)
+    count = len(latencies)
+    stats = {
+        'requests': count,
+        'errors': errors,
+        'rps': round(count / wall_time, 1) if wall_time else 0.0,
+        'mean_ms': round(sum(latencies) / count * 1000, 2) if count else 0.0,
+        'max_ms': round(latencies[-1] * 1000, 2) if count else 0.0,
+    }
+    for pct in PERCENTILES:
+        stats[f'p{pct}_ms'] = round(percentile(latencies, pct) * 1000, 2)
+    return stats
+
+
+class LoadTest:
+    """Run each scenario in turn with ``concurrency`` virtual users.
+
+    Every virtual user is one of the seeded accounts with its own session
+    and cart. Each scenario gets ``warmup`` untimed requests per user, then
+    ``requests`` timed requests in total spread over the users; responses
+    with a 5xx status (or a transport error) count as errors.
+
+    With ``base_url`` the requests go to a running server over HTTP,
+    otherwise through the WSGI handler in this process (threads share the
+    GIL, so in-process numbers are best compared with each other rather
+    than with production).
+    """
+
+    def __init__(self, fixture, scenarios=None, concurrency=8, requests=200,
+                 warmup=2, base_url=None, rng_seed=0):
+        self.fixture = fixture
+        self.scenarios = list(scenarios or SCENARIOS)
+        self.concurrency = max(1, concurrency)
+        self.requests = max(1, requests)
+        self.warmup = max(0, warmup)
+        self.base_url = base_url
+        self.rng_seed = rng_seed
+
+    def run(self, progress=None):
+        """Return {scenario: stats}; unroutable scenarios are skipped"""
+        sessions = [
+            login_session(self.fixture.users[i % len(self.fixture.users)])
+            for i in range(self.concurrency)
+        ]
+        results = {}
+        with self.environment():
+            for name in self.scenarios:
+                method, url_name, builder = SCENARIOS[name]
+                if url_name.startswith('store:') and not self.fixture.has_store_locations:
+                    if progress:
+                        progress(f'{name}: skipped (store tables are not migrated)')
+                    continue
+                try:
+                    url = reverse(url_name)
+                except NoReverseMatch:
+                    if progress:
+                        progress(f'{name}: skipped ({url_name} is not routed)')
+                    continue
+                results[name] = self.run_scenario(sessions, method, url, builder)
+                if progress:
+                    progress(f'{name}: {results[name]["rps"]} req/s')
+        return results
+
+    @contextlib.contextmanager
+    def environment(self):
+        if self.base_url:
+            yield
+            return
+        # Views print debug output; keep it out of the report
+        with override_settings(
+            ROOT_URLCONF='shop_app.loadtest',
+            ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, 'testserver'],
+        ), contextlib.redirect_stdout(io.StringIO()):
+            yield
+
+    def make_client(self, session_key):
+        if self.base_url:
+            return HTTPClient(session_key, self.base_url)
+        return InProcessClient(session_key)
+
+    def run_scenario(self, sessions, method, url, builder):
+        lock = threading.Lock()
+        latencies = []
+        errors = [0]
+        remaining = [self.requests]
+        start_gate = threading.Barrier(len(sessions) + 1)
+
+        def worker(index, session_key):
+            rng = random.Random(self.rng_seed * 1000 + index)
+            client = self.make_client(session_key)
+            try:
+                try:
+                    for _ in range(self.warmup):
+                        client.request(method, url, *builder(self.fixture, rng))
+                except Exception:
+                    pass  # counted once the timed requests fail the same way
+                start_gate.wait()
+                while True:
+                    with lock:
+                        if remaining[0] <= 0:
+                            break
+                        remaining[0] -= 1
+                    data, is_json = builder(self.fixture, rng)
+                    started = time.perf_counter()
+                    try:
+                        status = client.request(method, url, data, is_json)
+                    except Exception:
+                        status = None
+                    elapsed = time.perf_counter() - started
+                    with lock:
+                        latencies.append(elapsed)
+                        if status is None or status >= 500:
+                            errors[0] += 1
+            finally:
+                client.close()
+
+        threads = [
+            threading.Thread(target=worker, args=(i, session_key), daemon=True)
+            for i, session_key in enumerate(sessions)
+        ]
+        for thread in threads:
+            thread.start()
+        start_gate.wait()
+        started = time.perf_counter()
+        for thread in threads:
+            thread.join()
+        return summarize(latencies, errors[0], time.perf_counter() - started)
+
+
+# ==============================
+# Baselines
+# ==============================
+def compare(results, baseline, tolerance=0.2):
+    """Compare a run against a baseline run.
+
+    Returns {scenario: {'p95_change', 'rps_change', 'regressed'}} where the
+    changes are fractions (0.25 = 25% higher). A scenario regresses when its
+    p95 latency rose, or its throughput fell, by more than ``tolerance``,
+    or when it produced errors the baseline did not have.
+    """
+    comparison = {}
+    for name, stats in results.items():
+        base = baseline.get('results', {}).get(name)
+        if not base:
+            continue
+        p95_change = (stats['p95_ms'] - base['p95_ms']) / base['p95_ms'] if base['p95_ms'] else 0.0
+        rps_change = (stats['rps'] - base['rps']) / base['rps'] if base['rps'] else 0.0
+        comparison[name] = {
+            'p95_change': round(p95_change, 3),
+            'rps_change': round(rps_change, 3),
+            'regressed': (
+                p95_change > tolerance or rps_change < -tolerance or
+                stats['errors'] > base['errors']
+            ),
+        }
+    return comparison
+
+
+def make_record(results, config):
+    return {
+        'created': timezone.now().isoformat(),
+        'config': config,
+        'results': results,
+    }
+
+
+def load_baseline(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_baseline(path, record):
+    with open(path, 'w') as f:
+        json.dump(record, f, indent=2, sort_keys=True)
+
+
+def append_history(path, record):
+    """Add a run to a JSON-lines history file for tracking over time"""
+    with open(path, 'a') as f:
+        f.write(json.dumps(record, sort_keys=True) + '\n')
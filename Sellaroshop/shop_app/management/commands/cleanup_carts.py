@@ -0,0 +1,54 @@
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from shop_app import carts
+from shop_app.models import StockHold
+
+
+class Command(BaseCommand):
+    help = (
+        'Delete guest carts and sessions inactive for longer than --days, '
+        'and expired checkout stock holds, '
+        'in small batches so the database is never locked for long. '
+        'Meant to run from cron.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int,
+                            default=getattr(settings, 'GUEST_CART_MAX_AGE_DAYS', carts.GUEST_CART_MAX_AGE_DAYS),
+                            help='Inactivity after which guest carts and sessions are deleted')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Rows deleted per transaction')
+        parser.add_argument('--pause', type=float, default=0.1, help='Seconds to sleep between batches')
+        parser.add_argument('--skip-sessions', action='store_true',
+                            help='Only delete guest carts')
+        parser.add_argument('--dry-run', action='store_true', help='Count what would be deleted')
+
+    def handle(self, *args, **options):
+        if options['days'] < 1 or options['batch_size'] < 1:
+            raise CommandError('--days and --batch-size must be at least 1')
+        cutoff = timezone.now() - timedelta(days=options['days'])
+
+        targets = [
+            ('guest carts', carts.stale_guest_carts(cutoff)),
+            ('stock holds', StockHold.objects.expired()),
+        ]
+        if not options['skip_sessions'] and settings.SESSION_ENGINE in (
+            'django.contrib.sessions.backends.db', 'django.contrib.sessions.backends.cached_db',
+        ):
+            targets.append(('sessions', carts.stale_sessions(cutoff)))
+
+        started = time.monotonic()
+        for label, queryset in targets:
+            if options['dry_run']:
+                self.stdout.write(f'{queryset.count()} {label} would be deleted')
+                continue
+            deleted = carts.delete_in_batches(queryset, options['batch_size'], options['pause'])
+            details = ', '.join(f'{count} {model}' for model, count in sorted(deleted.items()) if count)
+            self.stdout.write(f"Deleted {sum(deleted.values())} rows for stale {label} ({details or 'none'})")
+
+        if not options['dry_run']:
+            self.stdout.write(self.style.SUCCESS(f'Cleanup finished in {time.monotonic() - started:.1f}s'))
@@ -0,0 +1,52 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from shop_app import images
+from shop_app.models import Product
+
+
+class Command(BaseCommand):
+    help = 'Generate WebP/JPEG derivatives for product images that do not have them yet'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--force', action='store_true',
+                            help='Regenerate manifests for every product image')
+        parser.add_argument('--workers', type=int, default=4)
+
+    def handle(self, *args, **options):
+        products = Product.objects.exclude(image='').exclude(image__isnull=True).only('id', 'image', 'image_variants')
+        if options['force']:
+            Product.objects.exclude(image_variants={}).update_uncached(image_variants={})
+            pending = list(products.values_list('id', flat=True))
+        else:
+            pending = [product.id for product in products.iterator() if images.needs_derivatives(product)]
+
+        self.stdout.write(f'{len(pending)} product images to process')
+        processed = failed = 0
+        for product_id, result in zip(pending, self.run(pending, options['workers'])):
+            if isinstance(result, Exception):
+                failed += 1
+                self.stderr.write(f'Product {product_id}: {result}')
+            elif result:
+                processed += 1
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Derivatives generated for {processed} products, {failed} failed'
+        ))
+
+    def run(self, pending, workers):
+        if workers <= 1:
+            yield from map(self.process, pending)
+            return
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            yield from pool.map(self.process, pending)
+
+    def process(self, product_id):
+        try:
+            return images.process_product(product_id)
+        except Exception as e:
+            return e
+        finally:
+            close_old_connections()
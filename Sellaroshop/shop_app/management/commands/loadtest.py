@@ -0,0 +1,119 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from shop_app import loadtest
+
+
+class Command(BaseCommand):
+    help = (
+        'Benchmark storefront endpoints under concurrent load against a '
+        'synthetic catalog. Seeding inserts (and replaces) rows prefixed '
+        'with "Loadtest" / "loadtest-", so it only runs when asked for with '
+        '--seed-data, and only with DEBUG on unless --force is given.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--products', type=int, default=2000)
+        parser.add_argument('--users', type=int, default=50)
+        parser.add_argument('--cart-items', type=int, default=3)
+        parser.add_argument('--stores', type=int, default=50)
+        parser.add_argument('--seed-data', action='store_true',
+                            help='Insert fresh load test data first; default reuses a previous run\'s')
+        parser.add_argument('--clear', action='store_true',
+                            help='Delete the load test data and exit')
+        parser.add_argument('--force', action='store_true',
+                            help='Allow --seed-data / --clear with DEBUG off')
+        parser.add_argument('--concurrency', type=int, default=8)
+        parser.add_argument('--requests', type=int, default=200,
+                            help='Timed requests per endpoint')
+        parser.add_argument('--warmup', type=int, default=2,
+                            help='Untimed requests per client before each endpoint')
+        parser.add_argument('--endpoint', action='append', choices=sorted(loadtest.SCENARIOS),
+                            help='Endpoint to run (repeatable, default all)')
+        parser.add_argument('--url',
+                            help='Base URL of a running server; default drives the app in-process')
+        parser.add_argument('--baseline', help='Baseline JSON file to compare against')
+        parser.add_argument('--save-baseline', action='store_true',
+                            help='Write this run to --baseline instead of comparing')
+        parser.add_argument('--history', help='Append this run to a JSON-lines history file')
+        parser.add_argument('--tolerance', type=float, default=0.2,
+                            help='Allowed p95 / throughput change before a regression (0.2 = 20%%)')
+        parser.add_argument('--fail-on-regression', action='store_true')
+        parser.add_argument('--rng-seed', type=int, default=0, help='Random seed')
+
+    def handle(self, *args, **options):
+        if (options['clear'] or options['seed_data']) and not settings.DEBUG and not options['force']:
+            # Keep fixture rows out of a production catalog
+            raise CommandError(
+                'Refusing to write load test data with DEBUG off; '
+                'use a scratch database or pass --force'
+            )
+
+        if options['clear']:
+            loadtest.clear_data()
+            self.stdout.write(self.style.SUCCESS('Load test data deleted'))
+            return
+
+        if not options['seed_data']:
+            try:
+                fixture = loadtest.Fixture()
+            except ValueError as e:
+                raise CommandError(f'{e} (--seed-data)')
+        else:
+            self.stdout.write(
+                f"Seeding {options['products']} products, {options['users']} users "
+                f"and {options['stores']} stores..."
+            )
+            fixture = loadtest.seed(
+                products=options['products'], users=options['users'],
+                cart_items=options['cart_items'], stores=options['stores'],
+                rng_seed=options['rng_seed'],
+            )
+
+        config = {
+            key: options[key]
+            for key in ('products', 'users', 'cart_items', 'concurrency', 'requests', 'url')
+        }
+        runner = loadtest.LoadTest(
+            fixture, scenarios=options['endpoint'], concurrency=options['concurrency'],
+            requests=options['requests'], warmup=options['warmup'],
+            base_url=options['url'], rng_seed=options['rng_seed'],
+        )
+        results = runner.run(progress=self.stdout.write)
+        record = loadtest.make_record(results, config)
+
+        comparison = {}
+        if options['baseline'] and options['save_baseline']:
+            loadtest.save_baseline(options['baseline'], record)
+            self.stdout.write(f"Baseline written to {options['baseline']}")
+        elif options['baseline']:
+            try:
+                baseline = loadtest.load_baseline(options['baseline'])
+            except (OSError, ValueError) as e:
+                raise CommandError(f'Could not read baseline: {e}')
+            comparison = loadtest.compare(results, baseline, options['tolerance'])
+        if options['history']:
+            loadtest.append_history(options['history'], record)
+
+        self.report(results, comparison)
+
+        regressed = [name for name, change in comparison.items() if change['regressed']]
+        if regressed and options['fail_on_regression']:
+            raise CommandError(f"Regressed against baseline: {', '.join(regressed)}")
+
+    def report(self, results, comparison):
+        columns = ['p50_ms', 'p90_ms', 'p95_ms', 'p99_ms', 'max_ms']
+        header = f"{'endpoint':<18} {'reqs':>6} {'errs':>5} {'req/s':>8} " + ' '.join(
+            f'{column[:-3]:>8}' for column in columns
+        ) + ' (ms)'
+        self.stdout.write('\n' + header)
+        for name, stats in results.items():
+            line = f"{name:<18} {stats['requests']:>6} {stats['errors']:>5} {stats['rps']:>8} " + ' '.join(
+                f'{stats[column]:>8}' for column in columns
+            )
+            change = comparison.get(name)
+            if change:
+                line += f"  p95 {change['p95_change']:+.0%} req/s {change['rps_change']:+.0%}"
+                if change['regressed']:
+                    line = self.style.ERROR(line + '  REGRESSED')
+            self.stdout.write(line)
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from shop_app import search
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the full-text product search index'
+
+    def handle(self, *args, **options):
+        if not search.is_enabled():
+            self.stdout.write(
+                self.style.WARNING('Full-text index is only used on SQLite, nothing to do.')
+            )
+            return
+
+        with transaction.atomic():
+            search.rebuild()
+
+        with connection.cursor() as cursor:
+            cursor.execute(f"SELECT count(*) FROM {search.FTS_TABLE}")
+            indexed = cursor.fetchone()[0]
+
+        self.stdout.write(self.style.SUCCESS(f'Search index rebuilt: {indexed} products indexed'))
@@ -0,0 +1,45 @@
+from django.db import migrations
+
+# The SQL is spelled out here rather than imported from shop_app.search, so
+# later changes to that module cannot change what this migration did
+CREATE_SQL = """
+CREATE VIRTUAL TABLE IF NOT EXISTS shop_app_product_fts USING fts5(
+    name, description, brand, category,
+    tokenize = 'unicode61 remove_diacritics 2',
+    prefix = '2 3'
+)
+"""
+
+BACKFILL_SQL = """
+INSERT INTO shop_app_product_fts (rowid, name, description, brand, category)
+SELECT p.id, p.name, p.description, b.name, c.name
+FROM shop_app_product p
+JOIN shop_app_brand b ON b.id = p.brand_id
+JOIN shop_app_category c ON c.id = p.category_id
+"""
+
+DROP_SQL = "DROP TABLE IF EXISTS shop_app_product_fts"
+
+
+def create_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    schema_editor.execute(CREATE_SQL)
+    schema_editor.execute(BACKFILL_SQL)
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    schema_editor.execute(DROP_SQL)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop_app', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
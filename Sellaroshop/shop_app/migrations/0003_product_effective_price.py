@@ -0,0 +1,28 @@
+# Generated by Django 5.2.7 on 2026-10-19 05:08
+
+from django.db import migrations, models
+from django.db.models import Case, F, Q, When
+
+
+def backfill_effective_price(apps, schema_editor):
+    Product = apps.get_model('shop_app', 'Product')
+    on_sale = Q(is_on_sale=True, discount_price__isnull=False)
+    Product.objects.update(
+        effective_price=Case(When(on_sale, then=F('discount_price')), default=F('price'))
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop_app', '0002_product_search_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='effective_price',
+            field=models.DecimalField(db_index=True, decimal_places=2, default=0, editable=False, max_digits=10),
+        ),
+        migrations.RunPython(backfill_effective_price, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,90 @@
+from django.db import migrations
+
+# Spelled out rather than imported from shop_app.search, like 0002
+INDEX_PRODUCT_SQL = """
+    INSERT INTO shop_app_product_fts (rowid, name, description, brand, category)
+    SELECT new.id, new.name, new.description, b.name, c.name
+    FROM shop_app_brand b, shop_app_category c
+    WHERE b.id = new.brand_id AND c.id = new.category_id;
+"""
+
+CREATE_TRIGGERS_SQL = (
+    f"""
+CREATE TRIGGER IF NOT EXISTS shop_app_product_fts_insert
+AFTER INSERT ON shop_app_product BEGIN
+{INDEX_PRODUCT_SQL}
+END
+""",
+    f"""
+CREATE TRIGGER IF NOT EXISTS shop_app_product_fts_update
+AFTER UPDATE OF name, description, brand_id, category_id ON shop_app_product BEGIN
+    DELETE FROM shop_app_product_fts WHERE rowid = old.id;
+{INDEX_PRODUCT_SQL}
+END
+""",
+    """
+CREATE TRIGGER IF NOT EXISTS shop_app_product_fts_delete
+AFTER DELETE ON shop_app_product BEGIN
+    DELETE FROM shop_app_product_fts WHERE rowid = old.id;
+END
+""",
+    """
+CREATE TRIGGER IF NOT EXISTS shop_app_brand_fts_update
+AFTER UPDATE OF name ON shop_app_brand BEGIN
+    UPDATE shop_app_product_fts SET brand = new.name
+    WHERE rowid IN (SELECT id FROM shop_app_product WHERE brand_id = new.id);
+END
+""",
+    """
+CREATE TRIGGER IF NOT EXISTS shop_app_category_fts_update
+AFTER UPDATE OF name ON shop_app_category BEGIN
+    UPDATE shop_app_product_fts SET category = new.name
+    WHERE rowid IN (SELECT id FROM shop_app_product WHERE category_id = new.id);
+END
+""",
+)
+
+TRIGGER_NAMES = (
+    'shop_app_product_fts_insert',
+    'shop_app_product_fts_update',
+    'shop_app_product_fts_delete',
+    'shop_app_brand_fts_update',
+    'shop_app_category_fts_update',
+)
+
+# Catch up with writes made by queryset updates before the triggers existed
+BACKFILL_SQL = (
+    "DELETE FROM shop_app_product_fts",
+    """
+INSERT INTO shop_app_product_fts (rowid, name, description, brand, category)
+SELECT p.id, p.name, p.description, b.name, c.name
+FROM shop_app_product p
+JOIN shop_app_brand b ON b.id = p.brand_id
+JOIN shop_app_category c ON c.id = p.category_id
+""",
+)
+
+
+def create_search_triggers(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    for sql in CREATE_TRIGGERS_SQL + BACKFILL_SQL:
+        schema_editor.execute(sql)
+
+
+def drop_search_triggers(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    for name in TRIGGER_NAMES:
+        schema_editor.execute(f'DROP TRIGGER IF EXISTS {name}')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop_app', '0007_product_brand_listing_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_triggers, drop_search_triggers),
+    ]
@@ -1,14 +1,30 @@
 # models.py - CORRECTED VERSION (no circular imports)
-from django.db import models
+from django.db import models, transaction
 from django.utils.text import slugify
 from django.utils import timezone
 from django.contrib.auth import get_user_model
 from django.core.validators import MinValueValidator
+from django.db.models import Case, Count, DecimalField, F, Q, Sum, Value, When
+from django.db.models.functions import Coalesce
+from django.db.models.lookups import LessThan
+from .cache import bump_catalog_version
 from decimal import Decimal
 
 # Get the User model
 User = get_user_model()
 
+# ==============================
+# Category / Brand QuerySet
+# ==============================
+class TaxonomyQuerySet(models.QuerySet):
+    def with_product_counts(self):
+        """Annotate available product counts in the same query, so
+        product_count does not cost a query per row"""
+        return self.annotate(
+            available_product_count=Count('products', filter=Q(products__available=True))
+        )
+
+
 # ==============================
 # Category Model
 # ==============================
@@ -21,6 +37,8 @@ class Category(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    objects = TaxonomyQuerySet.as_manager()
+
     class Meta:
         verbose_name_plural = "Categories"
         ordering = ['name']
@@ -35,6 +53,9 @@ class Category(models.Model):
     
     @property
     def product_count(self):
+        # Use the with_product_counts() annotation when the queryset has it
+        if hasattr(self, 'available_product_count'):
+            return self.available_product_count
         return self.products.filter(available=True).count()
 
 
@@ -50,6 +71,8 @@ class Brand(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    objects = TaxonomyQuerySet.as_manager()
+
     class Meta:
         ordering = ['name']
 
@@ -63,6 +86,9 @@ class Brand(models.Model):
     
     @property
     def product_count(self):
+        # Use the with_product_counts() annotation when the queryset has it
+        if hasattr(self, 'available_product_count'):
+            return self.available_product_count
         return self.products.filter(available=True).count()
 
 
@@ -91,6 +117,139 @@ class Store(models.Model):
 # ==============================
 # Product Model
 # ==============================
+MONEY = models.DecimalField(max_digits=10, decimal_places=2)
+
+
+def pricing_expressions(price, discount_price):
+    """SQL equivalents of Product.refresh_pricing() for bulk UPDATEs"""
+    on_sale = LessThan(discount_price, price)
+    return {
+        'is_on_sale': Case(
+            When(on_sale, then=Value(True)),
+            default=Value(False),
+            output_field=models.BooleanField()
+        ),
+        'effective_price': Case(
+            When(on_sale, then=discount_price),
+            default=price,
+            output_field=MONEY
+        ),
+    }
+
+
+def invalidate_product_snapshots(product_ids=None):
+    from . import snapshots
+    if product_ids is None:
+        snapshots.invalidate_all()
+    else:
+        snapshots.invalidate_many(product_ids)
+
+
+class InsufficientStock(ValueError):
+    """Raised by ProductQuerySet.decrement_stock. ``shortages`` maps
+    each short product id to the units actually in stock."""
+
+    def __init__(self, shortages):
+        self.shortages = shortages
+        super().__init__(f'Not enough stock for products {sorted(shortages)}')
+
+
+class ProductQuerySet(models.QuerySet):
+    """Keeps is_on_sale / effective_price in sync for bulk writes and
+    invalidates catalog caches, since bulk writes skip the save signals"""
+
+    PRICE_FIELDS = ('price', 'discount_price')
+
+    def update(self, **kwargs):
+        if any(field in kwargs for field in self.PRICE_FIELDS):
+            # Literals need an output type: Value(None) has none and would
+            # make the pricing CASE unresolvable when a sale is cleared
+            price, discount_price = (
+                value if hasattr(value, 'resolve_expression') else Value(value, output_field=MONEY)
+                for value in (kwargs.get(field, F(field)) for field in self.PRICE_FIELDS)
+            )
+            kwargs.update(pricing_expressions(price, discount_price))
+        rows = super().update(**kwargs)
+        bump_catalog_version()
+        invalidate_product_snapshots()
+        return rows
+
+    def update_uncached(self, **kwargs):
+        """Plain UPDATE for columns no catalog cache holds (such as
+        image_variants): no pricing sync, version bump or snapshot purge"""
+        if any(field in kwargs for field in self.PRICE_FIELDS):
+            raise ValueError('Price changes must go through update()')
+        return super().update(**kwargs)
+
+    def bulk_update(self, objs, fields, batch_size=None):
+        fields = list(fields)
+        if any(field in fields for field in self.PRICE_FIELDS):
+            for obj in objs:
+                obj.refresh_pricing()
+            fields += [f for f in ('is_on_sale', 'effective_price') if f not in fields]
+        rows = super().bulk_update(objs, fields, batch_size=batch_size)
+        bump_catalog_version()
+        invalidate_product_snapshots()
+        return rows
+
+    def decrement_stock(self, quantities):
+        """Take {product id: quantity} out of stock, all or nothing.
+
+        The rows are locked (select_for_update, where the database has
+        row locks) and checked with one query, then changed by a single
+        conditional UPDATE for every line:
+            stock = stock - q, sold_count = sold_count + q WHERE stock >= q
+        The guard keeps two concurrent checkouts from overselling even
+        without row locks. Raises InsufficientStock, with nothing
+        changed, if any product is short; run it inside the caller's
+        transaction so the rest of an order rolls back with it.
+        """
+        quantities = {product_id: quantity for product_id, quantity in quantities.items() if quantity > 0}
+        if not quantities:
+            return 0
+        ids = list(quantities)
+        wanted = Case(
+            *[When(id=product_id, then=Value(quantity)) for product_id, quantity in quantities.items()],
+            output_field=models.PositiveIntegerField(),
+        )
+
+        def shortages(stock):
+            return {
+                product_id: stock.get(product_id, 0)
+                for product_id, quantity in quantities.items() if stock.get(product_id, 0) < quantity
+            }
+
+        with transaction.atomic():
+            stock = dict(self.select_for_update().filter(id__in=ids).values_list('id', 'stock'))
+            if shortages(stock):
+                raise InsufficientStock(shortages(stock))
+            # models.QuerySet.update: stock changes need no price sync or
+            # snapshot wipe, only the affected entries dropped
+            rows = models.QuerySet.update(
+                self.filter(id__in=ids, stock__gte=wanted),
+                stock=F('stock') - wanted,
+                sold_count=F('sold_count') + wanted,
+            )
+            if rows != len(ids):
+                # Sold elsewhere between the check and the update
+                raise InsufficientStock(shortages(dict(self.filter(id__in=ids).values_list('id', 'stock'))))
+
+        def stock_changed():
+            bump_catalog_version()
+            invalidate_product_snapshots(ids)
+
+        transaction.on_commit(stock_changed)
+        return rows
+
+    def bulk_create(self, objs, *args, **kwargs):
+        objs = list(objs)
+        for obj in objs:
+            obj.refresh_pricing()
+        created = super().bulk_create(objs, *args, **kwargs)
+        bump_catalog_version()
+        return created
+
+
 class Product(models.Model):
     name = models.CharField(max_length=200)
     slug = models.SlugField(max_length=200, unique=True, blank=True)
@@ -109,32 +268,109 @@ class Product(models.Model):
         null=True,
         validators=[MinValueValidator(Decimal('0.01'))]
     )
+    # Stored copy of final_price so price filters and sorts run in SQL
+    effective_price = models.DecimalField(
+        max_digits=10,
+        decimal_places=2,
+        default=0,
+        db_index=True,
+        editable=False
+    )
     stock = models.PositiveIntegerField(default=0)
     available = models.BooleanField(default=True)
     is_featured = models.BooleanField(default=False)
     is_new = models.BooleanField(default=False)
     is_on_sale = models.BooleanField(default=False)
     image = models.ImageField(upload_to='products/', blank=True, null=True)
+    # Derivative manifest written by images.generate_derivatives()
+    image_variants = models.JSONField(default=dict, blank=True, editable=False)
     rating = models.DecimalField(max_digits=3, decimal_places=2, default=0)
     review_count = models.PositiveIntegerField(default=0)
     sold_count = models.PositiveIntegerField(default=0)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    objects = ProductQuerySet.as_manager()
+
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            # Storefront sections: flag + available, newest first (read backwards)
+            models.Index(
+                fields=['created_at'],
+                condition=models.Q(available=True, is_featured=True),
+                name='product_featured_idx'
+            ),
+            models.Index(
+                fields=['created_at'],
+                condition=models.Q(available=True, is_new=True),
+                name='product_new_idx'
+            ),
+            models.Index(
+                fields=['created_at'],
+                condition=models.Q(available=True, is_on_sale=True),
+                name='product_on_sale_idx'
+            ),
+            # Listings (available only) for each keyset sort. Columns are
+            # ascending so a backward scan also yields (key DESC, id DESC);
+            # the partial condition matches the query's "available" term
+            models.Index(
+                fields=['created_at'],
+                condition=models.Q(available=True),
+                name='product_available_idx'
+            ),
+            models.Index(
+                fields=['category', 'created_at'],
+                condition=models.Q(available=True),
+                name='product_cat_newest_idx'
+            ),
+            models.Index(
+                fields=['category', 'effective_price'],
+                condition=models.Q(available=True),
+                name='product_cat_price_idx'
+            ),
+            models.Index(
+                fields=['category', 'sold_count'],
+                condition=models.Q(available=True),
+                name='product_cat_popular_idx'
+            ),
+            models.Index(
+                fields=['brand', 'created_at'],
+                condition=models.Q(available=True),
+                name='product_brand_newest_idx'
+            ),
+            models.Index(
+                fields=['brand', 'effective_price'],
+                condition=models.Q(available=True),
+                name='product_brand_price_idx'
+            ),
+            models.Index(
+                fields=['brand', 'sold_count'],
+                condition=models.Q(available=True),
+                name='product_brand_popular_idx'
+            ),
+        ]
 
     def save(self, *args, **kwargs):
         if not self.slug:
             self.slug = slugify(self.name)
         
+        self.refresh_pricing()
+        
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and any(f in update_fields for f in ProductQuerySet.PRICE_FIELDS):
+            kwargs['update_fields'] = set(update_fields) | {'is_on_sale', 'effective_price'}
+            
+        super().save(*args, **kwargs)
+
+    def refresh_pricing(self):
+        """Derive is_on_sale and effective_price from price/discount_price"""
         # Auto-set is_on_sale if discount_price exists
         if self.discount_price and self.discount_price < self.price:
             self.is_on_sale = True
         else:
             self.is_on_sale = False
-            
-        super().save(*args, **kwargs)
+        self.effective_price = self.final_price
 
     def __str__(self):
         return self.name
@@ -161,12 +397,12 @@ class Product(models.Model):
     
     def reduce_stock(self, quantity):
         """Reduce stock quantity"""
-        if self.stock >= quantity:
-            self.stock -= quantity
-            self.sold_count += quantity
-            self.save()
-            return True
-        return False
+        try:
+            Product.objects.decrement_stock({self.pk: quantity})
+        except InsufficientStock:
+            return False
+        self.refresh_from_db(fields=['stock', 'sold_count'])
+        return True
     
     def increase_stock(self, quantity):
         """Increase stock quantity"""
@@ -220,6 +456,9 @@ class Deal(models.Model):
 # ==============================
 # Cart Model
 # ==============================
+CART_MONEY = DecimalField(max_digits=12, decimal_places=2)
+
+
 class Cart(models.Model):
     user = models.ForeignKey(
         User, 
@@ -240,20 +479,41 @@ class Cart(models.Model):
             return f"{self.user.username}'s Cart"
         return f"Guest Cart {self.session_key}"
     
+    def totals(self):
+        """(item count, total cost) in one aggregate query, priced by the
+        products' stored effective_price"""
+        totals = self.items.aggregate(
+            count=Coalesce(Sum('quantity'), 0),
+            cost=Coalesce(
+                Sum(F('quantity') * F('product__effective_price'), output_field=CART_MONEY),
+                Value(Decimal('0.00')),
+                output_field=CART_MONEY,
+            ),
+        )
+        # SQLite sums decimals as floats
+        return totals['count'], Decimal(totals['cost']).quantize(Decimal('0.01'))
+    
     def total_items(self):
         """Total number of items in cart"""
-        return sum(item.quantity for item in self.items.all())
+        return self.items.aggregate(count=Coalesce(Sum('quantity'), 0))['count']
     
     def total_cost(self):
         """Total cost of all items in cart"""
-        total = 0
-        for item in self.items.all():
-            total += item.item_total()
-        return round(total, 2)
+        return self.totals()[1]
     
     def is_empty(self):
         """Check if cart is empty"""
-        return self.items.count() == 0
+        return not self.items.exists()
+    
+    def item_rows(self):
+        """id / product_id / quantity of every item (see cart_summary)"""
+        return list(self.items.values('id', 'product_id', 'quantity'))
+    
+    def line_items(self):
+        return self.items.all().select_related('product')
+    
+    def clear(self):
+        self.items.all().delete()
 
 
 # ==============================
@@ -278,6 +538,40 @@ class CartItem(models.Model):
         return self.product.final_price * self.quantity
 
 
+# ==============================
+# StockHold Model
+# ==============================
+class StockHoldQuerySet(models.QuerySet):
+
+    def active(self, now=None):
+        return self.filter(expires_at__gt=now or timezone.now())
+
+    def expired(self, now=None):
+        return self.filter(expires_at__lte=now or timezone.now())
+
+
+class StockHold(models.Model):
+    """Units of a product set aside for a cart while its owner checks out
+    (see reservations.py); ignored once expires_at has passed"""
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='holds')
+    cart = models.ForeignKey(Cart, on_delete=models.CASCADE, related_name='holds')
+    quantity = models.PositiveIntegerField()
+    expires_at = models.DateTimeField(db_index=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    objects = StockHoldQuerySet.as_manager()
+
+    class Meta:
+        unique_together = ['cart', 'product']
+        indexes = [
+            # Active holds per product (availability checks)
+            models.Index(fields=['product', 'expires_at'], name='stockhold_product_exp_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.quantity} x {self.product_id} for cart {self.cart_id}"
+
+
 # ==============================
 # Wishlist Model
 # ==============================
@@ -0,0 +1,146 @@
+# pagination.py - keyset (cursor) pagination for product listings
+import base64
+import datetime
+import json
+from decimal import Decimal
+
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+
+DEFAULT_PAGE_SIZE = 24
+MAX_PAGE_SIZE = 100
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def _encode_value(value):
+    if isinstance(value, Decimal):
+        return str(value)
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        # Keep full precision; the next page filters on equality
+        return value.isoformat()
+    return value
+
+
+def encode_cursor(values):
+    raw = json.dumps([_encode_value(v) for v in values], separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor, fields):
+    """Decode a cursor into values for the sort ``fields`` (model
+    fields), converted with each field's to_python(); raises
+    InvalidCursor for anything else, e.g. a tampered or stale cursor"""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    except (ValueError, TypeError) as e:
+        raise InvalidCursor(str(e))
+    if not isinstance(values, list) or len(values) != len(fields):
+        raise InvalidCursor('Cursor does not match the current sort')
+    try:
+        # Only scalars: to_python() lets some containers through
+        if not all(isinstance(value, (str, int, float)) for value in values):
+            raise ValueError('Cursor values must be scalars')
+        return [field.to_python(value) for field, value in zip(fields, values)]
+    except (ValidationError, ValueError, TypeError) as e:
+        raise InvalidCursor(str(e))
+
+
+def _sort_field(queryset, name):
+    """Model field, or annotation output field, behind a sort key"""
+    annotation = queryset.query.annotations.get(name)
+    if annotation is not None:
+        return annotation.output_field
+    return queryset.model._meta.get_field(name)
+
+
+def _after(ordering, values):
+    """Build the "row comes after `values`" filter for an ordering.
+
+    For ordering (a, -b, id) this is
+    a > va OR (a = va AND b < vb) OR (a = va AND b = vb AND id > vid).
+    """
+    condition = Q()
+    equal = Q()
+    for field, value in zip(ordering, values):
+        name = field.lstrip('-')
+        lookup = 'lt' if field.startswith('-') else 'gt'
+        condition |= equal & Q(**{f'{name}__{lookup}': value})
+        equal &= Q(**{name: value})
+    return condition
+
+
+class KeysetPage:
+    def __init__(self, object_list, next_cursor, cursor, params):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.cursor = cursor
+        self.params = params
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __bool__(self):
+        return bool(self.object_list)
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_previous(self):
+        return bool(self.cursor)
+
+    @property
+    def next_query(self):
+        """Current query string with the cursor advanced to the next page"""
+        params = self.params.copy()
+        params['cursor'] = self.next_cursor
+        return params.urlencode()
+
+    @property
+    def first_query(self):
+        params = self.params.copy()
+        params.pop('cursor', None)
+        return params.urlencode()
+
+
+def paginate(queryset, ordering, params, per_page=DEFAULT_PAGE_SIZE):
+    """Return one page of ``queryset`` sorted by ``ordering``.
+
+    ``params`` is the request's query dict; the page cursor is read from
+    its 'cursor' key and the other filters are carried over to the
+    next/first page links.
+
+    ``ordering`` must end in a unique field (normally 'id' / '-id') so the
+    key is total. Instead of OFFSET, each page filters on the last key of
+    the previous one, so with a matching index page 500 costs the same as
+    page 1. An invalid cursor restarts from the first page.
+    """
+    per_page = max(1, min(per_page, MAX_PAGE_SIZE))
+    cursor = params.get('cursor')
+    queryset = queryset.order_by(*ordering)
+
+    if cursor:
+        try:
+            fields = [_sort_field(queryset, field.lstrip('-')) for field in ordering]
+            values = decode_cursor(cursor, fields)
+            queryset = queryset.filter(_after(ordering, values))
+        except InvalidCursor:
+            cursor = None
+
+    rows = list(queryset[:per_page + 1])
+    next_cursor = None
+    if len(rows) > per_page:
+        rows = rows[:per_page]
+        last = rows[-1]
+        next_cursor = encode_cursor(
+            [getattr(last, field.lstrip('-')) for field in ordering]
+        )
+    return KeysetPage(rows, next_cursor, cursor, params)
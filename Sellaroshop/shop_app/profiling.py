@@ -0,0 +1,207 @@
+# profiling.py - per-request phase timings and slow request sampling
+import random
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+from django.template.backends.django import DjangoTemplates, Template
+from django.utils.functional import SimpleLazyObject, empty
+
+_current_profile = ContextVar('request_profile', default=None)
+
+
+class RequestProfile:
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.view_start = None
+        # Number of queries and template time when the view started, so
+        # SQL run by middleware before it is not charged to the view
+        self.view_queries = 0
+        self.view_tpl = 0.0
+        self.queries = []
+        self.phases = {}
+
+    def start_view(self):
+        self.view_start = time.perf_counter()
+        self.view_queries = len(self.queries)
+        self.view_tpl = self.phases.get('tpl', 0.0)
+
+    def view_time(self, end):
+        """Seconds from the view starting to ``end`` that were spent
+        neither in SQL nor in template rendering"""
+        db = sum(duration for sql, duration in self.queries[self.view_queries:])
+        tpl = self.phases.get('tpl', 0.0) - self.view_tpl
+        return max(end - self.view_start - db - tpl, 0.0)
+
+    def add(self, phase, seconds):
+        self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    @property
+    def db_time(self):
+        return sum(duration for sql, duration in self.queries)
+
+    def __call__(self, execute, sql, params, many, context):
+        # connection.execute_wrapper hook
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries.append((sql, time.perf_counter() - start))
+
+    def top_queries(self, limit):
+        slowest = sorted(self.queries, key=lambda q: q[1], reverse=True)[:limit]
+        return [{'sql': sql[:1000], 'ms': round(duration * 1000, 2)} for sql, duration in slowest]
+
+
+@contextmanager
+def timed(phase):
+    """Attribute a block to a named Server-Timing phase, e.g. 'cv2'"""
+    profile = _current_profile.get()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if profile is not None:
+            profile.add(phase, time.perf_counter() - start)
+
+
+# ==============================
+# Template backend
+# ==============================
+class ProfiledTemplate(Template):
+    def render(self, context=None, request=None):
+        with timed('tpl'):
+            return super().render(context, request)
+
+
+class ProfiledDjangoTemplates(DjangoTemplates):
+    """DjangoTemplates backend that reports render time to the profiler"""
+
+    def from_string(self, template_code):
+        return ProfiledTemplate(self.engine.from_string(template_code), self)
+
+    def get_template(self, template_name):
+        template = super().get_template(template_name)
+        return ProfiledTemplate(template.template, self)
+
+
+# ==============================
+# Slow request log
+# ==============================
+class SlowRequestLog:
+    """Ring buffer of ``size`` slots in the default cache.
+
+    Each entry takes the next slot from an atomic counter, so with a
+    shared cache (see cache.is_shared()) the report shows the slow
+    requests of every worker. With a per-process cache each worker only
+    sees its own.
+    """
+
+    def __init__(self, size, prefix='profiling:slow'):
+        self.size = size
+        self.prefix = prefix
+
+    def _keys(self):
+        return [f'{self.prefix}:{slot}' for slot in range(self.size)]
+
+    def add(self, entry):
+        counter = f'{self.prefix}:next'
+        cache.add(counter, 0, None)
+        try:
+            position = cache.incr(counter)
+        except ValueError:
+            # Evicted between add() and incr()
+            position = 0
+            cache.set(counter, position, None)
+        cache.set(f'{self.prefix}:{position % self.size}', entry, None)
+
+    def entries(self):
+        """Newest first"""
+        entries = cache.get_many(self._keys()).values()
+        return sorted(entries, key=lambda entry: entry['time'], reverse=True)
+
+    def clear(self):
+        cache.delete_many(self._keys() + [f'{self.prefix}:next'])
+
+
+slow_requests = SlowRequestLog(getattr(settings, 'PROFILING_BUFFER_SIZE', 200))
+
+
+# ==============================
+# Middleware
+# ==============================
+class RequestProfilingMiddleware:
+    """Time SQL, template rendering and view code for every request.
+
+    Timings go out as a Server-Timing header to staff users (when the view
+    has loaded request.user anyway) or to everyone with DEBUG /
+    SERVER_TIMING_PUBLIC. Requests slower than
+    PROFILING_SLOW_REQUEST_MS are sampled at PROFILING_SAMPLE_RATE into a
+    ring buffer in the cache together with their slowest SQL statements.
+    Should be first in MIDDLEWARE so "total" covers the whole stack.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.slow_ms = getattr(settings, 'PROFILING_SLOW_REQUEST_MS', 500)
+        self.sample_rate = getattr(settings, 'PROFILING_SAMPLE_RATE', 1.0)
+        self.top_sql = getattr(settings, 'PROFILING_TOP_SQL', 5)
+
+    def __call__(self, request):
+        profile = RequestProfile()
+        token = _current_profile.set(profile)
+        try:
+            with connection.execute_wrapper(profile):
+                response = self.get_response(request)
+        finally:
+            _current_profile.reset(token)
+
+        end = time.perf_counter()
+        timings = self.timings(profile, end)
+        total = end - profile.start
+
+        if self.show_header(request):
+            response['Server-Timing'] = ', '.join(
+                f'{name};dur={seconds * 1000:.1f};desc="{desc}"'
+                for name, desc, seconds in timings
+            )
+
+        if total * 1000 >= self.slow_ms and random.random() < self.sample_rate:
+            slow_requests.add({
+                'time': time.time(),
+                'method': request.method,
+                'path': request.get_full_path()[:500],
+                'status': response.status_code,
+                'timings': {name: round(seconds * 1000, 1) for name, desc, seconds in timings},
+                'query_count': len(profile.queries),
+                'top_queries': profile.top_queries(self.top_sql),
+            })
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        profile = _current_profile.get()
+        if profile is not None:
+            profile.start_view()
+
+    def timings(self, profile, end):
+        timings = [('db', f'SQL ({len(profile.queries)} queries)', profile.db_time)]
+        for phase, seconds in profile.phases.items():
+            timings.append((phase, 'Template render' if phase == 'tpl' else phase, seconds))
+        if profile.view_start is not None:
+            # Non-SQL, non-template time from the view starting until the
+            # response came back (inner middleware's response phase included)
+            timings.append(('view', 'View code', profile.view_time(end)))
+        timings.append(('total', 'Total', end - profile.start))
+        return timings
+
+    def show_header(self, request):
+        if settings.DEBUG or getattr(settings, 'SERVER_TIMING_PUBLIC', False):
+            return True
+        user = getattr(request, 'user', None)
+        if isinstance(user, SimpleLazyObject) and user._wrapped is empty:
+            # The view never loaded the user; don't spend queries on it here
+            return False
+        return bool(user is not None and user.is_authenticated and user.is_staff)
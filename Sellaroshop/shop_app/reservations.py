@@ -0,0 +1,148 @@
+# reservations.py - time-limited stock holds taken when checkout begins
+import hashlib
+import math
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Max, Min, Sum
+from django.utils import timezone
+
+from .cache import is_shared, mark_catalog_modified
+from .models import Product, StockHold
+
+HOLD_TTL = 10 * 60
+HOLDS_CACHE_KEY = 'stock-holds:active'
+HOLDS_TOKEN_KEY = 'stock-holds:token'
+# Upper bound on how stale the cached totals get; they are also dropped
+# whenever holds change and never outlive the earliest hold
+HOLDS_CACHE_TIMEOUT = 15
+
+
+def active_holds():
+    """{'held': {product id: units on hold}, 'token': str} for all active
+    holds.
+
+    One GROUP BY over the active holds (few, and indexed by expiry) on a
+    cache miss, so checking availability on every product card costs a
+    dict lookup. ``token`` changes whenever holds take a product to zero
+    or give one back, i.e. whenever a card's in_stock could change; it is
+    part of the catalog ETag, and a new token moves the catalog
+    Last-Modified. Not cached when the cache is per process,
+    since holds taken by other workers would go unseen.
+    """
+    shared = is_shared()
+    data = cache.get(HOLDS_CACHE_KEY) if shared else None
+    if data is not None:
+        return data
+
+    now = timezone.now()
+    rows = list(
+        StockHold.objects.active(now).values('product_id').annotate(
+            held=Sum('quantity'), stock=Max('product__stock'), first_expiry=Min('expires_at'),
+        )
+    )
+    held_out = sorted(row['product_id'] for row in rows if row['held'] >= row['stock'])
+    data = {
+        'held': {row['product_id']: row['held'] for row in rows},
+        'token': hashlib.md5(','.join(map(str, held_out)).encode()).hexdigest()[:12],
+    }
+    timeout = HOLDS_CACHE_TIMEOUT
+    if rows:
+        first_expiry = min(row['first_expiry'] for row in rows)
+        timeout = max(1, min(timeout, math.ceil((first_expiry - now).total_seconds())))
+    if shared:
+        if cache.get(HOLDS_TOKEN_KEY) != data['token']:
+            cache.set(HOLDS_TOKEN_KEY, data['token'], None)
+            mark_catalog_modified()
+        cache.set(HOLDS_CACHE_KEY, data, timeout)
+    return data
+
+
+def held_quantities():
+    return active_holds()['held']
+
+
+def holds_token():
+    return active_holds()['token']
+
+
+def available_stock(product_id, stock, held=None):
+    """Stock minus all active holds"""
+    held = held_quantities() if held is None else held
+    return max(0, stock - held.get(product_id, 0))
+
+
+def available_for_cart(cart, stock):
+    """{product id: units ``cart`` may have} for {product id: stock}:
+    stock minus the active holds of other carts.
+
+    The cart's own holds (it is checking out) do not count against it.
+    They are looked up only when one of the products is held at all,
+    so the usual cost is the cached active_holds() lookup.
+    """
+    held = held_quantities()
+    own = {}
+    if getattr(cart, 'id', None) is not None and any(held.get(product_id) for product_id in stock):
+        own = dict(
+            StockHold.objects.active().filter(cart=cart, product_id__in=list(stock))
+            .values('product_id').annotate(held=Sum('quantity')).values_list('product_id', 'held')
+        )
+    return {
+        product_id: available_stock(product_id, product_stock + own.get(product_id, 0), held)
+        for product_id, product_stock in stock.items()
+    }
+
+
+def _holds_changed():
+    cache.delete(HOLDS_CACHE_KEY)
+
+
+def hold_cart(cart, lines, ttl=None):
+    """Hold {product id: quantity} for ``cart`` for ``ttl`` seconds,
+    replacing its earlier holds (so calling it again extends them).
+
+    Products are locked (where the database supports it) and checked
+    against stock minus other carts' active holds in constant queries.
+    Returns {product id: units this cart could get} for the lines that
+    cannot be held; nothing changes then.
+    """
+    if not lines:
+        return {}
+    now = timezone.now()
+    expires_at = now + timedelta(seconds=ttl or getattr(settings, 'STOCK_HOLD_TTL', HOLD_TTL))
+    product_ids = list(lines)
+    with transaction.atomic():
+        stock = dict(Product.objects.select_for_update().filter(id__in=product_ids).values_list('id', 'stock'))
+        others = dict(
+            StockHold.objects.active(now).filter(product_id__in=product_ids).exclude(cart=cart)
+            .values('product_id').annotate(held=Sum('quantity')).values_list('product_id', 'held')
+        )
+        available = {
+            product_id: max(0, stock.get(product_id, 0) - others.get(product_id, 0))
+            for product_id in product_ids
+        }
+        shortages = {
+            product_id: available[product_id]
+            for product_id, quantity in lines.items() if quantity > available[product_id]
+        }
+        if shortages:
+            return shortages
+
+        StockHold.objects.filter(cart=cart).delete()
+        StockHold.objects.bulk_create([
+            StockHold(cart=cart, product_id=product_id, quantity=quantity, expires_at=expires_at)
+            for product_id, quantity in lines.items()
+        ])
+        transaction.on_commit(_holds_changed)
+    return {}
+
+
+def release(cart):
+    """Drop the cart's holds after checkout. Expired holds need no
+    release: they stop counting at expires_at and cleanup_carts deletes
+    them in batches."""
+    if StockHold.objects.filter(cart=cart).delete()[0]:
+        transaction.on_commit(_holds_changed)
+
@@ -0,0 +1,259 @@
+# resize.py - on-demand resized catalog images with a size-bounded disk cache
+import hashlib
+import io
+import os
+import tempfile
+import threading
+from concurrent.futures import Future
+from pathlib import Path
+
+from django.conf import settings
+from django.urls import reverse
+
+from . import images
+from .models import Brand, Category, Product
+
+# URL kind -> (model, image field)
+SOURCES = {
+    'product': (Product, 'image'),
+    'category': (Category, 'image'),
+    'brand': (Brand, 'logo'),
+}
+# Bounding boxes (width, height) that may be requested; anything else is a
+# 404 so the cache cannot be flooded with arbitrary sizes
+RESIZE_SIZES = ((100, 100), (200, 200), (300, 300), (400, 300), (600, 600), (800, 600), (1200, 900))
+# URL extension -> Pillow format (see images.DERIVATIVE_FORMATS)
+RESIZE_FORMATS = {'webp': 'webp', 'jpg': 'jpeg'}
+CONTENT_TYPES = {'webp': 'image/webp', 'jpg': 'image/jpeg'}
+
+CACHE_MAX_BYTES = 512 * 1024 * 1024
+# Eviction frees space down to this fraction of the limit, so it does not
+# run again on the very next write
+CACHE_LOW_WATER = 0.9
+
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+DEFAULT_MAX_AGE = 24 * 60 * 60
+
+
+def allowed(kind, width, height, ext):
+    sizes = {tuple(size) for size in getattr(settings, 'IMAGE_RESIZE_SIZES', RESIZE_SIZES)}
+    return kind in SOURCES and ext in RESIZE_FORMATS and (width, height) in sizes
+
+
+def _storage(kind):
+    model, field = SOURCES[kind]
+    return model._meta.get_field(field).storage
+
+
+def source_name(kind, pk):
+    """Storage name of the object's image, or None"""
+    model, field = SOURCES[kind]
+    return model.objects.filter(pk=pk).values_list(field, flat=True).first() or None
+
+
+def version(name):
+    """URL token for the current image; upload names change when the image
+    is replaced, so a matching token means the response can never change"""
+    return hashlib.sha1(name.encode()).hexdigest()[:12]
+
+
+def resized_url(obj, width, height, ext='webp'):
+    """Versioned URL of ``obj``'s image scaled into width x height, or ''"""
+    kind = next(kind for kind, (model, field) in SOURCES.items() if isinstance(obj, model))
+    field_file = getattr(obj, SOURCES[kind][1])
+    if not field_file:
+        return ''
+    url = reverse('resized_image', args=[kind, obj.pk, width, height, ext])
+    return f'{url}?v={version(field_file.name)}'
+
+
+def cache_key(kind, name, width, height, ext):
+    """Cache key and ETag of one rendition. The source size is part of it,
+    so a file overwritten under the same name is not served stale.
+    Raises FileNotFoundError when the source is gone."""
+    size = _storage(kind).size(name)
+    return hashlib.sha256(f'{name}:{size}:{width}x{height}:{ext}'.encode()).hexdigest()[:32]
+
+
+def render(kind, name, width, height, ext):
+    """Scale the source down to fit inside width x height (never up)"""
+    with _storage(kind).open(name, 'rb') as source:
+        image = images.open_image(source)
+    fit_width = min(width, max(1, height * image.width // image.height))
+    return images.encode(image, fit_width, RESIZE_FORMATS[ext])
+
+
+# ==============================
+# Disk cache
+# ==============================
+class DiskCache:
+    """Files under ``directory`` with least-recently-used eviction.
+
+    Reads bump the file's mtime, so mtime order is recency order and the
+    cache survives restarts without a separate index. Writes go through a
+    temporary file and os.replace(), so readers never see partial files
+    even with several processes sharing the directory.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._size = None
+
+    def path(self, key, ext):
+        return self.directory / key[:2] / f'{key}.{ext}'
+
+    def open(self, key, ext):
+        """Open file for ``key``, or None on a miss"""
+        path = self.path(key, ext)
+        try:
+            handle = open(path, 'rb')
+        except FileNotFoundError:
+            return None
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            # Evicted after the open; the handle still reads the data
+            pass
+        return handle
+
+    def put(self, key, ext, data):
+        path = self.path(key, ext)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=path.parent, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as tmp:
+                tmp.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            try:
+                os.unlink(tmp_path)
+            except FileNotFoundError:
+                pass
+            raise
+        self._grew(len(data))
+
+    def _entries(self):
+        """(mtime, size, path) of every cached file"""
+        entries = []
+        if not self.directory.is_dir():
+            return entries
+        for bucket in os.scandir(self.directory):
+            if not bucket.is_dir():
+                continue
+            for entry in os.scandir(bucket.path):
+                if entry.name.endswith('.tmp'):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    def usage(self):
+        return sum(size for _, size, _ in self._entries())
+
+    def _grew(self, nbytes):
+        # The running total is per process; it is resynced from disk on
+        # every eviction, which is what bounds the directory
+        with self._lock:
+            if self._size is None:
+                self._size = self.usage()
+            else:
+                self._size += nbytes
+            if self._size > self.max_bytes:
+                self._size = self.evict()
+
+    def evict(self, target=None):
+        """Delete least recently used files until at most ``target`` bytes
+        remain; returns the bytes left"""
+        if target is None:
+            target = int(self.max_bytes * CACHE_LOW_WATER)
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= target:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+        return total
+
+
+_disk_cache = None
+_disk_cache_lock = threading.Lock()
+
+
+def get_cache():
+    global _disk_cache
+    directory = getattr(settings, 'IMAGE_RESIZE_CACHE_DIR', Path(settings.BASE_DIR) / 'var' / 'resized')
+    max_bytes = getattr(settings, 'IMAGE_RESIZE_CACHE_MAX_BYTES', CACHE_MAX_BYTES)
+    with _disk_cache_lock:
+        if _disk_cache is None or (_disk_cache.directory, _disk_cache.max_bytes) != (Path(directory), max_bytes):
+            _disk_cache = DiskCache(directory, max_bytes)
+        return _disk_cache
+
+
+# ==============================
+# Request collapsing
+# ==============================
+_inflight = {}
+_inflight_lock = threading.Lock()
+
+
+def single_flight(key, work):
+    """Run ``work()`` once for concurrent callers with the same ``key``;
+    the others wait for and share its result (or exception)"""
+    with _inflight_lock:
+        future = _inflight.get(key)
+        leader = future is None
+        if leader:
+            future = _inflight[key] = Future()
+    if not leader:
+        return future.result()
+    try:
+        result = work()
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    else:
+        future.set_result(result)
+        return result
+    finally:
+        with _inflight_lock:
+            del _inflight[key]
+
+
+def open_resized(kind, name, key, width, height, ext):
+    """Open file of the rendition, rendering and caching it on a miss.
+
+    Concurrent misses in this process render once. Another process may
+    render the same key at the same moment; both writes are atomic and
+    identical, so that only costs the duplicate work.
+    """
+    disk = get_cache()
+    handle = disk.open(key, ext)
+    if handle is not None:
+        return handle
+
+    def fill():
+        # A caller that was rendering when we missed may have finished
+        if not disk.path(key, ext).exists():
+            disk.put(key, ext, render(kind, name, width, height, ext))
+
+    single_flight(key, fill)
+    handle = disk.open(key, ext)
+    if handle is None:
+        # Evicted straight away by a tiny cache; serve a fresh render
+        return io.BytesIO(render(kind, name, width, height, ext))
+    return handle
+
+
+def cache_control(immutable):
+    if immutable:
+        return f'public, max-age={IMMUTABLE_MAX_AGE}, immutable'
+    return f"public, max-age={getattr(settings, 'IMAGE_RESIZE_MAX_AGE', DEFAULT_MAX_AGE)}"
@@ -0,0 +1,150 @@
+# search.py - full-text product search backed by SQLite FTS5
+import re
+
+from django.db import connection
+from django.db.models import FloatField, Q, Value
+from django.db.models.expressions import RawSQL
+
+FTS_TABLE = 'shop_app_product_fts'
+
+# Column weights for bm25(): name, description, brand, category
+BM25_WEIGHTS = (10.0, 1.0, 5.0, 3.0)
+
+CREATE_SQL = f"""
+CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5(
+    name, description, brand, category,
+    tokenize = 'unicode61 remove_diacritics 2',
+    prefix = '2 3'
+)
+"""
+
+DROP_SQL = f"DROP TABLE IF EXISTS {FTS_TABLE}"
+
+# Rows are keyed by rowid = product id so they can be joined back cheaply
+_INSERT_SELECT_SQL = f"""
+INSERT INTO {FTS_TABLE} (rowid, name, description, brand, category)
+SELECT p.id, p.name, p.description, b.name, c.name
+FROM shop_app_product p
+JOIN shop_app_brand b ON b.id = p.brand_id
+JOIN shop_app_category c ON c.id = p.category_id
+"""
+
+# Triggers keep the index in step with every write to the catalog tables,
+# including queryset update() / bulk_create() / delete() that send no signals.
+# A product row is reindexed by deleting and re-inserting it.
+_INDEX_PRODUCT_SQL = f"""
+    INSERT INTO {FTS_TABLE} (rowid, name, description, brand, category)
+    SELECT new.id, new.name, new.description, b.name, c.name
+    FROM shop_app_brand b, shop_app_category c
+    WHERE b.id = new.brand_id AND c.id = new.category_id;
+"""
+
+TRIGGERS_SQL = (
+    f"""
+CREATE TRIGGER IF NOT EXISTS shop_app_product_fts_insert
+AFTER INSERT ON shop_app_product BEGIN
+{_INDEX_PRODUCT_SQL}
+END
+""",
+    f"""
+CREATE TRIGGER IF NOT EXISTS shop_app_product_fts_update
+AFTER UPDATE OF name, description, brand_id, category_id ON shop_app_product BEGIN
+    DELETE FROM {FTS_TABLE} WHERE rowid = old.id;
+{_INDEX_PRODUCT_SQL}
+END
+""",
+    f"""
+CREATE TRIGGER IF NOT EXISTS shop_app_product_fts_delete
+AFTER DELETE ON shop_app_product BEGIN
+    DELETE FROM {FTS_TABLE} WHERE rowid = old.id;
+END
+""",
+    f"""
+CREATE TRIGGER IF NOT EXISTS shop_app_brand_fts_update
+AFTER UPDATE OF name ON shop_app_brand BEGIN
+    UPDATE {FTS_TABLE} SET brand = new.name
+    WHERE rowid IN (SELECT id FROM shop_app_product WHERE brand_id = new.id);
+END
+""",
+    f"""
+CREATE TRIGGER IF NOT EXISTS shop_app_category_fts_update
+AFTER UPDATE OF name ON shop_app_category BEGIN
+    UPDATE {FTS_TABLE} SET category = new.name
+    WHERE rowid IN (SELECT id FROM shop_app_product WHERE category_id = new.id);
+END
+""",
+)
+
+_TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def is_enabled():
+    """FTS5 is only used on SQLite; other backends fall back to icontains"""
+    return connection.vendor == 'sqlite'
+
+
+def build_match_expression(query):
+    """Turn free text into a safe FTS5 prefix query.
+
+    Every word is quoted (so FTS operators typed by users are treated as
+    text) and suffixed with * for prefix matching, e.g. 'blue sho' becomes
+    '"blue"* "sho"*'. Returns '' when the query has no searchable words.
+    """
+    tokens = _TOKEN_RE.findall(query.lower())
+    return ' '.join(f'"{token}"*' for token in tokens)
+
+
+def _execute(sql, params=None, cursor=None):
+    if cursor is not None:
+        cursor.execute(sql, params or [])
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params or [])
+
+
+def rebuild(cursor=None):
+    """Create the index and its triggers (if needed) and backfill it in one INSERT ... SELECT"""
+    _execute(CREATE_SQL, cursor=cursor)
+    # A table rebuild by a later schema migration drops the triggers; this puts them back
+    for sql in TRIGGERS_SQL:
+        _execute(sql, cursor=cursor)
+    _execute(f"DELETE FROM {FTS_TABLE}", cursor=cursor)
+    _execute(_INSERT_SELECT_SQL, cursor=cursor)
+    _execute(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('optimize')", cursor=cursor)
+
+
+def filter_queryset(queryset, query):
+    """Restrict a Product queryset to full-text matches, best match first.
+
+    On SQLite the FTS table is joined in so the result is ranked by BM25
+    and can still be combined with the usual ORM filters. Elsewhere it
+    falls back to icontains over the same fields.
+    """
+    expression = build_match_expression(query)
+    if not expression:
+        return queryset.none()
+
+    if not is_enabled():
+        # No relevance score here; a constant search_rank keeps callers
+        # that order or paginate by it working (newest id first)
+        return queryset.filter(
+            Q(name__icontains=query) |
+            Q(description__icontains=query) |
+            Q(brand__name__icontains=query) |
+            Q(category__name__icontains=query)
+        ).annotate(
+            search_rank=Value(0.0, output_field=FloatField())
+        ).order_by('search_rank', '-id')
+
+    # search_rank is a real annotation so it can be filtered on (keyset
+    # pagination) as well as ordered by; lower bm25() means more relevant.
+    # The MATCH plus rowid lookup is an index seek in FTS5.
+    weights = ', '.join(str(weight) for weight in BM25_WEIGHTS)
+    matches = RawSQL(f'SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s', [expression])
+    rank = RawSQL(
+        f'SELECT bm25({FTS_TABLE}, {weights}) FROM {FTS_TABLE} '
+        f'WHERE {FTS_TABLE} MATCH %s AND rowid = shop_app_product.id',
+        [expression],
+        output_field=FloatField()
+    )
+    return queryset.filter(id__in=matches).annotate(search_rank=rank).order_by('search_rank', '-id')
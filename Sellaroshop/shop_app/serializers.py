@@ -0,0 +1,212 @@
+# serializers.py - projection-based JSON serialization for catalog endpoints
+import json
+from decimal import Decimal
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import HttpResponse, StreamingHttpResponse
+
+from .models import Product
+
+try:
+    import orjson
+except ImportError:  # optional: pip install orjson for faster encoding
+    orjson = None
+
+STREAM_BATCH_SIZE = 500
+
+DEFAULT_PRODUCT_IMAGE = '/static/img/default-product.jpg'
+PRODUCT_IMAGE = Product._meta.get_field('image')
+
+
+# ==============================
+# Encoding
+# ==============================
+def _orjson_default(obj):
+    if isinstance(obj, Decimal):
+        return str(obj)
+    return DjangoJSONEncoder().default(obj)
+
+
+def dumps(data):
+    """Encode ``data`` to JSON bytes, with orjson when it is installed"""
+    if orjson is not None:
+        # Dates go through DjangoJSONEncoder for identical output
+        return orjson.dumps(
+            data, default=_orjson_default, option=orjson.OPT_PASSTHROUGH_DATETIME
+        )
+    return json.dumps(data, cls=DjangoJSONEncoder).encode()
+
+
+class FastJsonResponse(HttpResponse):
+    """Drop-in JsonResponse replacement that encodes through dumps()"""
+
+    def __init__(self, data, safe=True, **kwargs):
+        if safe and not isinstance(data, dict):
+            raise TypeError(
+                'In order to allow non-dict objects to be serialized set the '
+                'safe parameter to False.'
+            )
+        kwargs.setdefault('content_type', 'application/json')
+        super().__init__(content=dumps(data), **kwargs)
+
+
+def _batches(rows, size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def stream_json(rows, key, envelope=None, batch_size=STREAM_BATCH_SIZE):
+    """Yield the JSON for ``{**envelope, key: [*rows]}`` piece by piece.
+
+    Rows are encoded ``batch_size`` at a time, so memory use depends on the
+    batch size rather than on the number of rows.
+    """
+    head = dumps({**(envelope or {}), key: []})
+    # head ends in '[]}'; emit up to and including the '['
+    yield head[:-2]
+    first = True
+    for batch in _batches(rows, batch_size):
+        chunk = b','.join(dumps(row) for row in batch)
+        yield chunk if first else b',' + chunk
+        first = False
+    yield b']}'
+
+
+def stream_ndjson(rows, batch_size=STREAM_BATCH_SIZE):
+    """Yield one JSON document per line"""
+    for batch in _batches(rows, batch_size):
+        yield b'\n'.join(dumps(row) for row in batch) + b'\n'
+
+
+def streaming_response(request, rows, key, envelope=None):
+    """Stream ``rows`` as NDJSON for ?stream=ndjson, otherwise as the
+    usual JSON envelope"""
+    if request.GET.get('stream') == 'ndjson':
+        return StreamingHttpResponse(stream_ndjson(rows), content_type='application/x-ndjson')
+    return StreamingHttpResponse(stream_json(rows, key, envelope), content_type='application/json')
+
+
+# ==============================
+# Projections
+# ==============================
+class Projection:
+    """A values() projection plus a function that turns each row into the
+    endpoint's JSON shape.
+
+    Only the listed columns are fetched, so no model instances are built
+    and large unused columns never leave the database. ``annotations`` are
+    computed in SQL (e.g. prices cast straight to floats) instead of per
+    row in Python.
+    """
+
+    def __init__(self, fields, build, **annotations):
+        self.fields = fields
+        self.annotations = annotations
+        self.build = build
+
+    def values(self, queryset):
+        return queryset.values(*self.fields, **self.annotations)
+
+    def rows(self, queryset):
+        build = self.build
+        return [build(row) for row in self.values(queryset)]
+
+    def iterate(self, queryset, chunk_size=2000):
+        """Yield rows without caching the whole result set"""
+        build = self.build
+        for row in self.values(queryset).iterator(chunk_size=chunk_size):
+            yield build(row)
+
+
+def image_url(field, name, default=''):
+    """``instance.<field>.url`` for a projected file name"""
+    return field.storage.url(name) if name else default
+
+
+def to_cents(amount):
+    # Prices have two decimal places, so this is exact
+    return round(amount * 100)
+
+
+def discount_percentage(price, final_price):
+    """Product.discount_percentage from projected float prices"""
+    price_cents, final_cents = to_cents(price), to_cents(final_price)
+    if final_cents >= price_cents or price_cents <= 0:
+        return 0
+    # Integer cents keep Decimal's rounding of the original property
+    return round(Decimal((price_cents - final_cents) * 100) / price_cents)
+
+
+def product_card(snapshot, held=None):
+    """Listing / search card for a product snapshot (see snapshots.py).
+    ``held`` is {product id: units on hold} from reservations; held stock
+    does not count as in stock."""
+    return {
+        'id': snapshot['id'],
+        'name': snapshot['name'],
+        'price': snapshot['final_price_cents'] / 100,
+        'original_price': snapshot['price_cents'] / 100,
+        'image': snapshot['image'],
+        'url': snapshot['url'],
+        'in_stock': snapshot['stock'] > (held or {}).get(snapshot['id'], 0),
+        'discount_percentage': snapshot['discount_percentage'],
+    }
+
+
+def api_product(snapshot, held=None):
+    return {
+        'id': snapshot['id'],
+        'name': snapshot['name'],
+        'price': snapshot['price_cents'] / 100,
+        'final_price': snapshot['final_price_cents'] / 100,
+        'description': snapshot['description'],
+        'image': snapshot['image'] or DEFAULT_PRODUCT_IMAGE,
+        'stock': snapshot['stock'],
+        'available_stock': max(0, snapshot['stock'] - (held or {}).get(snapshot['id'], 0)),
+        'is_featured': snapshot['is_featured'],
+        'is_new': snapshot['is_new'],
+        'rating': snapshot['rating'] or 0,
+        'review_count': snapshot['review_count'] or 0,
+        'discount_percentage': snapshot['discount_percentage'],
+    }
+
+
+def cart_item(item, snapshot):
+    """``item`` is a CartItem values() row with id, product_id, quantity"""
+    return {
+        'id': item['id'],
+        'product_id': snapshot['id'],
+        'name': snapshot['name'],
+        'price': snapshot['final_price_cents'] / 100,
+        'original_price': snapshot['price_cents'] / 100,
+        'quantity': item['quantity'],
+        'image': snapshot['image'] or DEFAULT_PRODUCT_IMAGE,
+        'total': snapshot['final_price_cents'] * item['quantity'] / 100,
+        'stock': snapshot['stock'],
+        'in_stock': snapshot['stock'] > 0,
+    }
+
+
+def cart_summary(cart):
+    """Items, item count and total for a Cart or SessionCart: at most one
+    query for the cart rows, product data from the snapshot cache"""
+    from . import snapshots
+
+    rows = cart.item_rows()
+    products = snapshots.get_many([row['product_id'] for row in rows])
+    items = [cart_item(row, products[row['product_id']]) for row in rows if row['product_id'] in products]
+    total_cents = sum(
+        products[row['product_id']]['final_price_cents'] * row['quantity']
+        for row in rows if row['product_id'] in products
+    )
+    return {
+        'items': items,
+        'count': sum(item['quantity'] for item in items),
+        'total': total_cents / 100,
+    }
@@ -0,0 +1,52 @@
+# signals.py - keep derived product data in sync with the catalog
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from .models import Product, Brand, Category, Deal
+from . import images, snapshots
+from .cache import bump_catalog_version
+from .typeahead import typeahead_index
+
+# The full-text search index is kept in sync by SQLite triggers, see search.TRIGGERS_SQL
+
+
+@receiver(post_save, sender=Product)
+def product_saved(sender, instance, **kwargs):
+    typeahead_index.update_product(instance)
+    bump_catalog_version()
+    # After commit, so a rolled back save never reaches the cache
+    transaction.on_commit(lambda: snapshots.refresh(instance))
+    if images.needs_derivatives(instance):
+        transaction.on_commit(lambda: images.schedule_product(instance.pk))
+
+
+@receiver(post_delete, sender=Product)
+def product_deleted(sender, instance, **kwargs):
+    typeahead_index.remove_product(instance.pk)
+    bump_catalog_version()
+    snapshots.invalidate(instance.pk)
+
+
+@receiver(post_save, sender=Brand)
+def brand_saved(sender, instance, created, **kwargs):
+    if not created:
+        typeahead_index.rename_brand(instance.pk, instance.name)
+    bump_catalog_version()
+
+
+@receiver(post_save, sender=Category)
+def category_saved(sender, instance, created, **kwargs):
+    bump_catalog_version()
+
+
+@receiver(post_delete, sender=Brand)
+@receiver(post_delete, sender=Category)
+def taxonomy_deleted(sender, instance, **kwargs):
+    bump_catalog_version()
+
+
+@receiver(post_save, sender=Deal)
+@receiver(post_delete, sender=Deal)
+def deal_changed(sender, instance, **kwargs):
+    bump_catalog_version()
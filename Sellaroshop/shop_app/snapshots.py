@@ -0,0 +1,137 @@
+# snapshots.py - read-through cache of per-product display data
+import time
+
+from django.core.cache import cache
+from django.db.models import F, FloatField
+from django.db.models.functions import Cast
+
+from .cache import is_shared
+from .models import Product
+from .serializers import PRODUCT_IMAGE, Projection, discount_percentage, image_url, to_cents
+
+# Bump when the snapshot shape changes so old entries are never read
+SNAPSHOT_SCHEMA = 1
+SNAPSHOT_TIMEOUT = 6 * 60 * 60
+GENERATION_KEY = 'product-snapshot:generation'
+
+
+def _from_row(row):
+    price_cents = to_cents(row['price_value'])
+    final_price_cents = to_cents(row['final_price_value'])
+    return {
+        'id': row['id'],
+        'name': row['name'],
+        'description': row['description'],
+        'url': f"/product/{row['id']}/",
+        'image': image_url(PRODUCT_IMAGE, row['image']),
+        'price_cents': price_cents,
+        'final_price_cents': final_price_cents,
+        'discount_percentage': discount_percentage(row['price_value'], row['final_price_value']),
+        'stock': row['stock'],
+        'available': row['available'],
+        'is_featured': row['is_featured'],
+        'is_new': row['is_new'],
+        'rating': row['rating_value'],
+        'review_count': row['review_count'],
+    }
+
+
+SNAPSHOT = Projection(
+    ['id', 'name', 'description', 'image', 'stock', 'available', 'is_featured', 'is_new', 'review_count'],
+    _from_row,
+    price_value=Cast(F('price'), FloatField()),
+    final_price_value=Cast(F('effective_price'), FloatField()),
+    rating_value=Cast(F('rating'), FloatField()),
+)
+
+
+def from_instance(product):
+    """Snapshot of an already loaded product, identical to what a fresh
+    read from the database would give"""
+    return _from_row({
+        'id': product.pk,
+        'name': product.name,
+        'description': product.description,
+        'image': product.image.name,
+        'stock': product.stock,
+        'available': product.available,
+        'is_featured': product.is_featured,
+        'is_new': product.is_new,
+        'review_count': product.review_count,
+        'price_value': float(product.price),
+        'final_price_value': float(product.final_price),
+        'rating_value': float(product.rating),
+    })
+
+
+def _generation():
+    generation = cache.get(GENERATION_KEY)
+    if generation is None:
+        generation = int(time.time() * 1000)
+        cache.add(GENERATION_KEY, generation, None)
+        generation = cache.get(GENERATION_KEY, generation)
+    return generation
+
+
+def _key(product_id, generation):
+    return f'product-snapshot:{SNAPSHOT_SCHEMA}:{generation}:{product_id}'
+
+
+def get_many(product_ids):
+    """Snapshots for ``product_ids`` as {id: snapshot}.
+
+    Hits come from one cache round trip; all misses are read with a single
+    ``id__in`` query and cached. Ids that no longer exist are left out.
+    Entries are refreshed when a product is saved (see signals) and
+    dropped wholesale after queryset update()/bulk_update(), which skip
+    the save signals. Without a shared cache another worker's price
+    change would never reach this one, so everything is read from the
+    database then.
+    """
+    product_ids = list(dict.fromkeys(product_ids))
+    if not product_ids:
+        return {}
+    if not is_shared():
+        return {snapshot['id']: snapshot for snapshot in SNAPSHOT.rows(Product.objects.filter(id__in=product_ids))}
+    generation = _generation()
+    keys = {_key(product_id, generation): product_id for product_id in product_ids}
+    found = {snapshot['id']: snapshot for snapshot in cache.get_many(list(keys)).values()}
+
+    missing = [product_id for product_id in product_ids if product_id not in found]
+    if missing:
+        for snapshot in SNAPSHOT.rows(Product.objects.filter(id__in=missing)):
+            found[snapshot['id']] = snapshot
+            # add(), not set(): never overwrite a fresher copy stored by a
+            # save that committed while this read was in flight
+            cache.add(_key(snapshot['id'], generation), snapshot, SNAPSHOT_TIMEOUT)
+    return found
+
+
+def get(product_id):
+    return get_many([product_id]).get(product_id)
+
+
+def refresh(product):
+    """Store the snapshot of a just-saved product"""
+    if product.get_deferred_fields():
+        # Not all fields are loaded; let the next read fetch the row
+        invalidate(product.pk)
+        return
+    cache.set(_key(product.pk, _generation()), from_instance(product), SNAPSHOT_TIMEOUT)
+
+
+def invalidate(product_id):
+    cache.delete(_key(product_id, _generation()))
+
+
+def invalidate_many(product_ids):
+    generation = _generation()
+    cache.delete_many([_key(product_id, generation) for product_id in product_ids])
+
+
+def invalidate_all():
+    """Drop every snapshot by moving to a new key generation"""
+    try:
+        cache.incr(GENERATION_KEY)
+    except ValueError:
+        cache.set(GENERATION_KEY, int(time.time() * 1000), None)
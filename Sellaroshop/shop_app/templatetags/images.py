@@ -0,0 +1,69 @@
+# images.py - srcset / <picture> tags for product image derivatives
+from django import template
+from django.templatetags.static import static
+from django.utils.html import format_html, format_html_join
+
+from shop_app import resize
+
+register = template.Library()
+
+
+def _variants(obj, fmt):
+    """{width: storage name} for ``obj``'s current image, or {} while the
+    derivatives are not generated yet"""
+    manifest = getattr(obj, 'image_variants', None) or {}
+    if not obj.image or manifest.get('source') != obj.image.name:
+        return {}
+    return {int(width): name for width, name in manifest['variants'].get(fmt, {}).items()}
+
+
+@register.simple_tag
+def image_srcset(obj, fmt='jpeg'):
+    """'url 160w, url 320w, ...' for an object with image / image_variants"""
+    storage = obj.image.storage if obj.image else None
+    return ', '.join(
+        f'{storage.url(name)} {width}w' for width, name in sorted(_variants(obj, fmt).items())
+    )
+
+
+@register.simple_tag
+def image_src(obj, width=None, fmt='jpeg'):
+    """URL of the smallest derivative at least ``width`` wide, falling back
+    to the original upload"""
+    if not obj.image:
+        return ''
+    variants = _variants(obj, fmt)
+    if not variants:
+        return obj.image.url
+    widths = sorted(variants)
+    chosen = next((w for w in widths if width is None or w >= width), widths[-1])
+    return obj.image.storage.url(variants[chosen])
+
+
+@register.simple_tag
+def responsive_image(obj, sizes='100vw', width=None, alt='', css_class='', style='', default='img/default-product.jpg'):
+    """<picture> with a WebP source and a JPEG <img> fallback.
+
+    ``width`` picks the plain src for browsers without srcset support;
+    ``default`` is a static path used when there is no image at all.
+    """
+    if not obj.image:
+        return format_html(
+            '<img src="{}" class="{}" alt="{}" style="{}" loading="lazy">',
+            static(default), css_class, alt, style,
+        )
+    sources = format_html_join(
+        '', '<source type="image/webp" srcset="{}" sizes="{}">',
+        [(srcset, sizes) for srcset in [image_srcset(obj, 'webp')] if srcset],
+    )
+    return format_html(
+        '<picture>{}<img src="{}" srcset="{}" sizes="{}" class="{}" alt="{}" style="{}" loading="lazy"></picture>',
+        sources, image_src(obj, width), image_srcset(obj), sizes, css_class, alt, style,
+    )
+
+
+@register.simple_tag
+def resized_url(obj, width, height, ext='webp'):
+    """Versioned URL of the on-demand rendition of a product, category or
+    brand image that fits width x height"""
+    return resize.resized_url(obj, width, height, ext)
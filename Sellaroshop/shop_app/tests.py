@@ -0,0 +1,1834 @@
+import io
+import json
+import os
+import re
+import shutil
+import tempfile
+from datetime import timedelta
+from decimal import Decimal
+from types import SimpleNamespace
+from unittest import mock
+
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.template import Context, Template
+from django.db import connection
+from django.db.models import F, Q, QuerySet
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.sessions.models import Session
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import include, path, resolve, reverse
+from django.utils import timezone
+
+from . import cache as catalog_cache, carts, facets as facets_module, images, loadtest, pagination, reservations, resize, search, serializers, snapshots, views
+from .budgets import QueryCounter
+from .profiling import RequestProfile, SlowRequestLog, slow_requests
+from .typeahead import typeahead_index
+from .models import (
+    Product, Category, Brand, Cart, CartItem,
+    Store, Deal, ProductReview, Wishlist, InsufficientStock, ProductQuerySet, StockHold
+)
+from products.models import (
+    Product as LegacyProduct, Category as LegacyCategory, Brand as LegacyBrand
+)
+from store.models import StoreLocation
+
+User = get_user_model()
+
+# Never run cache.clear() against the configured (possibly shared) cache.
+# The test run is a single process, so its LocMemCache counts as shared.
+TEST_CACHE = override_settings(
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'tests'}},
+    CACHE_IS_SHARED=True,
+)
+
+
+def setUpModule():
+    TEST_CACHE.enable()
+
+
+def tearDownModule():
+    TEST_CACHE.disable()
+
+
+class CatalogTestCase(TestCase):
+    """Category 'Electronics' and brand 'Acme' with ``product_count``
+    products named 'Widget {i}' (extra fields from product_fields()).
+    Every test starts with an empty cache."""
+
+    product_count = 0
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.category = Category.objects.create(name='Electronics')
+        cls.brand = Brand.objects.create(name='Acme')
+        cls.products = [
+            cls.make_product(name=f'Widget {i}', **cls.product_fields(i))
+            for i in range(cls.product_count)
+        ]
+
+    @classmethod
+    def product_fields(cls, i):
+        return {}
+
+    @classmethod
+    def make_product(cls, **fields):
+        return Product.objects.create(**{
+            'category': cls.category, 'brand': cls.brand,
+            'price': Decimal('10.00'), 'stock': 5, **fields,
+        })
+
+    def setUp(self):
+        cache.clear()
+
+
+# ==============================
+# Query plan regression tests
+# ==============================
+FULL_SCAN_RE = re.compile(r'\bSCAN shop_app_product\b(?! USING)')
+SORT_RE = re.compile(r'USE TEMP B-TREE FOR (?:RIGHT PART OF )?ORDER BY')
+
+
+class QueryPlanTests(CatalogTestCase):
+    """Run EXPLAIN QUERY PLAN on every product query a storefront view
+    issues and fail if one falls back to a full table scan or sorts the
+    listing outside an index. The cache starts empty so cached facets do
+    not hide the queries being checked."""
+
+    product_count = 20
+
+    @classmethod
+    def product_fields(cls, i):
+        return {
+            'description': 'A useful widget',
+            'price': Decimal('10.00') + i,
+            'discount_price': Decimal('5.00') if i % 3 == 0 else None,
+            'stock': i % 4,
+            'is_featured': i % 2 == 0,
+            'is_new': i % 5 == 0,
+        }
+
+    def explain(self, sql, params):
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+            return [row[-1] for row in cursor.fetchall()]
+
+    def assertIndexedPlans(self, url, check_sort=True):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(url)
+            # Querysets the template never iterated still belong to the view
+            for key in (response.context.keys() if response.context else []):
+                if isinstance(response.context[key], QuerySet):
+                    list(response.context[key])
+        self.assertEqual(response.status_code, 200)
+
+        checked = 0
+        for query in ctx.captured_queries:
+            sql = query['sql']
+            if not sql.startswith('SELECT') or 'shop_app_product' not in sql:
+                continue
+            # captured SQL has parameters inlined; re-run it as-is
+            plan = self.explain(sql, [])
+            checked += 1
+            for step in plan:
+                self.assertIsNone(
+                    FULL_SCAN_RE.search(step),
+                    f'{url} full table scan:\n{sql}\n{plan}'
+                )
+            if check_sort and ' ORDER BY ' in sql and ' GROUP BY ' not in sql:
+                self.assertFalse(
+                    any(SORT_RE.search(step) for step in plan),
+                    f'{url} sorts outside an index:\n{sql}\n{plan}'
+                )
+        self.assertTrue(checked, f'{url} issued no product queries')
+
+    def test_deals(self):
+        self.assertIndexedPlans(reverse('deals'))
+
+    def test_new_arrivals(self):
+        self.assertIndexedPlans(reverse('new_arrivals'))
+
+    def test_category_products(self):
+        url = reverse('category_products', args=[self.category.slug])
+        for sort in ['', 'newest', 'price_asc', 'price_desc', 'popular']:
+            with self.subTest(sort=sort):
+                self.assertIndexedPlans(f'{url}?sort={sort}&format=json')
+        self.assertIndexedPlans(f'{url}?min_price=12&max_price=20&sort=price_asc&format=json')
+
+    def test_brand_products(self):
+        url = reverse('brand_products', args=[self.brand.slug])
+        for sort in ['', 'newest', 'price_asc', 'price_desc', 'popular']:
+            with self.subTest(sort=sort):
+                self.assertIndexedPlans(f'{url}?sort={sort}&format=json')
+
+    def test_search(self):
+        url = reverse('search')
+        # Relevance order needs every match's bm25 score, so only scans fail
+        self.assertIndexedPlans(f'{url}?q=widget', check_sort=False)
+        self.assertIndexedPlans(f'{url}?category={self.category.id}')
+
+
+# ==============================
+# Query budget tests
+# ==============================
+@override_settings(ENFORCE_QUERY_BUDGETS=True)
+class ProductDetailQueryTests(CatalogTestCase):
+
+    product_count = 6
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.user = User.objects.create_user('shopper', password='secret-pass-123')
+
+    def add_reviews(self, product, count):
+        for i in range(count):
+            user = User.objects.create_user(f'reviewer{product.id}-{i}')
+            ProductReview.objects.create(
+                product=product, user=user, rating=4, is_approved=True
+            )
+
+    def count_queries(self, product):
+        url = reverse('product_detail', args=[product.id])
+        # Compare cold requests: the first one would fill shared caches
+        cache.clear()
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(ctx.captured_queries)
+
+    def test_cost_does_not_grow_with_reviews(self):
+        few, many = self.products[0], self.products[1]
+        self.add_reviews(few, 1)
+        self.add_reviews(many, 15)
+        self.assertEqual(self.count_queries(few), self.count_queries(many))
+
+    def test_within_budget_when_logged_in(self):
+        self.client.login(username='shopper', password='secret-pass-123')
+        Wishlist.objects.create(user=self.user, product=self.products[0])
+        # The view raises QueryBudgetExceeded if it goes over its budget
+        url = reverse('product_detail', args=[self.products[0].id])
+        response = self.client.get(url)
+        self.assertTrue(response.context['in_wishlist'])
+        self.assertLessEqual(
+            self.count_queries(self.products[0]), views.product_detail.query_budget
+        )
+
+
+# ==============================
+# Request profiling tests
+# ==============================
+class RequestProfilingTests(CatalogTestCase):
+
+    product_count = 1
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.staff = User.objects.create_user('staff', is_staff=True)
+
+    def setUp(self):
+        super().setUp()
+        slow_requests.clear()
+
+    def server_timing(self, response):
+        timings = {}
+        for metric in response['Server-Timing'].split(', '):
+            name, duration, desc = metric.split(';')
+            timings[name] = (float(duration[len('dur='):]), desc)
+        return timings
+
+    def test_header_only_for_staff(self):
+        response = self.client.get(reverse('categories'))
+        self.assertNotIn('Server-Timing', response)
+
+        self.client.force_login(self.staff)
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(reverse('categories'))
+        timings = self.server_timing(response)
+        self.assertEqual(timings['db'][1], f'desc="SQL ({len(ctx.captured_queries)} queries)"')
+        self.assertIn('tpl', timings)
+        self.assertIn('view', timings)
+        self.assertGreaterEqual(timings['total'][0], timings['view'][0])
+
+    @override_settings(SERVER_TIMING_PUBLIC=True)
+    def test_public_header(self):
+        response = self.client.get(reverse('search_api') + '?q=wid')
+        timings = self.server_timing(response)
+        self.assertNotIn('tpl', timings)
+        self.assertEqual(set(timings), {'db', 'view', 'total'})
+
+    @override_settings(PROFILING_SLOW_REQUEST_MS=0)
+    def test_slow_requests_are_sampled(self):
+        self.client.get(reverse('categories'))
+        self.client.force_login(self.staff)
+        response = self.client.get(reverse('slow_requests') + '?format=json')
+        entry = response.json()['entries'][0]
+        self.assertEqual((entry['method'], entry['path'], entry['status']), ('GET', '/categories/', 200))
+        self.assertEqual(entry['query_count'], len(entry['top_queries']))
+        self.assertIn('SELECT', entry['top_queries'][0]['sql'])
+
+        self.assertNotContains(self.client.get(reverse('slow_requests')), 'only requests served by this worker')
+        with self.settings(CACHE_IS_SHARED=False):
+            self.assertContains(self.client.get(reverse('slow_requests')), 'only requests served by this worker')
+
+    def test_log_is_a_ring_in_the_cache(self):
+        log = SlowRequestLog(2, prefix='test:slow')
+        for time in (1, 2, 3):
+            log.add({'time': time})
+        # Another worker's log object reads the same slots
+        self.assertEqual(SlowRequestLog(2, prefix='test:slow').entries(), [{'time': 3}, {'time': 2}])
+        log.clear()
+        self.assertEqual(log.entries(), [])
+
+    @override_settings(PROFILING_SAMPLE_RATE=0, PROFILING_SLOW_REQUEST_MS=0)
+    def test_sample_rate(self):
+        self.client.get(reverse('categories'))
+        self.assertEqual(slow_requests.entries(), [])
+
+    def test_report_is_staff_only(self):
+        response = self.client.get(reverse('slow_requests'))
+        self.assertEqual(response.status_code, 302)
+
+    def test_view_time_excludes_sql_before_the_view(self):
+        profile = RequestProfile()
+        # Session / auth middleware queries before the view ran
+        profile.queries.append(('SELECT session', 5.0))
+        profile.start_view()
+        profile.queries.append(('SELECT product', 0.25))
+        profile.add('tpl', 0.5)
+        end = profile.view_start + 1.0
+        self.assertAlmostEqual(profile.view_time(end), 0.25)
+        self.assertAlmostEqual(profile.db_time, 5.25)
+
+
+# ==============================
+# Catalog cache tests
+# ==============================
+class CatalogCacheTests(CatalogTestCase):
+
+    product_count = 1
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.product = cls.products[0]
+
+    def test_catalog_changes_invalidate_versioned_keys(self):
+        key = catalog_cache.versioned_key('facets', {'q': 'widget'})
+        self.assertEqual(catalog_cache.versioned_key('facets', {'q': 'widget'}), key)
+        self.assertNotEqual(catalog_cache.versioned_key('facets', {'q': 'lamp'}), key)
+
+        self.product.stock = 5
+        self.product.save()
+        self.assertNotEqual(catalog_cache.versioned_key('facets', {'q': 'widget'}), key)
+
+        key = catalog_cache.versioned_key('facets')
+        Deal.objects.create(
+            title='Sale', product=self.product, discount_percentage=10,
+            start_date=timezone.now(), end_date=timezone.now() + timedelta(days=1),
+        )
+        self.assertNotEqual(catalog_cache.versioned_key('facets'), key)
+
+    def test_get_or_rebuild_follows_the_catalog_version(self):
+        builds = []
+        build = lambda: builds.append(1) or len(builds)
+        self.assertEqual(catalog_cache.get_or_rebuild('sections', build), 1)
+        self.assertEqual(catalog_cache.get_or_rebuild('sections', build), 1)
+        Product.objects.filter(pk=self.product.pk).update(stock=3)
+        self.assertEqual(catalog_cache.get_or_rebuild('sections', build), 2)
+
+    def test_stale_copy_is_served_while_another_worker_rebuilds(self):
+        catalog_cache.get_or_rebuild('sections', lambda: 'old')
+        catalog_cache.bump_catalog_version()
+        cache.add('sections:rebuild', 1)
+        self.assertEqual(catalog_cache.get_or_rebuild('sections', lambda: 'new'), 'old')
+        cache.delete('sections:rebuild')
+        self.assertEqual(catalog_cache.get_or_rebuild('sections', lambda: 'new'), 'new')
+
+    def test_concurrent_misses_rebuild_once(self):
+        import threading
+        started, release = threading.Event(), threading.Event()
+        calls, results = [], []
+
+        def build():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return 'built'
+
+        def request():
+            results.append(catalog_cache.get_or_rebuild('sections', build))
+
+        leader = threading.Thread(target=request)
+        leader.start()
+        started.wait(5)
+        others = [threading.Thread(target=request) for _ in range(3)]
+        for thread in others:
+            thread.start()
+        release.set()
+        for thread in [leader, *others]:
+            thread.join(5)
+        self.assertEqual((len(calls), results), (1, ['built'] * 4))
+
+
+class TaxonomyCountTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.audio = Category.objects.create(name='Audio')
+        cls.video = Category.objects.create(name='Video')
+        cls.empty = Category.objects.create(name='Empty')
+        cls.acme = Brand.objects.create(name='Acme')
+        cls.zenith = Brand.objects.create(name='Zenith')
+        for i, (category, brand, available) in enumerate([
+            (cls.audio, cls.acme, True),
+            (cls.audio, cls.acme, True),
+            (cls.audio, cls.zenith, False),
+            (cls.video, cls.zenith, True),
+            (cls.video, cls.zenith, False),
+        ]):
+            Product.objects.create(
+                name=f'Player {i}', category=category, brand=brand,
+                price=Decimal('10.00'), available=available,
+            )
+
+    def setUp(self):
+        cache.clear()
+
+    def test_counts_exclude_unavailable_products(self):
+        with self.assertNumQueries(1):
+            categories = {c.name: c.product_count for c in Category.objects.with_product_counts()}
+        self.assertEqual(categories, {'Audio': 2, 'Video': 1, 'Empty': 0})
+        with self.assertNumQueries(1):
+            brands = {b.name: b.product_count for b in Brand.objects.with_product_counts()}
+        self.assertEqual(brands, {'Acme': 2, 'Zenith': 1})
+        # Without the annotation product_count still agrees
+        self.assertEqual(Category.objects.get(pk=self.audio.pk).product_count, 2)
+
+    def test_listing_pages_use_one_count_query(self):
+        for name, model, expected in [
+            ('categories', Category, {'Audio': 2, 'Video': 1, 'Empty': 0}),
+            ('brands', Brand, {'Acme': 2, 'Zenith': 1}),
+        ]:
+            with self.subTest(name), CaptureQueriesContext(connection) as ctx:
+                response = self.client.get(reverse(name))
+            self.assertEqual(response.status_code, 200)
+            counts = {item.name: item.product_count for item in response.context[name]}
+            self.assertEqual(counts, expected)
+            table = model._meta.db_table
+            self.assertEqual(
+                len([q for q in ctx.captured_queries if f'FROM "{table}"' in q['sql']]), 1
+            )
+            # Cached afterwards
+            with CaptureQueriesContext(connection) as ctx:
+                self.client.get(reverse(name))
+            self.assertFalse([q for q in ctx.captured_queries if f'FROM "{table}"' in q['sql']])
+
+
+# ==============================
+# Conditional response tests
+# ==============================
+class ConditionalResponseTests(CatalogTestCase):
+
+    product_count = 1
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.product = cls.products[0]
+
+    def assertNotModified(self, url, **headers):
+        with self.assertNumQueries(0):
+            response = self.client.get(url, headers=headers)
+        self.assertEqual(response.status_code, 304)
+        return response
+
+    def test_etag_round_trip(self):
+        url = reverse('search_api') + '?q=widg'
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+        self.assertNotModified(url, if_none_match=etag)
+
+        # Other parameters are a different resource
+        response = self.client.get(reverse('search_api') + '?q=acm', headers={'if-none-match': etag})
+        self.assertEqual(response.status_code, 200)
+
+        self.product.stock = 3
+        self.product.save()
+        response = self.client.get(url, headers={'if-none-match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    @override_settings(CACHE_IS_SHARED=None)
+    def test_process_local_cache_is_not_trusted(self):
+        self.assertFalse(catalog_cache.is_shared())
+        # Shared, but add() and incr() are not atomic across workers
+        with self.settings(CACHES={'default': {
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache', 'LOCATION': '/nonexistent',
+        }}):
+            self.assertFalse(catalog_cache.is_shared())
+        response = self.client.get(reverse('search_api') + '?q=widg')
+        self.assertNotIn('ETag', response)
+        self.assertNotIn('Last-Modified', response)
+
+        # A price change made by another worker (whose cache invalidation
+        # this process never sees) must show up here at once
+        snapshots.get_many([self.product.id])
+        QuerySet.update(
+            Product.objects.filter(pk=self.product.pk),
+            price=Decimal('7.00'), effective_price=Decimal('7.00'),
+        )
+        with self.assertNumQueries(1):
+            self.assertEqual(snapshots.get(self.product.id)['final_price_cents'], 700)
+        cart = carts.SessionCart({self.product.id: 2})
+        self.assertEqual(cart.totals(), (2, Decimal('14.00')))
+
+        with self.settings(CACHE_IS_SHARED=True):
+            self.assertIn('ETag', self.client.get(reverse('search_api') + '?q=widg'))
+
+    def test_last_modified(self):
+        url = reverse('search_api') + '?q=widg'
+        response = self.client.get(url)
+        self.assertNotModified(url, if_modified_since=response['Last-Modified'])
+
+    def test_deals_bump_version(self):
+        url = reverse('search_api') + '?q=widg'
+        etag = self.client.get(url)['ETag']
+        Deal.objects.create(
+            product=self.product, title='Sale', end_date=timezone.now() + timedelta(days=1)
+        )
+        self.assertNotEqual(self.client.get(url)['ETag'], etag)
+
+    def test_listings_only_for_json(self):
+        url = reverse('category_products', args=[self.category.slug])
+        self.assertNotIn('ETag', self.client.get(url))
+
+        response = self.client.get(url, {'format': 'json'})
+        self.assertNotModified(f'{url}?format=json', if_none_match=response['ETag'])
+
+
+# ==============================
+# Full-text search tests
+# ==============================
+class SearchIndexTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.category = Category.objects.create(name='Audio')
+        cls.brand = Brand.objects.create(name='Acme')
+        make = lambda name, description: Product.objects.create(
+            name=name, description=description, category=cls.category,
+            brand=cls.brand, price=Decimal('10.00'),
+        )
+        cls.in_name = make('Bluetooth speaker', 'Portable and loud')
+        cls.in_description = make('Party box', 'A speaker with bluetooth pairing')
+        cls.unrelated = make('Desk lamp', 'Warm light')
+
+    def search(self, query):
+        return list(search.filter_queryset(Product.objects.all(), query))
+
+    def test_bm25_ranks_name_matches_first(self):
+        results = self.search('bluetooth')
+        self.assertEqual(results, [self.in_name, self.in_description])
+        self.assertLess(results[0].search_rank, results[1].search_rank)
+
+    def test_prefix_matching(self):
+        self.assertEqual(self.search('blue spea'), [self.in_name, self.in_description])
+        self.assertEqual(self.search('lam'), [self.unrelated])
+        # FTS syntax typed by users is matched as text
+        self.assertEqual(self.search('"lamp* ('), [self.unrelated])
+        self.assertEqual(self.search('!!'), [])
+
+    def test_index_follows_catalog_changes(self):
+        self.unrelated.name = 'Reading light'
+        self.unrelated.save()
+        self.assertEqual(self.search('reading'), [self.unrelated])
+        self.assertEqual(self.search('desk'), [])
+
+        self.brand.name = 'Zenith'
+        self.brand.save()
+        self.assertEqual(len(self.search('zenith')), 3)
+
+        self.in_description.delete()
+        self.assertEqual(self.search('bluetooth'), [self.in_name])
+
+    def test_index_follows_queryset_writes(self):
+        zebra, = Product.objects.bulk_create([Product(
+            name='Zebra lamp', slug='zebra-lamp', description='Striped shade',
+            category=self.category, brand=self.brand, price=Decimal('10.00'),
+        )])
+        self.assertEqual(self.search('zebra'), [zebra])
+
+        Product.objects.filter(pk=zebra.pk).update(name='Walrus rug')
+        self.assertEqual(self.search('walrus'), [zebra])
+        self.assertEqual(self.search('zebra'), [])
+
+        Category.objects.filter(pk=self.category.pk).update(name='Outdoor')
+        self.assertEqual(len(self.search('outdoor')), 4)
+
+        Product.objects.filter(pk=zebra.pk).delete()
+        self.assertEqual(self.search('walrus'), [])
+
+    def test_rebuild_command(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {search.FTS_TABLE}')
+        self.assertEqual(self.search('bluetooth'), [])
+
+        out = io.StringIO()
+        call_command('rebuild_search_index', stdout=out)
+        self.assertIn('3 products indexed', out.getvalue())
+        self.assertEqual(self.search('bluetooth'), [self.in_name, self.in_description])
+
+
+class TypeaheadTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(name='Audio')
+        cls.brand = Brand.objects.create(name='Sonic')
+        make = lambda name, sold, reviews: Product.objects.create(
+            name=name, category=category, brand=cls.brand, price=Decimal('10.00'),
+            sold_count=sold, review_count=reviews,
+        )
+        cls.popular = make('Wireless headphones', 50, 1)
+        cls.reviewed = make('Wired headphones', 10, 40)
+        cls.quiet = make('Wired earbuds', 10, 2)
+
+    def setUp(self):
+        typeahead_index.invalidate()
+
+    def test_ranking_and_prefixes(self):
+        self.assertEqual(
+            typeahead_index.suggest('head'), [self.popular.id, self.reviewed.id]
+        )
+        # Units sold first, then reviews
+        self.assertEqual(
+            typeahead_index.suggest('wir'), [self.popular.id, self.reviewed.id, self.quiet.id]
+        )
+        # Every word must match a prefix, brand names included
+        self.assertEqual(typeahead_index.suggest('sonic wired ear'), [self.quiet.id])
+        self.assertEqual(typeahead_index.suggest('wired speaker'), [])
+        self.assertEqual(typeahead_index.suggest('head', limit=1), [self.popular.id])
+
+    def test_incremental_updates(self):
+        typeahead_index.suggest('warm')
+        quiet = Product.objects.get(pk=self.quiet.pk)
+        quiet.name = 'Wired speaker'
+        # Brand names come from the index: saving costs no extra query
+        with self.assertNumQueries(0):
+            typeahead_index.update_product(quiet)
+        self.assertEqual(typeahead_index.suggest('speak'), [self.quiet.id])
+        self.assertEqual(typeahead_index.suggest('earb'), [])
+
+        self.popular.available = False
+        self.popular.save()
+        self.assertEqual(typeahead_index.suggest('head'), [self.reviewed.id])
+
+        self.reviewed.delete()
+        self.assertEqual(typeahead_index.suggest('head'), [])
+
+        added = Product.objects.create(
+            name='Headphone stand', category_id=self.quiet.category_id, brand=self.brand,
+            price=Decimal('5.00'),
+        )
+        self.assertEqual(typeahead_index.suggest('head'), [added.id])
+
+        self.brand.name = 'Aurora'
+        self.brand.save()
+        self.assertEqual(typeahead_index.suggest('aurora head'), [added.id])
+
+    def test_stale_index_is_served_while_rebuilding(self):
+        typeahead_index.suggest('head')
+        typeahead_index.invalidate()
+        # Someone else holds the build: the current index answers
+        with typeahead_index._build_lock, self.assertNumQueries(0):
+            self.assertEqual(
+                typeahead_index.suggest('head'), [self.popular.id, self.reviewed.id]
+            )
+        with self.assertNumQueries(1):
+            typeahead_index.suggest('head')
+
+
+class ListingPaginationTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.category = Category.objects.create(name='Audio')
+        brand = Brand.objects.create(name='Acme')
+        cls.products = [
+            Product.objects.create(
+                name=f'Speaker {i}', category=cls.category, brand=brand,
+                price=Decimal('10.00') + i, sold_count=i,
+            )
+            for i in range(5)
+        ]
+
+    def setUp(self):
+        cache.clear()
+        # Two products per page
+        patcher = mock.patch.object(pagination.paginate, '__defaults__', (2,))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get_ids(self, url, **params):
+        response = self.client.get(url, {'format': 'json', **params})
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        return [product['id'] for product in data['products']], data.get('next_cursor')
+
+    def walk(self, url, **params):
+        ids, cursor = self.get_ids(url, **params)
+        while cursor:
+            page, cursor = self.get_ids(url, cursor=cursor, **params)
+            ids += page
+        return ids
+
+    def test_pages_cover_the_listing_once(self):
+        url = reverse('category_products', args=[self.category.slug])
+        for sort in ['newest', 'price_asc', 'price_desc', 'popular']:
+            with self.subTest(sort=sort):
+                ids = self.walk(url, sort=sort)
+                self.assertEqual(sorted(ids), sorted(p.id for p in self.products))
+        self.assertEqual(len(self.walk(reverse('search'), q='speaker')), 5)
+
+    def test_bad_cursors_restart_from_the_first_page(self):
+        bad = [
+            pagination.encode_cursor(values) for values in
+            [['2020-01-01T00:00:00', 'abc'], [{'a': 1}, 1], ['abc', 1], [None, 1], [1]]
+        ] + ['not base64!', 'e30']
+        listings = [
+            (reverse('category_products', args=[self.category.slug]), {}),
+            (reverse('category_products', args=[self.category.slug]), {'sort': 'price_asc'}),
+            (reverse('search'), {'q': 'speaker'}),
+        ]
+        for url, params in listings:
+            first = self.get_ids(url, **params)[0]
+            for cursor in bad:
+                with self.subTest(url=url, cursor=cursor):
+                    self.assertEqual(self.get_ids(url, cursor=cursor, **params)[0], first)
+                    response = self.client.get(url, {'cursor': cursor, **params})
+                    self.assertEqual(response.status_code, 200)
+
+    def test_search_without_full_text_index(self):
+        with mock.patch.object(search, 'is_enabled', return_value=False):
+            ids = self.walk(reverse('search'), q='speaker')
+        self.assertEqual(ids, [p.id for p in reversed(self.products)])
+
+
+class FacetTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.audio = Category.objects.create(name='Audio')
+        cls.video = Category.objects.create(name='Video')
+        cls.acme = Brand.objects.create(name='Acme')
+        cls.zenith = Brand.objects.create(name='Zenith')
+        for i, (category, brand, price, stock) in enumerate([
+            (cls.audio, cls.acme, '20.00', 3),
+            (cls.audio, cls.acme, '75.00', 0),
+            (cls.audio, cls.zenith, '150.00', 1),
+            (cls.video, cls.zenith, '40.00', 2),
+            (cls.video, cls.zenith, '900.00', 5),
+        ]):
+            Product.objects.create(
+                name=f'Player {i}', category=category, brand=brand,
+                price=Decimal(price), stock=stock,
+            )
+
+    def setUp(self):
+        cache.clear()
+
+    def counts(self, facets, dimension):
+        return {item['name']: item['count'] for item in facets[dimension]}
+
+    def test_bucket_counts(self):
+        facets = facets_module.compute_facets(Product.objects.all())
+        self.assertEqual(facets['total'], 5)
+        self.assertEqual(self.counts(facets, 'categories'), {'Audio': 3, 'Video': 2})
+        self.assertEqual(self.counts(facets, 'brands'), {'Zenith': 3, 'Acme': 2})
+        self.assertEqual(
+            [bucket['count'] for bucket in facets['price']], [2, 1, 1, 1]
+        )
+        self.assertEqual(facets['stock'], {'in_stock': 4, 'out_of_stock': 1})
+
+    def test_each_dimension_ignores_its_own_filter(self):
+        with self.assertNumQueries(1):
+            facets = facets_module.compute_facets(Product.objects.all(), {
+                'category': Q(category=self.audio),
+                'price': Q(effective_price__lt=100),
+            })
+        self.assertEqual(facets['total'], 2)
+        # Other categories keep the counts picking them would give
+        self.assertEqual(self.counts(facets, 'categories'), {'Audio': 2, 'Video': 1})
+        self.assertEqual([bucket['count'] for bucket in facets['price']], [1, 1, 1, 0])
+        self.assertEqual(self.counts(facets, 'brands'), {'Acme': 2})
+        self.assertEqual(facets['stock'], {'in_stock': 1, 'out_of_stock': 1})
+
+    def test_search_page_category_counts(self):
+        response = self.client.get(reverse('search'), {'q': 'player', 'category': self.audio.id})
+        counts = {c.name: c.facet_count for c in response.context['categories']}
+        self.assertEqual(counts, {'Audio': 3, 'Video': 2})
+        self.assertEqual(len(response.context['products']), 3)
+
+    def test_get_facets_is_cached_per_catalog_version(self):
+        queryset = Product.objects.filter(category=self.audio)
+        get = lambda: facets_module.get_facets(queryset, '', category=self.audio.id)
+        self.assertEqual(get()['total'], 3)
+        with self.assertNumQueries(0):
+            self.assertEqual(get()['total'], 3)
+        Product.objects.filter(price__gt=100).update(stock=0)
+        self.assertEqual(get()['stock'], {'in_stock': 1, 'out_of_stock': 2})
+
+
+# ==============================
+# Effective price tests
+# ==============================
+class EffectivePriceTests(CatalogTestCase):
+
+    def make(self, price, discount=None, name='Widget'):
+        # bulk_create skips save(), which fills in the slug
+        return Product(
+            name=name, slug=name.lower(), category=self.category, brand=self.brand,
+            price=Decimal(price), discount_price=discount and Decimal(discount),
+        )
+
+    def assertPricing(self, product_id, effective_price, is_on_sale):
+        stored = Product.objects.values('effective_price', 'is_on_sale').get(pk=product_id)
+        self.assertEqual(stored, {'effective_price': Decimal(effective_price), 'is_on_sale': is_on_sale})
+
+    def test_save(self):
+        product = self.make('20.00', '15.00')
+        product.save()
+        self.assertPricing(product.id, '15.00', True)
+        # A "discount" above the price is not a sale
+        product.discount_price = Decimal('25.00')
+        product.save(update_fields=['discount_price'])
+        self.assertPricing(product.id, '20.00', False)
+        product.discount_price = None
+        product.save()
+        self.assertPricing(product.id, '20.00', False)
+
+    def test_update(self):
+        product = self.make('20.00', '15.00')
+        product.save()
+        products = Product.objects.filter(pk=product.pk)
+
+        products.update(discount_price=None)
+        self.assertPricing(product.id, '20.00', False)
+        products.update(discount_price=Decimal('12.50'))
+        self.assertPricing(product.id, '12.50', True)
+        products.update(price=Decimal('10.00'))
+        self.assertPricing(product.id, '10.00', False)
+        products.update(price=F('price') * 2)
+        self.assertPricing(product.id, '12.50', True)
+        products.update(price=Decimal('30.00'), discount_price=None)
+        self.assertPricing(product.id, '30.00', False)
+
+    def test_bulk_update(self):
+        on_sale, full_price = self.make('20.00', '15.00'), self.make('8.00', name='Gadget')
+        Product.objects.bulk_create([on_sale, full_price])
+        on_sale.discount_price = None
+        full_price.discount_price = Decimal('6.00')
+        Product.objects.bulk_update([on_sale, full_price], ['discount_price'])
+        self.assertPricing(on_sale.id, '20.00', False)
+        self.assertPricing(full_price.id, '6.00', True)
+
+    def test_bulk_create(self):
+        created = Product.objects.bulk_create([
+            self.make('20.00', '15.00'), self.make('8.00', name='Gadget'),
+        ])
+        self.assertPricing(created[0].id, '15.00', True)
+        self.assertPricing(created[1].id, '8.00', False)
+
+    def test_malformed_price_bounds_are_ignored(self):
+        self.make('20.00').save()
+        category_url = reverse('category_products', args=[self.category.slug])
+        for bounds in ({'min_price': 'nan'}, {'max_price': 'Infinity'}, {'min_price': 'sNaN'},
+                       {'min_price': '-inf', 'max_price': 'abc'}):
+            for url in (reverse('search') + '?q=widget', category_url):
+                with self.subTest(url=url, **bounds):
+                    response = self.client.get(url, {**bounds, 'format': 'json'})
+                    self.assertEqual(response.status_code, 200)
+                    self.assertEqual(len(response.json()['products']), 1)
+
+
+# ==============================
+# Serializer tests
+# ==============================
+class SerializerTests(CatalogTestCase):
+    # Projections must produce exactly what the instance-based code did
+
+    PRICES = [
+        ('19.99', None), ('2.00', '1.99'), ('10.00', '9.95'),
+        ('149.99', '99.99'), ('0.10', '0.05'), ('30.00', '45.00'),
+    ]
+    product_count = len(PRICES)
+
+    @classmethod
+    def product_fields(cls, i):
+        price, discount = cls.PRICES[i]
+        return {
+            'price': Decimal(price), 'discount_price': discount and Decimal(discount),
+            'stock': i, 'rating': Decimal('4.50') if i % 2 else 0,
+            'image': f'products/widget{i}.jpg' if i % 2 else '',
+        }
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.user = User.objects.create_user('shopper')
+
+    def test_snapshots_match_instances(self):
+        rows = snapshots.SNAPSHOT.rows(Product.objects.order_by('id'))
+        self.assertEqual(rows, [snapshots.from_instance(p) for p in self.products])
+        for snapshot, p in zip(rows, self.products):
+            self.assertEqual(serializers.product_card(snapshot), {
+                'id': p.id,
+                'name': p.name,
+                'price': float(p.final_price),
+                'original_price': float(p.price),
+                'image': p.image.url if p.image else '',
+                'url': f'/product/{p.id}/',
+                'in_stock': p.is_in_stock,
+                'discount_percentage': p.discount_percentage,
+            })
+
+    def test_get_many_reads_only_misses(self):
+        first, second, third = self.products[:3]
+        with self.assertNumQueries(1):
+            self.assertEqual(set(snapshots.get_many([first.id, second.id])), {first.id, second.id})
+        with self.assertNumQueries(1):
+            found = snapshots.get_many([first.id, second.id, third.id, 0])
+        self.assertEqual(set(found), {first.id, second.id, third.id})
+        with self.assertNumQueries(0):
+            snapshots.get_many([third.id, first.id])
+
+    def test_snapshots_follow_product_changes(self):
+        product = self.products[0]
+        snapshots.get(product.id)
+
+        product.discount_price = Decimal('15.00')
+        with self.captureOnCommitCallbacks(execute=True):
+            product.save()
+        with self.assertNumQueries(0):
+            self.assertEqual(snapshots.get(product.id)['final_price_cents'], 1500)
+
+        Product.objects.filter(id=product.id).update(stock=42)
+        with self.assertNumQueries(1):
+            self.assertEqual(snapshots.get(product.id)['stock'], 42)
+
+        product.delete()
+        self.assertIsNone(snapshots.get(product.id))
+
+    def test_cart_summary_matches_model_totals(self):
+        cart = Cart.objects.create(user=self.user)
+        for quantity, product in enumerate(self.products, start=1):
+            CartItem.objects.create(cart=cart, product=product, quantity=quantity)
+        items = list(cart.items.select_related('product'))
+        expected_total = sum(item.item_total() for item in items)
+
+        with self.assertNumQueries(2):
+            summary = serializers.cart_summary(cart)
+        with self.assertNumQueries(1):
+            self.assertEqual(cart.total_cost(), expected_total)
+        self.assertEqual(summary['count'], cart.total_items())
+        self.assertEqual(summary['total'], float(expected_total))
+        self.assertEqual([row['id'] for row in summary['items']], [item.id for item in items])
+        for row, item in zip(summary['items'], items):
+            self.assertEqual(row['total'], float(item.item_total()))
+            self.assertEqual(row['price'], float(item.product.final_price))
+
+    def test_cart_mutations_do_not_grow_with_cart(self):
+        cart = Cart.objects.create(user=self.user)
+        self.assertEqual(cart.totals(), (0, Decimal('0.00')))
+        self.client.force_login(self.user)
+
+        def add(product):
+            cache.clear()
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.post(reverse('add_to_cart'), {'product_id': product.id})
+            self.assertTrue(response.json()['success'])
+            return len(queries)
+
+        small = add(self.products[1])
+        for product in self.products[2:5]:
+            CartItem.objects.create(cart=cart, product=product, quantity=product.stock)
+        self.assertEqual(add(self.products[5]), small)
+
+        items = list(cart.items.select_related('product'))
+        with self.assertNumQueries(1):
+            self.assertEqual(cart.totals(), (
+                sum(item.quantity for item in items), sum(item.item_total() for item in items)
+            ))
+
+    def test_api_products(self):
+        response = views.api_products(RequestFactory().get('/api/products/'))
+        rows = json.loads(response.content)
+        expected = Product.objects.filter(available=True)[:8]
+        self.assertEqual([row['id'] for row in rows], [p.id for p in expected])
+        for row, product in zip(rows, expected):
+            self.assertEqual(row['final_price'], float(product.final_price))
+            self.assertEqual(row['rating'], float(product.rating) if product.rating else 0)
+            self.assertEqual(row['discount_percentage'], product.discount_percentage)
+
+    def test_dumps_matches_json_response(self):
+        data = {'price': Decimal('9.90'), 'when': timezone.now(), 'name': 'Café'}
+        expected = json.loads(views.JsonResponse(data).content)
+        self.assertEqual(json.loads(serializers.dumps(data)), expected)
+        with mock.patch.object(serializers, 'orjson', None):
+            self.assertEqual(json.loads(serializers.dumps(data)), expected)
+
+    def test_stream_json_matches_full_document(self):
+        queryset = Product.objects.order_by('id')
+        for rows in (queryset, queryset.none(), queryset[:1]):
+            expected = {'success': True, 'products': snapshots.SNAPSHOT.rows(rows)}
+            chunks = list(serializers.stream_json(
+                snapshots.SNAPSHOT.iterate(rows, chunk_size=2), 'products',
+                {'success': True}, batch_size=4
+            ))
+            self.assertEqual(json.loads(b''.join(chunks)), expected)
+        self.assertEqual(len(chunks), 3)
+
+    def test_streaming_response_ndjson(self):
+        rows = snapshots.SNAPSHOT.rows(Product.objects.order_by('id'))
+        request = RequestFactory().get('/products/', {'stream': 'ndjson'})
+        response = serializers.streaming_response(request, iter(rows), 'products')
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        lines = b''.join(response.streaming_content).splitlines()
+        self.assertEqual([json.loads(line) for line in lines], rows)
+
+
+# ==============================
+# Anonymous cart tests
+# ==============================
+class SessionCartTests(CatalogTestCase):
+
+    product_count = 3
+
+    @classmethod
+    def product_fields(cls, i):
+        return {'discount_price': Decimal('7.50') if i else None}
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.user = User.objects.create_user('shopper', password='secret')
+
+    def add(self, product, quantity=1):
+        return self.client.post(reverse('add_to_cart'), {'product_id': product.id, 'quantity': quantity}).json()
+
+    def test_anonymous_cart_writes_no_rows(self):
+        self.assertEqual(self.add(self.products[0], 2)['cart_total'], 20.0)
+        data = self.add(self.products[1])
+        self.assertEqual((data['cart_count'], data['cart_total']), (3, 27.5))
+        self.assertIn(carts.COOKIE_NAME, self.client.cookies)
+        self.assertFalse(Cart.objects.exists())
+        self.assertFalse(Session.objects.exists())
+
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get(reverse('get_cart_count')).json()['count'], 3)
+        items = self.client.get(reverse('cart_data')).json()['items']
+        self.assertEqual([item['id'] for item in items], [self.products[0].id, self.products[1].id])
+
+        # Stock limits still apply
+        self.assertFalse(self.add(self.products[1], 5)['success'])
+        response = self.client.post(reverse('update_cart_quantity'), {'item_id': self.products[1].id, 'quantity': 4})
+        self.assertEqual(response.json()['total'], 50.0)
+        response = self.client.post(reverse('remove_from_cart'), {'item_id': self.products[0].id})
+        self.assertEqual(response.json()['cart_count'], 4)
+        self.assertContains(self.client.get(reverse('cart_page')), 'Widget 1')
+
+        self.client.post(reverse('clear_cart'))
+        self.assertEqual(self.client.cookies[carts.COOKIE_NAME].value, '')
+
+    def test_tampered_cookie_is_ignored(self):
+        self.add(self.products[0])
+        self.client.cookies[carts.COOKIE_NAME] = '{"%d":99}' % self.products[0].id
+        self.assertEqual(self.client.get(reverse('get_cart_count')).json()['count'], 0)
+
+    def test_login_moves_cart_into_database(self):
+        user_cart = Cart.objects.create(user=self.user)
+        CartItem.objects.create(cart=user_cart, product=self.products[0], quantity=1)
+        self.add(self.products[0], 2)
+        self.add(self.products[2])
+
+        self.client.post(reverse('login'), {'username': 'shopper', 'password': 'secret'})
+        self.assertEqual(
+            dict(user_cart.items.values_list('product_id', 'quantity')),
+            {self.products[0].id: 3, self.products[2].id: 1},
+        )
+        self.assertEqual(self.client.cookies[carts.COOKIE_NAME].value, '')
+        self.assertEqual(self.client.get(reverse('get_cart_count')).json()['count'], 4)
+
+    @override_settings(ANONYMOUS_CART_STORAGE='database')
+    def test_database_mode(self):
+        self.add(self.products[0])
+        self.assertTrue(Cart.objects.filter(user=None, session_key__isnull=False).exists())
+        self.assertNotIn(carts.COOKIE_NAME, self.client.cookies)
+
+    @override_settings(ANONYMOUS_CART_STORAGE='database')
+    def test_guest_cart_merged_on_login(self):
+        user_cart = Cart.objects.create(user=self.user)
+        CartItem.objects.create(cart=user_cart, product=self.products[0], quantity=4)
+        self.add(self.products[0], 3)
+        self.add(self.products[1], 2)
+
+        self.client.post(reverse('login'), {'username': 'shopper', 'password': 'secret'})
+        # 4 + 3 is clamped to the 5 in stock
+        self.assertEqual(
+            dict(user_cart.items.values_list('product_id', 'quantity')),
+            {self.products[0].id: 5, self.products[1].id: 2},
+        )
+        self.assertFalse(Cart.objects.filter(user=None).exists())
+
+    @override_settings(ANONYMOUS_CART_STORAGE='database')
+    def test_empty_guest_cart_removed_on_login(self):
+        self.add(self.products[0])
+        CartItem.objects.filter(cart__user=None).delete()
+        self.assertTrue(Cart.objects.filter(user=None).exists())
+
+        self.client.post(reverse('login'), {'username': 'shopper', 'password': 'secret'})
+        self.assertFalse(Cart.objects.filter(user=None).exists())
+
+    def batch(self, *operations):
+        return self.client.post(
+            reverse('update_cart_batch'), json.dumps({'operations': list(operations)}),
+            content_type='application/json',
+        )
+
+    def test_batch_updates(self):
+        first, second, third = (product.id for product in self.products)
+        for login in (False, True):
+            if login:
+                self.client.force_login(self.user)
+            self.add(self.products[0])
+            response = self.batch(
+                {'op': 'add', 'product_id': first, 'quantity': 2},
+                {'op': 'set', 'product_id': second, 'quantity': 4},
+                {'op': 'add', 'product_id': third},
+                {'op': 'remove', 'product_id': third},
+            )
+            data = response.json()
+            self.assertEqual(
+                {item['product_id']: item['quantity'] for item in data['items']}, {first: 3, second: 4}
+            )
+            self.assertEqual((data['count'], data['total']), (7, 60.0))
+
+            # One bad operation rejects the whole batch
+            response = self.batch(
+                {'op': 'remove', 'product_id': first},
+                {'op': 'add', 'product_id': second, 'quantity': 2},
+            )
+            self.assertEqual(response.status_code, 400)
+            self.assertIn('Only 5 of Widget 1', response.json()['error'])
+            self.assertEqual(self.client.get(reverse('get_cart_count')).json()['count'], 7)
+
+            self.batch({'op': 'set', 'product_id': first, 'quantity': 0}, {'op': 'remove', 'product_id': second})
+            self.assertEqual(self.client.get(reverse('get_cart_count')).json()['count'], 0)
+
+        self.assertEqual(self.batch({'op': 'buy', 'product_id': first}).status_code, 400)
+        self.assertEqual(self.batch().status_code, 400)
+
+    def test_batch_set_zero_drops_dead_lines(self):
+        first, second = self.products[0].id, self.products[1].id
+        self.add(self.products[0])
+        self.add(self.products[1])
+        Product.objects.filter(pk=first).update(available=False)
+        Product.objects.filter(pk=second).delete()
+
+        response = self.batch({'op': 'set', 'product_id': first, 'quantity': 2})
+        self.assertEqual(response.status_code, 400)
+        response = self.batch(
+            {'op': 'set', 'product_id': first, 'quantity': 0},
+            {'op': 'set', 'product_id': second, 'quantity': 0},
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.client.get(reverse('get_cart_count')).json()['count'], 0)
+
+    def test_cleanup_command(self):
+        old = timezone.now() - timedelta(days=40)
+        stale = [Cart.objects.create(session_key=f'stale{i}') for i in range(3)]
+        for cart in stale:
+            CartItem.objects.create(cart=cart, product=self.products[0])
+        recent_item = Cart.objects.create(session_key='recent-item')
+        CartItem.objects.create(cart=recent_item, product=self.products[1])
+        fresh = Cart.objects.create(session_key='fresh')
+        user_cart = Cart.objects.create(user=self.user)
+        Cart.objects.exclude(id=fresh.id).update(updated_at=old)
+        CartItem.objects.exclude(cart=recent_item).update(updated_at=old)
+        Session.objects.create(session_key='expired', session_data='', expire_date=timezone.now() - timedelta(days=1))
+        Session.objects.create(session_key='idle', session_data='', expire_date=old + timedelta(days=14))
+        Session.objects.create(session_key='active', session_data='', expire_date=timezone.now() + timedelta(days=14))
+
+        out = io.StringIO()
+        call_command('cleanup_carts', dry_run=True, stdout=out)
+        self.assertIn('3 guest carts would be deleted', out.getvalue())
+        self.assertEqual(Cart.objects.count(), 6)
+
+        out = io.StringIO()
+        with mock.patch.object(carts.time, 'sleep') as sleep:
+            call_command('cleanup_carts', batch_size=2, stdout=out)
+        self.assertEqual(sleep.call_count, 2)  # one per full batch
+        self.assertIn('Deleted 6 rows for stale guest carts (3 shop_app.Cart, 3 shop_app.CartItem)', out.getvalue())
+        self.assertIn('Deleted 2 rows for stale sessions', out.getvalue())
+        self.assertCountEqual(Cart.objects.values_list('id', flat=True), [recent_item.id, fresh.id, user_cart.id])
+        self.assertEqual(list(Session.objects.values_list('session_key', flat=True)), ['active'])
+
+    def test_merge_cost_does_not_grow_with_cart(self):
+        def merge(username, products):
+            user = User.objects.create_user(username)
+            CartItem.objects.create(cart=Cart.objects.create(user=user), product=self.products[0], quantity=1)
+            with CaptureQueriesContext(connection) as queries:
+                cart = carts.merge_into_user_cart(user, {product.id: 2 for product in products})
+            self.assertEqual(cart.total_items(), 1 + 2 * len(products))
+            return len(queries)
+
+        self.assertEqual(merge('one', self.products[:1]), merge('many', self.products))
+
+
+# ==============================
+# Checkout stock tests
+# ==============================
+class CheckoutStockTests(CatalogTestCase):
+
+    product_count = 3
+
+    @classmethod
+    def product_fields(cls, i):
+        return {'stock': 3}
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.user = User.objects.create_user('buyer')
+
+    def stock(self):
+        return list(Product.objects.order_by('id').values_list('stock', 'sold_count'))
+
+    def test_decrement_is_one_update_for_all_lines(self):
+        def decrement(quantities):
+            with CaptureQueriesContext(connection) as queries:
+                Product.objects.decrement_stock(quantities)
+            return len(queries)
+
+        one = decrement({self.products[0].id: 1})
+        self.assertEqual(decrement({product.id: 1 for product in self.products}), one)
+        self.assertEqual(self.stock(), [(1, 2), (2, 1), (2, 1)])
+
+    def test_short_line_changes_nothing(self):
+        with self.assertRaises(InsufficientStock) as raised:
+            Product.objects.decrement_stock({self.products[0].id: 1, self.products[1].id: 4})
+        self.assertEqual(raised.exception.shortages, {self.products[1].id: 3})
+        self.assertEqual(self.stock(), [(3, 0)] * 3)
+
+    def test_update_guard_catches_concurrent_sale(self):
+        # Another checkout takes the stock after the locked read (SQLite
+        # has no row locks); the conditional UPDATE must not oversell
+        product = self.products[0]
+        sold_elsewhere = []
+
+        def sell_first(execute, sql, params, many, context):
+            if sql.startswith('UPDATE') and not sold_elsewhere:
+                sold_elsewhere.append(True)
+                Product.objects.filter(id=product.id).update(stock=0)
+            return execute(sql, params, many, context)
+
+        with connection.execute_wrapper(sell_first), self.assertRaises(InsufficientStock) as raised:
+            Product.objects.decrement_stock({product.id: 2})
+        self.assertEqual(raised.exception.shortages, {product.id: 0})
+        self.assertEqual(Product.objects.get(id=product.id).sold_count, 0)
+
+    def test_holds_reserve_stock_until_they_expire(self):
+        cache.clear()
+        product = self.products[0]
+        first = Cart.objects.create(user=self.user)
+        second = Cart.objects.create(user=User.objects.create_user('other'))
+        token = reservations.holds_token()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(reservations.hold_cart(first, {product.id: 2}), {})
+            self.assertEqual(reservations.hold_cart(second, {product.id: 2}), {product.id: 1})
+            # Holding again replaces (extends) the cart's own holds
+            self.assertEqual(reservations.hold_cart(first, {product.id: 3}), {})
+        self.assertEqual(StockHold.objects.count(), 1)
+
+        with self.assertNumQueries(1):
+            self.assertEqual(reservations.held_quantities(), {product.id: 3})
+        with self.assertNumQueries(0):
+            self.assertEqual(reservations.available_stock(product.id, 3), 0)
+        self.assertNotEqual(reservations.holds_token(), token)
+        card = serializers.product_card(snapshots.get(product.id), reservations.held_quantities())
+        self.assertFalse(card['in_stock'])
+
+        StockHold.objects.update(expires_at=timezone.now() - timedelta(seconds=1))
+        cache.clear()
+        self.assertEqual(reservations.held_quantities(), {})
+        self.assertEqual(reservations.hold_cart(second, {product.id: 2}), {})
+
+        out = io.StringIO()
+        call_command('cleanup_carts', pause=0, stdout=out)
+        self.assertIn('Deleted 1 rows for stale stock holds', out.getvalue())
+        self.assertEqual(list(StockHold.objects.values_list('cart', flat=True)), [second.id])
+
+    def test_held_stock_cannot_be_added_to_other_carts(self):
+        cache.clear()
+        product = self.products[0]
+        checkout_cart = Cart.objects.create(user=self.user)
+        with self.captureOnCommitCallbacks(execute=True):
+            reservations.hold_cart(checkout_cart, {product.id: 2})
+
+        # A visitor sees and gets only the unheld unit
+        response = self.client.get(reverse('product_detail', args=[product.id]))
+        self.assertEqual((response.context['in_stock'], response.context['available_stock']), (True, 1))
+        add = lambda quantity: self.client.post(
+            reverse('add_to_cart'), {'product_id': product.id, 'quantity': quantity}
+        ).json()
+        self.assertEqual(add(2)['error'], 'Only 1 items available in stock')
+        self.assertTrue(add(1)['success'])
+        self.assertFalse(add(1)['success'])
+        response = self.client.post(
+            reverse('update_cart_batch'),
+            json.dumps({'operations': [{'op': 'set', 'product_id': product.id, 'quantity': 2}]}),
+            content_type='application/json',
+        )
+        self.assertIn('Only 1 of Widget 0', response.json()['error'])
+
+        # The checking-out customer's own hold does not count against them
+        self.client.force_login(self.user)
+        CartItem.objects.create(cart=checkout_cart, product=product, quantity=2)
+        item = checkout_cart.items.get()
+        response = self.client.post(reverse('update_cart_quantity'), {'item_id': item.id, 'quantity': 4})
+        self.assertEqual(response.json()['error'], 'Only 3 items available in stock')
+        response = self.client.post(reverse('update_cart_quantity'), {'item_id': item.id, 'quantity': 3})
+        self.assertTrue(response.json()['success'])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            reservations.hold_cart(checkout_cart, {product.id: 3})
+        response = self.client.get(reverse('product_detail', args=[product.id]))
+        self.assertFalse(response.context['in_stock'])
+
+    def test_held_out_products_in_listings(self):
+        cache.clear()
+        product = self.products[0]
+        url = reverse('category_products', args=[product.category.slug])
+        last_modified = self.client.get(url, {'format': 'json'})['Last-Modified']
+
+        with self.captureOnCommitCallbacks(execute=True):
+            reservations.hold_cart(Cart.objects.create(user=self.user), {product.id: 3})
+
+        # A client revalidating by date alone sees the change
+        later = timezone.now().timestamp() + 5
+        with mock.patch('shop_app.cache.time.time', return_value=later):
+            response = self.client.get(
+                url, {'format': 'json'}, headers={'if-modified-since': last_modified}
+            )
+        self.assertEqual(response.status_code, 200)
+        in_stock = {card['id']: card['in_stock'] for card in response.json()['products']}
+        self.assertEqual(in_stock, {p.id: p != product for p in self.products})
+
+        # HTML cards agree with the JSON on what is sold out
+        response = self.client.get(url)
+        available = {p.id: p.available_stock for p in response.context['products']}
+        self.assertEqual(available, {p.id: 0 if p == product else 3 for p in self.products})
+
+    def test_checkout_is_all_or_nothing(self):
+        # checkout.html is not in the repo; use the harness stand-ins
+        templates = self.settings(TEMPLATES=HARNESS_TEMPLATES)
+        templates.enable()
+        self.addCleanup(templates.disable)
+        cart = Cart.objects.create(user=self.user)
+        for product in self.products:
+            CartItem.objects.create(cart=cart, product=product, quantity=2)
+        self.client.force_login(self.user)
+
+        # Sold out between the page's stock check and the update
+        short = InsufficientStock({self.products[2].id: 1})
+        with mock.patch.object(ProductQuerySet, 'decrement_stock', side_effect=short):
+            response = self.client.post(reverse('checkout'))
+        self.assertEqual(response.context['out_of_stock_items'], ['Widget 2'])
+        self.assertEqual(cart.items.count(), 3)
+
+        # A failure after the stock update rolls the stock back too
+        with mock.patch.object(Cart, 'clear', side_effect=RuntimeError('boom')):
+            with self.assertRaises(RuntimeError):
+                self.client.post(reverse('checkout'))
+        self.assertEqual(self.stock(), [(3, 0)] * 3)
+
+        # Opening checkout holds the cart's stock for it
+        self.client.get(reverse('checkout'))
+        self.assertEqual(StockHold.objects.filter(cart=cart).count(), 3)
+
+        response = self.client.post(reverse('checkout'))
+        self.assertEqual(response.context['items_count'], 3)
+        self.assertEqual(self.stock(), [(1, 2)] * 3)
+        self.assertFalse(cart.items.exists())
+        self.assertFalse(StockHold.objects.exists())
+
+
+# ==============================
+# Image derivative tests
+# ==============================
+@override_settings(IMAGE_DERIVATIVES_ASYNC=False)
+class ImageDerivativeTests(CatalogTestCase):
+
+    def setUp(self):
+        super().setUp()
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        settings_override = override_settings(MEDIA_ROOT=media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def upload(self, size=(800, 600), mode='RGBA'):
+        from PIL import Image
+        buffer = io.BytesIO()
+        Image.new(mode, size, (200, 30, 30, 128)[:len(mode)]).save(buffer, 'PNG')
+        return SimpleUploadedFile('widget.png', buffer.getvalue(), content_type='image/png')
+
+    def create_product(self, **kwargs):
+        with self.captureOnCommitCallbacks(execute=True):
+            product = self.make_product(name=f'Widget {Product.objects.count()}', **kwargs)
+        product.refresh_from_db()
+        return product
+
+    def test_derivatives_generated_on_upload(self):
+        from PIL import Image
+        product = self.create_product(image=self.upload())
+        manifest = product.image_variants
+        self.assertEqual(manifest['source'], product.image.name)
+        # 1024 is wider than the original and skipped
+        self.assertEqual(sorted(manifest['variants']['webp'], key=int), ['160', '320', '640'])
+
+        storage = product.image.storage
+        with storage.open(manifest['variants']['webp']['160']) as f, Image.open(f) as image:
+            self.assertEqual((image.format, image.size), ('WEBP', (160, 120)))
+        with storage.open(manifest['variants']['jpeg']['640']) as f, Image.open(f) as image:
+            self.assertEqual((image.format, image.mode), ('JPEG', 'RGB'))
+
+        # Same content, same files
+        other = self.create_product(image=self.upload())
+        self.assertNotEqual(other.image.name, product.image.name)
+        self.assertEqual(other.image_variants['variants'], manifest['variants'])
+
+    def test_small_images_keep_their_width(self):
+        product = self.create_product(image=self.upload(size=(100, 80), mode='RGB'))
+        self.assertEqual(list(product.image_variants['variants']['jpeg']), ['100'])
+
+    def test_template_tags(self):
+        product = self.create_product(image=self.upload())
+        html = Template(
+            '{% load images %}{% responsive_image product sizes="50vw" width=300 alt="Widget" %}'
+        ).render(Context({'product': product}))
+        variants = product.image_variants['variants']
+        self.assertIn('<source type="image/webp" srcset="/media/%s 160w, ' % variants['webp']['160'], html)
+        self.assertIn('src="/media/%s"' % variants['jpeg']['320'], html)
+
+        # A replaced image falls back to the original until it is processed
+        product.image.name = 'products/other.png'
+        self.assertEqual(Template('{% load images %}{% image_src product 300 %}').render(
+            Context({'product': product})), '/media/products/other.png')
+
+        no_image = self.create_product()
+        self.assertIn('img/default-product.jpg', Template(
+            '{% load images %}{% responsive_image product %}'
+        ).render(Context({'product': no_image})))
+
+    def test_backfill_command(self):
+        product = self.create_product(image=self.upload())
+        Product.objects.filter(id=product.id).update(image_variants={})
+        version = catalog_cache.get_catalog_version()
+        snapshots.get_many([product.id])
+        out = io.StringIO()
+        call_command('generate_image_derivatives', workers=1, stdout=out)
+        self.assertIn('Derivatives generated for 1 products, 0 failed', out.getvalue())
+        product.refresh_from_db()
+        self.assertFalse(images.needs_derivatives(product))
+        # No price or listing data changed: catalog caches stay warm
+        self.assertEqual(catalog_cache.get_catalog_version(), version)
+        with self.assertNumQueries(0):
+            snapshots.get_many([product.id])
+
+        call_command('generate_image_derivatives', workers=1, force=True, stdout=out)
+        self.assertEqual(catalog_cache.get_catalog_version(), version)
+        with self.assertNumQueries(0):
+            snapshots.get_many([product.id])
+
+
+class ResizedImageTests(CatalogTestCase):
+
+    def setUp(self):
+        super().setUp()
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        settings_override = override_settings(
+            MEDIA_ROOT=media_root, IMAGE_DERIVATIVES_ASYNC=False,
+            IMAGE_RESIZE_CACHE_DIR=os.path.join(media_root, 'resized'),
+        )
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def upload(self, size=(800, 400)):
+        from PIL import Image
+        buffer = io.BytesIO()
+        Image.new('RGB', size, (200, 30, 30)).save(buffer, 'PNG')
+        return SimpleUploadedFile('photo.png', buffer.getvalue(), content_type='image/png')
+
+    def test_renders_once_then_serves_from_disk(self):
+        from PIL import Image
+        self.brand.logo = self.upload()
+        self.brand.save()
+        url = resize.resized_url(self.brand, 400, 300)
+
+        with mock.patch.object(resize, 'render', wraps=resize.render) as render:
+            first = self.client.get(url)
+            second = self.client.get(url)
+        self.assertEqual(render.call_count, 1)
+        body = b''.join(first.streaming_content)
+        self.assertEqual(body, b''.join(second.streaming_content))
+        with Image.open(io.BytesIO(body)) as image:
+            # 800x400 fits a 400x300 box at 400x200
+            self.assertEqual((image.format, image.size), ('WEBP', (400, 200)))
+        self.assertEqual(first['Content-Type'], 'image/webp')
+        self.assertIn('immutable', first['Cache-Control'])
+
+        unversioned = self.client.get(url.split('?')[0])
+        self.assertNotIn('immutable', unversioned['Cache-Control'])
+        not_modified = self.client.get(url, HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(not_modified.status_code, 304)
+
+    def test_only_whitelisted_sizes(self):
+        self.category.image = self.upload()
+        self.category.save()
+        ok = reverse('resized_image', args=['category', self.category.pk, 200, 200, 'jpg'])
+        self.assertEqual(self.client.get(ok).status_code, 200)
+        for args in (['category', self.category.pk, 201, 200, 'jpg'],
+                     ['category', self.category.pk, 200, 200, 'gif'],
+                     ['store', self.category.pk, 200, 200, 'jpg'],
+                     ['brand', self.brand.pk, 200, 200, 'jpg']):
+            self.assertEqual(self.client.get(reverse('resized_image', args=args)).status_code, 404, args)
+
+    def test_lru_eviction(self):
+        disk = resize.DiskCache(settings.IMAGE_RESIZE_CACHE_DIR, max_bytes=1000)
+        for i, key in enumerate(['aa1', 'bb2', 'cc3']):
+            disk.put(key, 'jpg', b'x' * 100)
+            os.utime(disk.path(key, 'jpg'), (1000 + i, 1000 + i))
+        disk.max_bytes = 250
+        disk.open('aa1', 'jpg').close()  # now the most recently used
+        self.assertEqual(disk.evict(), 200)
+        self.assertIsNone(disk.open('bb2', 'jpg'))
+        self.assertIsNotNone(disk.open('aa1', 'jpg'))
+
+        # Writes past the limit evict on their own
+        disk.put('dd4', 'jpg', b'x' * 100)
+        self.assertLessEqual(disk.usage(), 250)
+
+    def test_concurrent_misses_render_once(self):
+        import threading
+        started, release = threading.Event(), threading.Event()
+        calls, results = [], []
+
+        def work():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return 'rendered'
+
+        def follower():
+            results.append(resize.single_flight('key', work))
+
+        leader = threading.Thread(target=follower)
+        leader.start()
+        started.wait(5)
+        others = [threading.Thread(target=follower) for _ in range(3)]
+        for thread in others:
+            thread.start()
+        release.set()
+        for thread in [leader, *others]:
+            thread.join(5)
+        self.assertEqual((len(calls), results), (1, ['rendered'] * 4))
+
+
+# ==============================
+# Load test suite
+# ==============================
+class LoadTestTests(TransactionTestCase):
+    # Worker threads use their own connections, so the seeded rows must
+    # be committed
+
+    def test_seed_and_run(self):
+        fixture = loadtest.seed(products=40, users=2, cart_items=2, stores=3)
+        self.assertEqual(len(fixture.product_ids), 40)
+        self.assertEqual(CartItem.objects.filter(cart__user__in=fixture.users).count(), 4)
+
+        scenarios = ['home', 'search_api', 'cart_data', 'store_nearby_api']
+        results = loadtest.LoadTest(
+            fixture, scenarios=scenarios, concurrency=2, requests=6, warmup=0
+        ).run()
+        self.assertEqual(list(results), scenarios)
+        for name, stats in results.items():
+            self.assertEqual((stats['requests'], stats['errors']), (6, 0), name)
+            self.assertLessEqual(stats['p50_ms'], stats['p99_ms'])
+
+        loadtest.clear_data()
+        self.assertFalse(Product.objects.exists())
+
+    def test_command_only_seeds_when_asked(self):
+        from django.core.management.base import CommandError
+
+        with self.assertRaisesMessage(CommandError, '--seed-data'):
+            call_command('loadtest', stdout=io.StringIO())
+        # Tests run with DEBUG off, like production
+        for flag in ['--seed-data', '--clear']:
+            with self.subTest(flag), self.assertRaisesMessage(CommandError, 'DEBUG off'):
+                call_command('loadtest', flag, stdout=io.StringIO())
+        self.assertFalse(Product.objects.exists())
+
+    def test_compare_to_baseline(self):
+        stats = {'rps': 100.0, 'p95_ms': 10.0, 'errors': 0}
+        baseline = {'results': {'home': stats, 'cart_data': stats, 'checkout': stats}}
+        comparison = loadtest.compare({
+            'home': {'rps': 95.0, 'p95_ms': 11.0, 'errors': 0},
+            'cart_data': {'rps': 70.0, 'p95_ms': 10.0, 'errors': 0},
+            'checkout': {'rps': 100.0, 'p95_ms': 10.0, 'errors': 3},
+            'search_api': {'rps': 1.0, 'p95_ms': 99.0, 'errors': 0},
+        }, baseline, tolerance=0.2)
+        self.assertEqual(comparison['home'], {'p95_change': 0.1, 'rps_change': -0.05, 'regressed': False})
+        self.assertTrue(comparison['cart_data']['regressed'])
+        self.assertTrue(comparison['checkout']['regressed'])
+        self.assertNotIn('search_api', comparison)
+
+
+# ==============================
+# Per-view query budget harness
+# ==============================
+try:
+    import products.urls as products_urls
+except ImportError:  # visual search needs cv2 / numpy / scikit-learn
+    products_urls = None
+
+urlpatterns = [
+    path('', include('shop_app.urls')),
+    path('store/', include(('store.urls', 'store'))),
+]
+if products_urls is not None:
+    urlpatterns.append(path('products/', include(('products.urls', 'products'))))
+
+# Templates referenced by views but not shipped in templates/; stand-ins
+# touch the same context data a real page would
+STAND_IN_TEMPLATES = {
+    'checkout.html': '{% for item in cart_items %}{{ item.product.name }} {{ item.quantity }}{% endfor %}{{ total_cost }}',
+    'checkout_success.html': '{{ order_total }} {{ items_count }}',
+    'wishlist.html': '{% for item in wishlist_items %}{{ item.product.name }} {{ item.product.final_price }}{% endfor %}',
+    'brand_products.html': '{{ brand.name }}{% for product in products %}{{ product.name }}{% endfor %}',
+}
+
+HARNESS_TEMPLATES = [{
+    'BACKEND': settings.TEMPLATES[0]['BACKEND'],
+    'DIRS': settings.TEMPLATES[0]['DIRS'],
+    'OPTIONS': {
+        'context_processors': settings.TEMPLATES[0]['OPTIONS']['context_processors'],
+        'loaders': [
+            'django.template.loaders.filesystem.Loader',
+            'django.template.loaders.app_directories.Loader',
+            ('django.template.loaders.locmem.Loader', STAND_IN_TEMPLATES),
+        ],
+    },
+}]
+
+HARNESS_PASSWORD = 'budget-harness-91'
+
+# (label, method, url, data); url and data take the fixture namespace
+VIEW_CASES = [
+    ('home', 'get', lambda f: reverse('home'), None),
+    ('login', 'get', lambda f: reverse('login'), None),
+    ('signup', 'get', lambda f: reverse('signup'), None),
+    # guest_ cases log out and put a line in the guest cart first, so the
+    # cart merge after login / signup is measured too
+    ('login_post', 'guest_post', lambda f: reverse('login'),
+     lambda f: {'username': 'budget', 'password': HARNESS_PASSWORD}),
+    ('login_post_invalid', 'guest_post', lambda f: reverse('login'),
+     lambda f: {'username': 'budget', 'password': 'wrong'}),
+    ('signup_post', 'guest_post', lambda f: reverse('signup'), lambda f: {
+        'username': 'newcomer', 'password1': HARNESS_PASSWORD, 'password2': HARNESS_PASSWORD,
+    }),
+    ('signup_post_invalid', 'guest_post', lambda f: reverse('signup'), lambda f: {
+        'username': 'budget', 'password1': HARNESS_PASSWORD, 'password2': HARNESS_PASSWORD,
+    }),
+    ('search', 'get', lambda f: reverse('search') + '?q=widget', None),
+    ('search_filtered', 'get', lambda f: reverse('search') + f'?category={f.category.id}&min_price=5', None),
+    ('search_api', 'get', lambda f: reverse('search_api') + '?q=widg', None),
+    ('cart_page', 'get', lambda f: reverse('cart_page'), None),
+    ('cart_data', 'get', lambda f: reverse('cart_data'), None),
+    ('get_cart_count', 'get', lambda f: reverse('get_cart_count'), None),
+    ('add_to_cart', 'post', lambda f: reverse('add_to_cart'), lambda f: {'product_id': f.product.id}),
+    ('update_cart_quantity', 'post', lambda f: reverse('update_cart_quantity'),
+     lambda f: {'item_id': f.cart.items.first().id, 'quantity': 2}),
+    ('remove_from_cart', 'post', lambda f: reverse('remove_from_cart'),
+     lambda f: {'item_id': f.cart.items.last().id}),
+    ('update_cart_batch', 'post_json', lambda f: reverse('update_cart_batch'), lambda f: {'operations': [
+        {'op': 'set', 'product_id': f.product.id, 'quantity': 2},
+        {'op': 'remove', 'product_id': f.cart.items.last().product_id},
+        {'op': 'add', 'product_id': f.cart.items.first().product_id},
+    ]}),
+    ('checkout', 'get', lambda f: reverse('checkout'), None),
+    ('checkout_post', 'post', lambda f: reverse('checkout'), None),
+    ('product_detail', 'get', lambda f: reverse('product_detail', args=[f.product.id]), None),
+    ('category_products', 'get', lambda f: reverse('category_products', args=[f.category.slug]), None),
+    ('brand_products', 'get', lambda f: reverse('brand_products', args=[f.brand.slug]), None),
+    ('wishlist', 'get', lambda f: reverse('wishlist'), None),
+    ('toggle_wishlist', 'post', lambda f: reverse('toggle_wishlist'), lambda f: {'product_id': f.product.id}),
+    ('submit_review', 'post', lambda f: reverse('submit_review'), lambda f: {'product_id': f.product.id, 'rating': 4}),
+    ('categories', 'get', lambda f: reverse('categories'), None),
+    ('brands', 'get', lambda f: reverse('brands'), None),
+    ('visual_search_page', 'get', lambda f: reverse('visual_search'), None),
+    ('api_visual_search', 'get', lambda f: reverse('api_visual_search'), None),
+    ('nearby_stores_page', 'get', lambda f: reverse('nearby_stores'), None),
+    ('deals', 'get', lambda f: reverse('deals'), None),
+    ('new_arrivals', 'get', lambda f: reverse('new_arrivals'), None),
+    ('resized_image', 'get', lambda f: reverse('resized_image', args=['product', f.product.id, 300, 300, 'webp']), None),
+    ('slow_requests', 'get', lambda f: reverse('slow_requests'), None),
+    ('store_locations', 'get', lambda f: reverse('store:store_locations'), None),
+    ('store_detail', 'get', lambda f: reverse('store:store_detail', args=[f.store.id]), None),
+    ('store_nearby', 'post_json', lambda f: reverse('store:nearby_stores'),
+     lambda f: {'latitude': 40.0, 'longitude': -74.0, 'radius': 5000}),
+    ('clear_cart', 'post', lambda f: reverse('clear_cart'), None),
+    ('logout', 'post', lambda f: reverse('logout'), None),
+]
+if products_urls is not None:
+    VIEW_CASES[-2:-2] = [
+        ('get_products', 'get', lambda f: reverse('products:get_products'), None),
+        ('extract_features', 'post', lambda f: reverse('products:extract_features'), None),
+    ]
+
+
+@override_settings(
+    ROOT_URLCONF='shop_app.tests',
+    TEMPLATES=HARNESS_TEMPLATES,
+    ENFORCE_QUERY_BUDGETS=False,
+)
+class QueryBudgetHarnessTests(TestCase):
+    """Drive every storefront, store and products URL against a small and
+    then a much larger catalog. Each view must stay within the
+    @query_budget it declares, and its query count must not change with
+    the amount of data (no N+1 queries).
+
+    Requests are made as a logged-in staff user with a populated cart. Set
+    QUERY_BUDGET_REPORT=1 to print per-view query counts and SQL time.
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('budget', password=HARNESS_PASSWORD, is_staff=True)
+        self.f = SimpleNamespace(cart=Cart.objects.create(user=self.user))
+        self.scale = 0
+
+    def grow(self, scale):
+        """Grow every dimension the views iterate over to ``scale``"""
+        f = self.f
+        for i in range(self.scale, scale):
+            category = Category.objects.create(name=f'Category {i}')
+            brand = Brand.objects.create(name=f'Brand {i}')
+            for j in range(4):
+                product = Product.objects.create(
+                    name=f'Widget {i}-{j}', description='A useful widget',
+                    category=category, brand=brand,
+                    price=Decimal('20.00') + j, discount_price=Decimal('9.00') if j % 2 else None,
+                    stock=1000, is_featured=True, is_new=True,
+                )
+                CartItem.objects.create(cart=f.cart, product=product, quantity=1)
+                Wishlist.objects.create(user=self.user, product=product)
+            StoreLocation.objects.create(
+                name=f'Store {i}', address='1 Main St', city='City', state='ST',
+                zip_code='00000', latitude=40.0 + i / 100, longitude=-74.0,
+            )
+            Store.objects.create(name=f'Shop {i}', location='Main St', nearby=bool(i % 2))
+            Deal.objects.create(
+                product=product, title=f'Deal {i}',
+                end_date=timezone.now() + timedelta(days=1),
+            )
+            if products_urls is not None:
+                legacy_category = LegacyCategory.objects.create(name=f'Category {i}')
+                legacy_brand = LegacyBrand.objects.create(name=f'Brand {i}')
+                LegacyProduct.objects.create(
+                    name=f'Widget {i}', description='', price=Decimal('10.00'),
+                    category=legacy_category, brand=legacy_brand,
+                )
+        self.scale = scale
+
+        # Views below act on the first product, which collects the reviews
+        f.category = Category.objects.order_by('id').first()
+        f.brand = Brand.objects.order_by('id').first()
+        f.product = Product.objects.filter(category=f.category).order_by('id').first()
+        f.store = StoreLocation.objects.order_by('id').first()
+        for i in range(ProductReview.objects.filter(product=f.product).count(), scale * 3):
+            ProductReview.objects.create(
+                product=f.product, user=User.objects.create_user(f'reviewer{i}'),
+                rating=4, is_approved=True,
+            )
+
+    def reset_state(self):
+        """Undo the previous case's writes and start every case cold"""
+        f = self.f
+        for product in Product.objects.exclude(cartitem__cart=f.cart):
+            CartItem.objects.create(cart=f.cart, product=product, quantity=1)
+        Wishlist.objects.get_or_create(user=self.user, product=f.product)
+        StockHold.objects.all().delete()
+        User.objects.filter(username='newcomer').delete()
+        self.client.force_login(self.user)
+        cache.clear()
+        typeahead_index.invalidate()
+
+    def measure(self, method, url, data):
+        if method.startswith('guest_'):
+            self.client.logout()
+            self.client.post(reverse('add_to_cart'), {'product_id': self.f.product.id})
+            method = method[len('guest_'):]
+        counter = QueryCounter()
+        with connection.execute_wrapper(counter):
+            if method == 'post_json':
+                response = self.client.post(url, json.dumps(data), content_type='application/json')
+            else:
+                response = getattr(self.client, method)(url, data or {})
+        self.assertLess(response.status_code, 500, f'{url} failed: {response.content[:300]}')
+        return counter.count, counter.duration
+
+    def run_cases(self):
+        results = {}
+        for label, method, url, data in VIEW_CASES:
+            self.reset_state()
+            results[label] = self.measure(method, url(self.f), data(self.f) if data else None)
+        return results
+
+    def test_views_stay_within_budget_as_catalog_grows(self):
+        self.grow(1)
+        small = self.run_cases()
+        self.grow(6)
+        large = self.run_cases()
+
+        report = []
+        for label, method, url, data in VIEW_CASES:
+            resolved_url = url(self.f)
+            view = resolve(resolved_url.split('?')[0]).func
+            budget = getattr(view, 'query_budget', None)
+            (small_count, _), (large_count, large_time) = small[label], large[label]
+            report.append(f'{label:<22} {large_count:>3} queries (budget {budget}) {large_time * 1000:7.2f} ms SQL')
+
+            with self.subTest(view=label):
+                self.assertTrue(
+                    hasattr(view, 'query_budget'), f'{label} does not declare a @query_budget'
+                )
+                if budget is None:
+                    continue
+                self.assertLessEqual(large_count, budget, f'{label} is over its query budget')
+                self.assertEqual(
+                    small_count, large_count,
+                    f'{label} query count grows with data ({small_count} -> {large_count})'
+                )
+
+        if os.environ.get('QUERY_BUDGET_REPORT'):
+            print('\n' + '\n'.join(report))
@@ -0,0 +1,220 @@
+# typeahead.py - per-process prefix index for the live search box
+import heapq
+import re
+import threading
+import time
+import unicodedata
+from bisect import bisect_left, insort
+
+_TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def normalize(text):
+    """Lowercase and strip accents so 'Crème' and 'creme' match"""
+    text = unicodedata.normalize('NFKD', text or '')
+    text = ''.join(ch for ch in text if not unicodedata.combining(ch))
+    return text.lower()
+
+
+def tokenize(text):
+    return _TOKEN_RE.findall(normalize(text))
+
+
+class TypeaheadIndex:
+    """Sorted token array over product names and brands.
+
+    Each token maps to the set of product ids containing it; prefix lookups
+    are a bisect into the sorted token list followed by a short scan, so a
+    suggestion never touches the database. Products are ranked by a
+    popularity weight (units sold, then review count).
+
+    The index is built lazily on first use and kept current by product
+    signals in this process. Other worker processes pick up changes on
+    their next periodic rebuild (``rebuild_interval`` seconds). Rebuilds
+    read the table into new structures outside the lock and swap them in,
+    so lookups keep using the previous index meanwhile; only the very
+    first lookup waits for a build.
+    """
+
+    def __init__(self, rebuild_interval=300):
+        self.rebuild_interval = rebuild_interval
+        self._lock = threading.RLock()
+        self._build_lock = threading.Lock()
+        self._tokens = []
+        self._postings = {}
+        self._docs = {}
+        self._brands = {}
+        self._ready = False
+        self._built_at = None
+        # {product id: (name, brand name, weight) or None} changed while
+        # a rebuild is reading the table; None when no rebuild runs
+        self._pending = None
+        self._generation = 0
+
+    def _is_stale(self):
+        return (
+            self._built_at is None or
+            time.monotonic() - self._built_at > self.rebuild_interval
+        )
+
+    def rebuild(self):
+        """Rebuild from the database now"""
+        with self._build_lock:
+            self._build()
+
+    def _build(self):
+        # Called with _build_lock held
+        from .models import Product
+
+        with self._lock:
+            self._pending = {}
+            generation = self._generation
+        try:
+            rows = Product.objects.filter(available=True).values_list(
+                'id', 'name', 'brand_id', 'brand__name', 'sold_count', 'review_count'
+            )
+            brands = {}
+            postings = {}
+            docs = {}
+            for product_id, name, brand_id, brand_name, sold_count, review_count in rows.iterator():
+                brands[brand_id] = brand_name
+                tokens = set(tokenize(name)) | set(tokenize(brand_name))
+                docs[product_id] = (tokens, (sold_count, review_count))
+                for token in tokens:
+                    postings.setdefault(token, set()).add(product_id)
+            # One sort instead of an insort per new token
+            tokens = sorted(postings)
+        except BaseException:
+            with self._lock:
+                self._pending = None
+            raise
+
+        with self._lock:
+            pending, self._pending = self._pending, None
+            self._tokens, self._postings, self._docs = tokens, postings, docs
+            self._brands.update(brands)
+            # Saves that happened while the table was being read
+            for product_id, doc in pending.items():
+                self._discard(product_id)
+                if doc is not None:
+                    self._add(product_id, *doc)
+            self._ready = True
+            # An invalidate() during the build asks for another one
+            self._built_at = time.monotonic() if generation == self._generation else None
+
+    def invalidate(self):
+        """Rebuild on the next lookup"""
+        with self._lock:
+            self._generation += 1
+            self._built_at = None
+
+    def rename_brand(self, brand_id, name):
+        """A brand's name changed: its products need reindexing"""
+        with self._lock:
+            self._brands[brand_id] = name
+            self.invalidate()
+
+    def _add(self, product_id, name, brand_name, weight):
+        tokens = set(tokenize(name)) | set(tokenize(brand_name))
+        self._docs[product_id] = (tokens, weight)
+        for token in tokens:
+            ids = self._postings.get(token)
+            if ids is None:
+                ids = self._postings[token] = set()
+                insort(self._tokens, token)
+            ids.add(product_id)
+
+    def _discard(self, product_id):
+        doc = self._docs.pop(product_id, None)
+        if doc is None:
+            return
+        for token in doc[0]:
+            ids = self._postings[token]
+            ids.discard(product_id)
+            if not ids:
+                del self._postings[token]
+                del self._tokens[bisect_left(self._tokens, token)]
+
+    def _brand_name(self, product):
+        from .models import Brand, Product
+
+        if Product.brand.is_cached(product):
+            return product.brand.name
+        brand_id = product.brand_id
+        name = self._brands.get(brand_id)
+        if name is None:
+            # A brand none of the indexed products had
+            name = self._brands[brand_id] = Brand.objects.filter(pk=brand_id).values_list(
+                'name', flat=True
+            ).first() or ''
+        return name
+
+    def update_product(self, product):
+        """Incrementally reindex one product after it was saved. Brand
+        names come from the index, so this does not query per save."""
+        with self._lock:
+            if not self._ready and self._pending is None:
+                return
+            doc = None
+            if product.available:
+                doc = (product.name, self._brand_name(product),
+                       (product.sold_count, product.review_count))
+            if self._pending is not None:
+                self._pending[product.pk] = doc
+            self._discard(product.pk)
+            if doc is not None:
+                self._add(product.pk, *doc)
+
+    def remove_product(self, product_id):
+        with self._lock:
+            if self._pending is not None:
+                self._pending[product_id] = None
+            self._discard(product_id)
+
+    def _prefix_ids(self, prefix):
+        ids = set()
+        tokens = self._tokens
+        i = bisect_left(tokens, prefix)
+        while i < len(tokens) and tokens[i].startswith(prefix):
+            ids |= self._postings[tokens[i]]
+            i += 1
+        return ids
+
+    def _refresh(self):
+        # Until the first build there is nothing to serve, so callers
+        # wait for it; after that one caller rebuilds a stale index and
+        # the rest keep using the current one
+        if not self._is_stale() or not self._build_lock.acquire(blocking=not self._ready):
+            return
+        try:
+            # Another caller may have rebuilt while this one waited
+            if self._is_stale():
+                self._build()
+        finally:
+            self._build_lock.release()
+
+    def suggest(self, query, limit=10):
+        """Return up to ``limit`` product ids whose words start with every
+        word in ``query``, most popular first"""
+        words = tokenize(query)
+        if not words:
+            return []
+
+        self._refresh()
+        with self._lock:
+            # Match the longest (most selective) word first
+            candidates = None
+            for word in sorted(words, key=len, reverse=True):
+                ids = self._prefix_ids(word)
+                candidates = ids if candidates is None else candidates & ids
+                if not candidates:
+                    return []
+
+            docs = self._docs
+            return heapq.nlargest(
+                limit, candidates, key=lambda pid: (docs[pid][1], pid)
+            )
+
+
+# Global instance
+typeahead_index = TypeaheadIndex()
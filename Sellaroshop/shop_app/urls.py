@@ -18,6 +18,7 @@ urlpatterns = [
     path('remove-from-cart/', views.remove_from_cart, name='remove_from_cart'),
     path('cart-data/', views.cart_data, name='cart_data'),
     path('update-cart-quantity/', views.update_cart_quantity, name='update_cart_quantity'),
+    path('update-cart-batch/', views.update_cart_batch, name='update_cart_batch'),
     path('get-cart-count/', views.get_cart_count, name='get_cart_count'),
     path('clear-cart/', views.clear_cart, name='clear_cart'),
     path('checkout/', views.checkout, name='checkout'),
@@ -44,4 +45,10 @@ urlpatterns = [
     path('nearby-stores/', views.nearby_stores, name='nearby_stores'),
     path('deals/', views.deals, name='deals'),
     path('new-arrivals/', views.new_arrivals, name='new_arrivals'),
+    
+    # Resized catalog images
+    path('img/<slug:kind>/<int:pk>/<int:width>x<int:height>.<slug:ext>', views.resized_image, name='resized_image'),
+    
+    # Staff-only diagnostics
+    path('profiling/slow-requests/', views.slow_requests_report, name='slow_requests'),
 ]
\ No newline at end of file
@@ -2,26 +2,45 @@
 from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.auth import authenticate, login, logout
 from django.contrib.auth.decorators import login_required
+from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth.forms import UserCreationForm
-from django.http import JsonResponse
+from django.http import FileResponse, Http404, HttpResponseNotModified, JsonResponse
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_POST, require_GET
 from django.db import transaction, models
 from decimal import Decimal, InvalidOperation
+from django.core.exceptions import ValidationError
 import json
 from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
-from django.db.models import Q, Count, Avg
+from django.db.models import Q, Count, Avg, Exists, OuterRef, Prefetch
+from django.core.cache import cache
+from django.conf import settings
 from django.contrib import messages
 from .models import (
     Product, Category, Brand, Cart, CartItem, 
-    Store, Deal, ProductReview, Wishlist, ProductImage
+    Store, Deal, ProductReview, Wishlist, ProductImage, InsufficientStock, MONEY
 )
+from . import search
+from .pagination import paginate
+from .facets import get_facets
+from .cache import catalog_condition, get_or_rebuild, is_shared, versioned_key
+from .budgets import query_budget
+from .profiling import slow_requests
+from .serializers import FastJsonResponse, api_product, cart_summary, product_card
+from . import carts, reservations, resize, snapshots
+from .typeahead import typeahead_index
 
 # Helper function to get or create cart
 def get_or_create_cart(request):
-    """Get or create cart for user or session"""
+    """Get or create cart for user or session.
+    
+    Anonymous visitors get a cookie-backed SessionCart (no database rows)
+    unless ANONYMOUS_CART_STORAGE is 'database'.
+    """
     if request.user.is_authenticated:
         cart, created = Cart.objects.get_or_create(user=request.user)
+    elif carts.uses_session_carts():
+        return carts.get_session_cart(request)
     else:
         # For anonymous users, use session
         session_key = request.session.session_key
@@ -35,19 +54,68 @@ def get_or_create_cart(request):
         )
     return cart
 
+# Listing helpers
+LISTING_SORTS = {
+    'price_asc': ('effective_price', 'id'),
+    'price_desc': ('-effective_price', '-id'),
+    'newest': ('-created_at', '-id'),
+    'popular': ('-sold_count', '-id'),
+}
+DEFAULT_LISTING_SORT = ('-created_at', '-id')
+
+def price_range_filter(min_price, max_price):
+    """Q for the min_price / max_price listing filters; malformed bounds
+    (including NaN and Infinity, which Decimal accepts) are ignored"""
+    condition = Q()
+    for bound, lookup in ((min_price, 'gte'), (max_price, 'lte')):
+        if bound:
+            try:
+                value = MONEY.to_python(bound)
+            except ValidationError:
+                continue
+            if value.is_finite():
+                condition &= Q(**{f'effective_price__{lookup}': value})
+    return condition
+
+def wants_json(request):
+    return (
+        request.headers.get('X-Requested-With') == 'XMLHttpRequest' or
+        request.GET.get('format') == 'json'
+    )
+
+def product_summary(product, held=None):
+    """Card fields for a loaded product, as plain (cacheable) data"""
+    return product_card(snapshots.from_instance(product), held)
+
+def with_available_stock(page):
+    """Set available_stock (stock minus active holds) on a page of
+    products, so HTML cards agree with the JSON in_stock"""
+    held = reservations.held_quantities()
+    for product in page:
+        product.available_stock = reservations.available_stock(product.id, product.stock, held)
+    return page
+
+def listing_json(page, facets=None):
+    """JSON body for one page of a paginated product listing"""
+    held = reservations.held_quantities()
+    return JsonResponse({
+        'success': True,
+        'products': [product_summary(product, held) for product in page],
+        'next_cursor': page.next_cursor,
+        'has_next': page.has_next,
+        'facets': facets
+    })
+
 # Home page
+@query_budget(2)
 def home(request):
-    featured_products = Product.objects.filter(is_featured=True, available=True)[:8]
-    new_products = Product.objects.filter(is_new=True, available=True)[:8]
-    on_sale_products = Product.objects.filter(is_on_sale=True, available=True)[:8]
-    
-    return render(request, 'index.html', {
-        'featured_products': featured_products,
-        'new_products': new_products,
-        'on_sale_products': on_sale_products,
-    })
+    # index.html renders its product cards client-side and reads no
+    # product context, so none is queried here
+    return render(request, 'index.html')
 
 # Authentication views
+# Budgets cover the worst case, a successful POST that merges a guest cart
+@query_budget(17)
 def login_user(request):
     if request.method == 'POST':
         username = request.POST.get('username')
@@ -55,29 +123,15 @@ def login_user(request):
         user = authenticate(request, username=username, password=password)
         
         if user is not None:
+            # login() rotates the session key the guest cart is stored under
+            guest_session_key = request.session.session_key
             login(request, user)
             
             # Merge cart if user had a guest cart
-            session_key = request.session.session_key
-            if session_key:
-                try:
-                    guest_cart = Cart.objects.filter(session_key=session_key, user=None).first()
-                    if guest_cart:
-                        user_cart = get_or_create_cart(request)
-                        # Transfer items from guest cart to user cart
-                        for item in guest_cart.items.all():
-                            user_item, created = CartItem.objects.get_or_create(
-                                cart=user_cart,
-                                product=item.product,
-                                defaults={'quantity': item.quantity}
-                            )
-                            if not created:
-                                user_item.quantity += item.quantity
-                                user_item.save()
-                        # Delete guest cart
-                        guest_cart.delete()
-                except Exception as e:
-                    print(f"Error merging cart: {e}")
+            try:
+                carts.merge_guest_cart(request, user, guest_session_key)
+            except Exception as e:
+                print(f"Error merging cart: {e}")
             
             if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
                 return JsonResponse({'success': True, 'message': 'Login successful'})
@@ -89,6 +143,7 @@ def login_user(request):
     
     return render(request, 'login.html')
 
+@query_budget(21)
 def signup(request):
     if request.method == 'POST':
         form = UserCreationForm(request.POST)
@@ -96,29 +151,14 @@ def signup(request):
             user = form.save()
             
             # Log the user in
+            guest_session_key = request.session.session_key
             login(request, user)
             
             # Merge cart if user had a guest cart
-            session_key = request.session.session_key
-            if session_key:
-                try:
-                    guest_cart = Cart.objects.filter(session_key=session_key, user=None).first()
-                    if guest_cart:
-                        user_cart = get_or_create_cart(request)
-                        # Transfer items from guest cart to user cart
-                        for item in guest_cart.items.all():
-                            user_item, created = CartItem.objects.get_or_create(
-                                cart=user_cart,
-                                product=item.product,
-                                defaults={'quantity': item.quantity}
-                            )
-                            if not created:
-                                user_item.quantity += item.quantity
-                                user_item.save()
-                        # Delete guest cart
-                        guest_cart.delete()
-                except Exception as e:
-                    print(f"Error merging cart: {e}")
+            try:
+                carts.merge_guest_cart(request, user, guest_session_key)
+            except Exception as e:
+                print(f"Error merging cart: {e}")
             
             if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
                 return JsonResponse({'success': True, 'message': 'Signup successful'})
@@ -132,6 +172,7 @@ def signup(request):
     form = UserCreationForm()
     return render(request, 'signup.html', {'form': form})
 
+@query_budget(4)
 def logout_user(request):
     if request.method == 'POST':
         logout(request)
@@ -141,9 +182,10 @@ def logout_user(request):
     return redirect('home')
 
 # Cart views
+@query_budget(7)
 def cart_page(request):
     cart = get_or_create_cart(request)
-    cart_items = cart.items.all().select_related('product')
+    cart_items = cart.line_items()
     total_cost = cart.total_cost()
     
     return render(request, 'cart.html', {
@@ -152,6 +194,7 @@ def cart_page(request):
         'total_cost': total_cost
     })
 
+@query_budget(11)
 @require_POST
 @csrf_exempt
 def add_to_cart(request):
@@ -162,43 +205,52 @@ def add_to_cart(request):
         print(f"DEBUG: Adding product {product_id} to cart")
         
         product = get_object_or_404(Product, id=product_id, available=True)
+        cart = get_or_create_cart(request)
         
-        # Check stock
-        if product.stock < quantity:
+        # Check stock; units held by other carts' checkouts are not available
+        available = reservations.available_for_cart(cart, {product.id: product.stock})[product.id]
+        if available < quantity:
             return JsonResponse({
                 'success': False,
-                'error': f'Only {product.stock} items available in stock'
+                'error': f'Only {available} items available in stock'
             })
         
-        cart = get_or_create_cart(request)
-        
-        # Get or create cart item
-        cart_item, created = CartItem.objects.get_or_create(
-            cart=cart,
-            product=product,
-            defaults={'quantity': quantity}
-        )
-        
-        if not created:
-            new_quantity = cart_item.quantity + quantity
-            if new_quantity > product.stock:
+        if isinstance(cart, carts.SessionCart):
+            new_quantity = cart.quantity(product.id) + quantity
+            if new_quantity > available:
                 return JsonResponse({
                     'success': False,
                     'error': f'Cannot add {quantity} more items. Total would exceed available stock.'
                 })
-            cart_item.quantity = new_quantity
-            cart_item.save()
+            cart.set(product.id, new_quantity)
+        else:
+            # Get or create cart item
+            cart_item, created = CartItem.objects.get_or_create(
+                cart=cart,
+                product=product,
+                defaults={'quantity': quantity}
+            )
+            
+            if not created:
+                new_quantity = cart_item.quantity + quantity
+                if new_quantity > available:
+                    return JsonResponse({
+                        'success': False,
+                        'error': f'Cannot add {quantity} more items. Total would exceed available stock.'
+                    })
+                cart_item.quantity = new_quantity
+                cart_item.save()
+            new_quantity = cart_item.quantity
         
         # Get updated cart data
-        cart_count = cart.total_items()
-        cart_total = cart.total_cost()
+        cart_count, cart_total = cart.totals()
         
         return JsonResponse({
             'success': True,
             'message': f'{product.name} added to cart',
             'cart_count': cart_count,
             'cart_total': float(cart_total),
-            'item_total': float(cart_item.item_total())
+            'item_total': float(product.final_price * new_quantity)
         })
     except Exception as e:
         print(f"ERROR in add_to_cart: {str(e)}")
@@ -207,6 +259,7 @@ def add_to_cart(request):
             'error': str(e)
         }, status=400)
 
+@query_budget(10)
 @require_POST
 @csrf_exempt
 def remove_from_cart(request):
@@ -214,13 +267,21 @@ def remove_from_cart(request):
         item_id = request.POST.get('item_id')
         cart = get_or_create_cart(request)
         
-        cart_item = get_object_or_404(CartItem, id=item_id, cart=cart)
-        product_name = cart_item.product.name
-        cart_item.delete()
+        if isinstance(cart, carts.SessionCart):
+            # Session cart item ids are product ids
+            product_id = int(item_id)
+            snapshot = snapshots.get(product_id) if cart.quantity(product_id) else None
+            if snapshot is None:
+                raise Http404('No such cart item')
+            product_name = snapshot['name']
+            cart.remove(product_id)
+        else:
+            cart_item = get_object_or_404(CartItem.objects.select_related('product'), id=item_id, cart=cart)
+            product_name = cart_item.product.name
+            cart_item.delete()
         
         # Get updated cart data
-        cart_count = cart.total_items()
-        cart_total = cart.total_cost()
+        cart_count, cart_total = cart.totals()
         
         return JsonResponse({
             'success': True,
@@ -234,36 +295,18 @@ def remove_from_cart(request):
             'error': str(e)
         }, status=400)
 
+@query_budget(5)
 def cart_data(request):
     """Get cart data for AJAX requests"""
     try:
         cart = get_or_create_cart(request)
-        cart_items = cart.items.all().select_related('product')
+        summary = cart_summary(cart)
         
-        items_data = []
-        for item in cart_items:
-            product = item.product
-            items_data.append({
-                'id': item.id,
-                'product_id': product.id,
-                'name': product.name,
-                'price': float(product.final_price),
-                'original_price': float(product.price),
-                'quantity': item.quantity,
-                'image': product.image.url if product.image else '/static/img/default-product.jpg',
-                'total': float(item.item_total()),
-                'stock': product.stock,
-                'in_stock': product.is_in_stock
-            })
-        
-        total = cart.total_cost()
-        cart_count = cart.total_items()
-        
-        return JsonResponse({
+        return FastJsonResponse({
             'success': True,
-            'count': cart_count,
-            'items': items_data,
-            'total': float(total),
+            'count': summary['count'],
+            'items': summary['items'],
+            'total': summary['total'],
             'cart_id': cart.id
         })
     except Exception as e:
@@ -276,6 +319,7 @@ def cart_data(request):
             'total': 0
         }, status=500)
 
+@query_budget(10)
 @require_POST
 @csrf_exempt
 def update_cart_quantity(request):
@@ -290,22 +334,31 @@ def update_cart_quantity(request):
             })
         
         cart = get_or_create_cart(request)
-        cart_item = get_object_or_404(CartItem, id=item_id, cart=cart)
+        if isinstance(cart, carts.SessionCart):
+            if not cart.quantity(int(item_id)):
+                raise Http404('No such cart item')
+            product = get_object_or_404(Product, id=item_id)
+        else:
+            cart_item = get_object_or_404(CartItem.objects.select_related('product'), id=item_id, cart=cart)
+            product = cart_item.product
         
-        # Check stock
-        if quantity > cart_item.product.stock:
+        # Check stock; units held by other carts' checkouts are not available
+        available = reservations.available_for_cart(cart, {product.id: product.stock})[product.id]
+        if quantity > available:
             return JsonResponse({
                 'success': False,
-                'error': f'Only {cart_item.product.stock} items available in stock'
+                'error': f'Only {available} items available in stock'
             })
         
-        cart_item.quantity = quantity
-        cart_item.save()
+        if isinstance(cart, carts.SessionCart):
+            cart.set(product.id, quantity)
+        else:
+            cart_item.quantity = quantity
+            cart_item.save()
         
         # Recalculate totals
-        total_cost = cart.total_cost()
-        cart_count = cart.total_items()
-        item_total = cart_item.item_total()
+        cart_count, total_cost = cart.totals()
+        item_total = product.final_price * quantity
         
         return JsonResponse({
             'success': True,
@@ -321,6 +374,43 @@ def update_cart_quantity(request):
             'error': str(e)
         }, status=400)
 
+@query_budget(12)
+@require_POST
+@csrf_exempt
+def update_cart_batch(request):
+    """Apply several cart changes in one request and return the new cart.
+    
+    Body: {"operations": [{"op": "add" | "set" | "remove",
+                           "product_id": 1, "quantity": 2}, ...]}
+    Either every operation is applied or none is.
+    """
+    try:
+        data = json.loads(request.body or b'{}')
+        operations = carts.parse_operations(data.get('operations') if isinstance(data, dict) else None)
+    except ValueError as e:
+        return JsonResponse({'success': False, 'error': str(e)}, status=400)
+    
+    try:
+        cart = get_or_create_cart(request)
+        errors = carts.apply_operations(cart, operations)
+        if errors:
+            return JsonResponse({'success': False, 'error': errors[0], 'errors': errors}, status=400)
+        
+        summary = cart_summary(cart)
+        return FastJsonResponse({
+            'success': True,
+            'count': summary['count'],
+            'items': summary['items'],
+            'total': summary['total'],
+            'cart_id': cart.id
+        })
+    except Exception as e:
+        return JsonResponse({
+            'success': False,
+            'error': str(e)
+        }, status=400)
+
+@query_budget(6)
 def get_cart_count(request):
     """Get only cart count (lighter than full cart_data)"""
     try:
@@ -330,16 +420,19 @@ def get_cart_count(request):
     except Exception as e:
         return JsonResponse({'success': False, 'count': 0, 'error': str(e)})
 
+@query_budget(6)
 @require_POST
 @csrf_exempt
 def clear_cart(request):
     try:
         cart = get_or_create_cart(request)
-        cart.items.all().delete()
+        cart.clear()
         return JsonResponse({'success': True, 'message': 'Cart cleared'})
     except Exception as e:
         return JsonResponse({'success': False, 'error': str(e)})
 
+# Budget covers a successful POST (hold, decrement, release, clear)
+@query_budget(20)
 @login_required
 def checkout(request):
     cart = get_or_create_cart(request)
@@ -347,14 +440,14 @@ def checkout(request):
     if cart.is_empty():
         return redirect('cart_page')
     
-    cart_items = cart.items.all().select_related('product')
+    cart_items = cart.line_items()
     total_cost = cart.total_cost()
+    lines = {item.product_id: item.quantity for item in cart_items}
     
-    # Check stock for all items before checkout
-    out_of_stock_items = []
-    for item in cart_items:
-        if item.quantity > item.product.stock:
-            out_of_stock_items.append(item.product.name)
+    # Hold the stock while the customer checks out (extended on submit);
+    # stock held by other checkouts is not available
+    shortages = reservations.hold_cart(cart, lines)
+    out_of_stock_items = [item.product.name for item in cart_items if item.product_id in shortages]
     
     if out_of_stock_items:
         return render(request, 'checkout.html', {
@@ -369,11 +462,20 @@ def checkout(request):
         # Process payment here (simplified)
         # In a real app, you would integrate with a payment gateway
         
-        # Update stock and clear cart
-        with transaction.atomic():
-            for item in cart_items:
-                item.product.reduce_stock(item.quantity)
-            cart.items.all().delete()
+        # Update stock and clear cart; a short line rolls back everything
+        try:
+            with transaction.atomic():
+                Product.objects.decrement_stock(lines)
+                reservations.release(cart)
+                cart.clear()
+        except InsufficientStock as e:
+            return render(request, 'checkout.html', {
+                'cart': cart,
+                'cart_items': cart_items,
+                'total_cost': total_cost,
+                'out_of_stock_items': [item.product.name for item in cart_items if item.product_id in e.shortages],
+                'error': 'Some items are out of stock'
+            })
         
         return render(request, 'checkout_success.html', {
             'order_total': total_cost,
@@ -387,34 +489,60 @@ def checkout(request):
     })
 
 # Product views
+RELATED_PRODUCTS_TIMEOUT = 60 * 60
+
+def related_product_ids(product):
+    """Ids of the related products for a product page, cached per
+    catalog version"""
+    key = versioned_key('related', product.id)
+    ids = cache.get(key)
+    if ids is None:
+        ids = list(Product.objects.filter(
+            category_id=product.category_id,
+            available=True
+        ).exclude(id=product.id).values_list('id', flat=True)[:4])
+        cache.set(key, ids, RELATED_PRODUCTS_TIMEOUT)
+    return ids
+
+@query_budget(8)
 def product_detail(request, product_id):
-    product = get_object_or_404(Product, id=product_id, available=True)
-    images = product.images.all()
-    related_products = Product.objects.filter(
-        category=product.category, 
-        available=True
-    ).exclude(id=product_id)[:4]
-    
-    # Get reviews
-    reviews = product.reviews.filter(is_approved=True)
+    products = Product.objects.select_related('category', 'brand').prefetch_related(
+        'images',
+        Prefetch(
+            'reviews',
+            queryset=ProductReview.objects.filter(is_approved=True).select_related('user'),
+            to_attr='approved_reviews'
+        )
+    )
     
-    # Check if user has this in wishlist
-    in_wishlist = False
+    # Check if user has this in wishlist, in the same query
     if request.user.is_authenticated:
-        in_wishlist = Wishlist.objects.filter(
-            user=request.user, 
-            product=product
-        ).exists()
+        products = products.annotate(in_wishlist=Exists(
+            Wishlist.objects.filter(user=request.user, product=OuterRef('pk'))
+        ))
+    
+    product = get_object_or_404(products, id=product_id, available=True)
+    
+    # Related products come from a precomputed id list, hydrated in one query
+    related_ids = related_product_ids(product)
+    related_by_id = Product.objects.filter(available=True).in_bulk(related_ids) if related_ids else {}
+    related_products = [related_by_id[pid] for pid in related_ids if pid in related_by_id]
+    
+    available_stock = reservations.available_stock(product.id, product.stock)
     
     return render(request, 'product_detail.html', {
         'product': product,
-        'images': images,
+        'available_stock': available_stock,
+        'in_stock': available_stock > 0,
+        'images': product.images.all(),
         'related_products': related_products,
-        'reviews': reviews,
-        'in_wishlist': in_wishlist
+        'reviews': product.approved_reviews,
+        'in_wishlist': getattr(product, 'in_wishlist', False)
     })
 
 # Search views
+@query_budget(5)
+@catalog_condition(when=wants_json)
 def search_products(request):
     query = request.GET.get('q', '').strip()
     category_id = request.GET.get('category', '')
@@ -424,103 +552,107 @@ def search_products(request):
     products = Product.objects.filter(available=True)
     
     if query:
-        products = products.filter(name__icontains=query)
-    
-    if category_id:
-        products = products.filter(category_id=category_id)
-    
-    if min_price:
-        try:
-            products = products.filter(final_price__gte=Decimal(min_price))
-        except:
-            pass
+        products = search.filter_queryset(products, query)
     
-    if max_price:
-        try:
-            products = products.filter(final_price__lte=Decimal(max_price))
-        except:
-            pass
-    
-    categories = Category.objects.filter(is_active=True)
+    # Facet filters are counted separately: each facet's counts leave out
+    # its own filter, so the other categories do not all show (0)
+    filters = {
+        'category': Q(category_id=category_id) if category_id else Q(),
+        'price': price_range_filter(min_price, max_price),
+    }
+    facets = get_facets(
+        products, query, filters,
+        category=category_id, min_price=min_price, max_price=max_price
+    )
+    products = products.filter(*filters.values())
+    ordering = ('search_rank', '-id') if query else DEFAULT_LISTING_SORT
+    page = paginate(products, ordering, request.GET)
+    
+    if wants_json(request):
+        return listing_json(page, facets)
+    
+    # Show how many results each category filter would keep
+    category_counts = {c['id']: c['count'] for c in facets['categories']}
+    categories = list(Category.objects.filter(is_active=True))
+    for category in categories:
+        category.facet_count = category_counts.get(category.id, 0)
     
     return render(request, 'search_results.html', {
         'query': query,
-        'products': products[:50],
+        'products': page,
+        'page': page,
+        'facets': facets,
         'categories': categories,
         'selected_category': category_id,
         'min_price': min_price,
         'max_price': max_price
     })
 
+@query_budget(3)
 @require_GET
+@catalog_condition()
 def search_api(request):
     """API endpoint for live search"""
     query = request.GET.get('q', '').strip()
     if len(query) < 2:
         return JsonResponse({'results': []})
     
-    products = Product.objects.filter(
-        name__icontains=query, 
-        available=True
-    )[:10]
-    
-    results = []
-    for product in products:
-        results.append({
-            'id': product.id,
-            'name': product.name,
-            'price': float(product.final_price),
-            'original_price': float(product.price),
-            'image': product.image.url if product.image else '',
-            'url': f'/product/{product.id}/',
-            'in_stock': product.is_in_stock,
-            'discount_percentage': product.discount_percentage
-        })
-    
-    return JsonResponse({'results': results})
+    # Suggestions come from the in-memory index and the product snapshot
+    # cache; the DB is only read for snapshot misses
+    product_ids = typeahead_index.suggest(query, limit=10)
+    products = snapshots.get_many(product_ids)
+    held = reservations.held_quantities()
+    results = [
+        product_card(products[pid], held) for pid in product_ids
+        if pid in products and products[pid]['available']
+    ]
+    
+    return FastJsonResponse({'results': results})
 
 # API endpoints
+@query_budget(3)
 @require_GET
+@catalog_condition()
 def api_products(request):
     """API endpoint to get products for homepage"""
     try:
-        products = Product.objects.filter(available=True)[:8]
+        product_ids = list(Product.objects.filter(available=True).values_list('id', flat=True)[:8])
+        products = snapshots.get_many(product_ids)
+        held = reservations.held_quantities()
+        product_list = [api_product(products[pid], held) for pid in product_ids if pid in products]
         
-        product_list = []
-        for product in products:
-            product_list.append({
-                'id': product.id,
-                'name': product.name,
-                'price': float(product.price),
-                'final_price': float(product.final_price) if product.final_price else float(product.price),
-                'description': product.description,
-                'image': product.image.url if product.image else '/static/img/default-product.jpg',
-                'stock': product.stock,
-                'is_featured': product.is_featured,
-                'is_new': product.is_new,
-                'rating': float(product.rating) if product.rating else 0,
-                'review_count': product.review_count or 0,
-                'discount_percentage': product.discount_percentage
-            })
-        
-        return JsonResponse(product_list, safe=False)
+        return FastJsonResponse(product_list, safe=False)
         
     except Exception as e:
         print(f"ERROR in api_products: {str(e)}")
         return JsonResponse({'error': str(e)}, status=500)
 
 # Static page views
+TAXONOMY_TIMEOUT = 60 * 60
+
+@query_budget(3)
 def categories(request):
-    categories = Category.objects.filter(is_active=True).prefetch_related('products')
+    categories = get_or_rebuild(
+        'taxonomy:categories',
+        lambda: list(Category.objects.filter(is_active=True).with_product_counts()),
+        TAXONOMY_TIMEOUT
+    )
     return render(request, 'categories.html', {'categories': categories})
 
+@query_budget(3)
 def brands(request):
-    brands = Brand.objects.filter(is_active=True).prefetch_related('products')
+    brands = get_or_rebuild(
+        'taxonomy:brands',
+        lambda: list(Brand.objects.filter(is_active=True).with_product_counts()),
+        TAXONOMY_TIMEOUT
+    )
     return render(request, 'brands.html', {'brands': brands})
 
+@query_budget(2)
 def visual_search(request):
     return render(request, 'visual_search.html')
 
+@query_budget(3)
 def api_visual_search(request):
     # This would handle image upload and search
     # For now, return dummy data
@@ -541,6 +673,7 @@ def api_visual_search(request):
     
     return JsonResponse({'success': False, 'error': 'No image provided'})
 
+@query_budget(2)
 def nearby_stores(request):
     stores = Store.objects.filter(is_active=True)
     
@@ -553,6 +686,7 @@ def nearby_stores(request):
         'other_stores': other_stores
     })
 
+@query_budget(2)
 def deals(request):
     # Get active deals
     active_deals = Deal.objects.filter(is_active=True)
@@ -568,6 +702,7 @@ def deals(request):
         'sale_products': sale_products
     })
 
+@query_budget(2)
 def new_arrivals(request):
     # Get new products
     new_products = Product.objects.filter(
@@ -580,11 +715,13 @@ def new_arrivals(request):
     })
 
 # Wishlist views
+@query_budget(3)
 @login_required
 def wishlist(request):
     wishlist_items = Wishlist.objects.filter(user=request.user).select_related('product')
     return render(request, 'wishlist.html', {'wishlist_items': wishlist_items})
 
+@query_budget(5)
 @require_POST
 @login_required
 @csrf_exempt
@@ -620,6 +757,7 @@ def toggle_wishlist(request):
         }, status=400)
 
 # Review views
+@query_budget(11)
 @require_POST
 @login_required
 @csrf_exempt
@@ -671,6 +809,8 @@ def submit_review(request):
         }, status=400)
 
 # Category products view
+@query_budget(6)
+@catalog_condition(when=wants_json)
 def category_products(request, category_slug):
     category = get_object_or_404(Category, slug=category_slug, is_active=True)
     products = Product.objects.filter(category=category, available=True)
@@ -680,46 +820,51 @@ def category_products(request, category_slug):
     max_price = request.GET.get('max_price', '')
     sort_by = request.GET.get('sort', '')
     
-    if min_price:
-        try:
-            products = products.filter(final_price__gte=Decimal(min_price))
-        except:
-            pass
+    price_filter = price_range_filter(min_price, max_price)
+    facets = get_facets(
+        products, '', {'price': price_filter},
+        category=category.id, min_price=min_price, max_price=max_price
+    )
+    products = products.filter(price_filter)
+    ordering = LISTING_SORTS.get(sort_by, DEFAULT_LISTING_SORT)
+    page = paginate(products, ordering, request.GET)
     
-    if max_price:
-        try:
-            products = products.filter(final_price__lte=Decimal(max_price))
-        except:
-            pass
-    
-    if sort_by == 'price_asc':
-        products = products.order_by('final_price')
-    elif sort_by == 'price_desc':
-        products = products.order_by('-final_price')
-    elif sort_by == 'newest':
-        products = products.order_by('-created_at')
-    elif sort_by == 'popular':
-        products = products.order_by('-sold_count')
+    if wants_json(request):
+        return listing_json(page, facets)
     
     return render(request, 'category_products.html', {
         'category': category,
-        'products': products,
+        'products': with_available_stock(page),
+        'page': page,
+        'facets': facets,
         'min_price': min_price,
         'max_price': max_price,
         'sort_by': sort_by
     })
 
 # Brand products view
+@query_budget(2)
+@catalog_condition(when=wants_json)
 def brand_products(request, brand_slug):
     brand = get_object_or_404(Brand, slug=brand_slug, is_active=True)
     products = Product.objects.filter(brand=brand, available=True)
+    sort_by = request.GET.get('sort', '')
+    
+    ordering = LISTING_SORTS.get(sort_by, DEFAULT_LISTING_SORT)
+    page = paginate(products, ordering, request.GET)
+    
+    if wants_json(request):
+        return listing_json(page)
     
     return render(request, 'brand_products.html', {
         'brand': brand,
-        'products': products
+        'products': page,
+        'page': page,
+        'sort_by': sort_by
     })
 
 # Debug view
+@query_budget(3)
 @require_GET
 def debug_products(request):
     """Debug endpoint to check products"""
@@ -728,4 +873,53 @@ def debug_products(request):
         'count': products.count(),
         'products': list(products.values('id', 'name', 'price', 'stock'))
     }
-    return JsonResponse(data)
\ No newline at end of file
+    return JsonResponse(data)
+
+@query_budget(1)
+@require_GET
+def resized_image(request, kind, pk, width, height, ext):
+    """A catalog image scaled to fit a whitelisted box, rendered on the
+    first request and then served from the disk cache"""
+    if not resize.allowed(kind, width, height, ext):
+        raise Http404('Unsupported image size')
+    name = resize.source_name(kind, pk)
+    if not name:
+        raise Http404('No image')
+    try:
+        key = resize.cache_key(kind, name, width, height, ext)
+    except FileNotFoundError:
+        raise Http404('Image file missing')
+    
+    etag = f'"{key}"'
+    if etag in request.headers.get('If-None-Match', ''):
+        response = HttpResponseNotModified()
+    else:
+        try:
+            handle = resize.open_resized(kind, name, key, width, height, ext)
+        except (FileNotFoundError, OSError) as e:
+            # Source vanished or is not a readable image
+            raise Http404(str(e))
+        response = FileResponse(handle, content_type=resize.CONTENT_TYPES[ext])
+    
+    response['ETag'] = etag
+    # Versioned URLs (see resize.resized_url) point at one upload forever
+    response['Cache-Control'] = resize.cache_control(request.GET.get('v') == resize.version(name))
+    return response
+
+@query_budget(2)
+@staff_member_required
+@require_GET
+def slow_requests_report(request):
+    """Sampled slow requests recorded by RequestProfilingMiddleware"""
+    entries = slow_requests.entries()
+    
+    if wants_json(request):
+        return JsonResponse({'success': True, 'entries': entries})
+    
+    return render(request, 'slow_requests.html', {
+        'entries': entries,
+        # Without a shared cache only this worker's requests are listed
+        'per_process': not is_shared(),
+        'threshold_ms': getattr(settings, 'PROFILING_SLOW_REQUEST_MS', 500),
+        'top_sql': getattr(settings, 'PROFILING_TOP_SQL', 5),
+    })
\ No newline at end of file
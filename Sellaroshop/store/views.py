@@ -3,6 +3,7 @@ from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_http_methods
 import json
 from .models import StoreLocation
+from shop_app.budgets import query_budget
 from math import radians, sin, cos, sqrt, atan2
 
 def haversine(lat1, lon1, lat2, lon2):
@@ -19,6 +20,7 @@ def haversine(lat1, lon1, lat2, lon2):
     
     return R * c
 
+@query_budget(1)
 @csrf_exempt
 @require_http_methods(["GET"])
 def get_store_locations(request):
@@ -53,6 +55,7 @@ def get_store_locations(request):
             'error': str(e)
         }, status=500)
 
+@query_budget(1)
 @csrf_exempt
 @require_http_methods(["POST"])
 def find_nearby_stores(request):
@@ -101,6 +104,7 @@ def find_nearby_stores(request):
             'error': str(e)
         }, status=500)
 
+@query_budget(1)
 @csrf_exempt
 @require_http_methods(["GET"])
 def get_store_by_id(request, store_id):